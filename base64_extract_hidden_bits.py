@@ -1,65 +1,382 @@
 #!/usr/bin/env python
-
+import os
 import string
+import sys
+
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from functools import cached_property
+from itertools import chain
+from typing import BinaryIO, Iterator
+
+import numpy as np
+
+NEWLINE = ord("\n")
+CARRIAGE_RETURN = ord("\r")
+
+# marks characters outside an alphabet in its decode table
+INVALID = 0xFF
+# how much of the input to read at once, and to give each worker
+CHUNK_SIZE = 1 << 24
+# lines are looked at from their end, this keeps the indices into the chunk positive
+# for the longest padding
+PREFIX = b"\n" * 8
+
+
+@dataclass
+class Encoding:
+    name: str
+    alphabet: str
+    # characters in a complete quantum
+    quantum: int
+    # data characters in the final quantum -> how many low bits of the last one are
+    # ignored by a decoder, and so can hide data
+    hidden_bits: dict[int, int]
+    padding: str = "="
+
+    @cached_property
+    def table(self) -> np.ndarray:
+        """Character -> its value, or INVALID for characters outside the alphabet."""
+        table = np.full(256, INVALID, dtype=np.uint8)
+        alphabet = np.frombuffer(self.alphabet.encode(), dtype=np.uint8)
+        table[alphabet] = np.arange(len(self.alphabet))
+        return table
+
+    @cached_property
+    def bits_table(self) -> np.ndarray:
+        """Data characters in the final quantum -> bits hidden in it."""
+        bits = np.zeros(self.quantum, dtype=np.int64)
+        for data_chars, hidden in self.hidden_bits.items():
+            bits[data_chars] = hidden
+        return bits
+
+    @property
+    def max_padding(self) -> int:
+        return self.quantum - min(self.hidden_bits)
+
+    def covers(self, characters: set[int]) -> bool:
+        return characters <= set((self.alphabet + self.padding).encode())
+
+    def slack(
+        self, data: np.ndarray, data_ends: np.ndarray, data_chars: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """The value hidden in the final quantum of each line ending at data_ends, and
+        whether it's valid."""
+        values = self.table[data[data_ends - 1]].astype(np.int64)
+        mask = (1 << self.bits_table[data_chars]) - 1
+        return values & mask, values != INVALID
+
+
+@dataclass
+class Base85Encoding(Encoding):
+    """Base85 has no spare bits, but a final group of n characters decodes to n - 1
+    bytes whichever of the values it could take, after the decoder pads it with the
+    largest digit. The hidden value is how far the group is above the one an encoder
+    would write, up to the number of values every group can take."""
+
+    quantum: int = 5
+    hidden_bits: dict[int, int] = field(default_factory=lambda: {2: 4, 3: 3, 4: 1})
+    padding: str = ""
+
+    def slack(
+        self, data: np.ndarray, data_ends: np.ndarray, data_chars: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        # the digits of the final group, padded with the largest one
+        position = np.arange(self.quantum)
+        indices = data_ends[:, None] - data_chars[:, None] + position
+        digits = self.table[data[np.minimum(indices, data_ends[:, None] - 1)]]
+        valid = (digits != INVALID).all(axis=1)
+        digits = np.where(position < data_chars[:, None], digits, 84).astype(np.int64)
+
+        value = digits @ (85 ** (self.quantum - 1 - position))
+        valid &= value < 1 << 32
+
+        # the value of the digits written, and of the ones an encoder would write for
+        # the bytes they decode to, which pads them with zero bytes
+        weight = 85 ** (self.quantum - data_chars)
+        written = value - (weight - 1)
+        ignored_bits = 8 * (self.quantum - data_chars)
+        encoded = (value >> ignored_bits) << ignored_bits
+        encoded -= encoded % weight
+
+        mask = (1 << self.bits_table[data_chars]) - 1
+        return ((written - encoded) // weight) & mask, valid
+
+
+ENCODINGS = {
+    encoding.name: encoding
+    for encoding in [
+        Encoding(
+            "base32",
+            string.ascii_uppercase + "234567",
+            8,
+            {2: 2, 4: 4, 5: 1, 7: 3},
+        ),
+        Encoding(
+            "base64",
+            string.ascii_uppercase + string.ascii_lowercase + string.digits + "+/",
+            4,
+            {2: 4, 3: 2},
+        ),
+        Encoding(
+            "base64url",
+            string.ascii_uppercase + string.ascii_lowercase + string.digits + "-_",
+            4,
+            {2: 4, 3: 2},
+        ),
+        Base85Encoding(
+            "base85",
+            string.digits
+            + string.ascii_uppercase
+            + string.ascii_lowercase
+            + "!#$%&()*+-;<=>?@^_`{|}~",
+        ),
+        Base85Encoding("ascii85", "".join(map(chr, range(ord("!"), ord("u") + 1)))),
+    ]
+}
+
+
+def detect_encoding(sample: bytes) -> Encoding:
+    """The first encoding in ENCODINGS whose alphabet covers every character in sample,
+    so the smallest that fits, and whose quantum fits the padded lines."""
+    characters = set(sample) - {NEWLINE, CARRIAGE_RETURN}
+    lines = sample.splitlines()
+    for encoding in ENCODINGS.values():
+        if not encoding.covers(characters):
+            continue
+        padding = encoding.padding.encode()
+        if padding and any(
+            len(line) % encoding.quantum for line in lines if line.endswith(padding)
+        ):
+            continue
+        return encoding
+    raise ValueError("The input doesn't fit any of the supported alphabets")
+
+
+def hidden_bits(chunk: bytes, encoding: Encoding, unpadded: bool = False) -> np.ndarray:
+    """The bits hidden in the final quantum of every line in chunk, which must end in a
+    newline.
+
+    Lines without padding are skipped unless unpadded is set, as the length of a line
+    then isn't a multiple of the quantum.
+    """
+    data = np.frombuffer(PREFIX + chunk, dtype=np.uint8)
+    newlines = np.flatnonzero(data == NEWLINE)
+    starts = newlines[len(PREFIX) - 1 : -1] + 1
+    ends = newlines[len(PREFIX) :]
+    ends -= data[ends - 1] == CARRIAGE_RETURN
+
+    # count the padding at the end of each line
+    data_ends = ends.copy()
+    if encoding.padding:
+        padded = np.ones(len(ends), dtype=bool)
+        for _ in range(encoding.max_padding):
+            padded &= data[data_ends - 1] == ord(encoding.padding)
+            data_ends -= padded
 
-base64 = string.ascii_uppercase + string.ascii_lowercase + string.digits + "+/"
-
-
-def decode_base64(s: str) -> tuple[bytes, str]:
-    out = []
-    curr_char = 0
-    bitpos = 0
-    for c in s:
-        if c == "=":
-            bits = 0
-        else:
-            bits = base64.index(c)
-
-        # print(
-        #     f"{bytes(out).decode(errors="ignore"):<10}, {c = }, curr_char = 0b{curr_char:08b}, {bitpos = }, bits = 0b{bits:08b}"
-        # )
-
-        match bitpos:
-            case 0:
-                curr_char = bits << 2
-                bitpos = 6
-            case 6:
-                curr_char |= bits >> 4
-                out.append(curr_char)
-                curr_char = (bits & 0b1111) << 4
-                bitpos = 4
-            case 4:
-                curr_char |= bits >> 2
-                out.append(curr_char)
-                curr_char = (bits & 0b11) << 6
-                bitpos = 2
-            case 2:
-                curr_char |= bits
-                out.append(curr_char)
-                bitpos = 0
-
-        # print(
-        #     f"{bytes(out).decode(errors="ignore"):<10}, {c = }, curr_char = 0b{curr_char:08b}, {bitpos = }, bits = 0b{bits:08b}"
-        # )
-
-    if s.endswith("=="):
-        last_byte = out.pop()
-        last_byte = out.pop()
-        return bytes(out), f"{last_byte >> 4:04b}"
-    if s.endswith("="):
-        last_byte = out.pop()
-        return bytes(out), f"{last_byte >> 6:02b}"
+    data_chars = (data_ends - starts) % encoding.quantum
+    hiding = encoding.bits_table[data_chars] != 0
+    if encoding.padding and not unpadded:
+        hiding &= (ends - starts) % encoding.quantum == 0
+
+    data_ends = data_ends[hiding]
+    data_chars = data_chars[hiding]
+    values, valid = encoding.slack(data, data_ends, data_chars)
+    values = values[valid]
+    bits = encoding.bits_table[data_chars[valid]]
+
+    # the low bits of each value, most significant first
+    expanded = np.unpackbits(values.astype(np.uint8)[:, None], axis=1)
+    keep = np.arange(8) >= 8 - bits[:, None]
+    return expanded[keep]
+
+
+def read_chunks(input_file: BinaryIO, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Read whole lines at a time, each chunk ending in a newline."""
+    rest = b""
+    while chunk := input_file.read(chunk_size):
+        end = chunk.rfind(b"\n") + 1
+        if not end:
+            rest += chunk
+            continue
+        yield rest + chunk[:end]
+        rest = chunk[end:]
+
+    if rest:
+        yield rest + b"\n"
+
+
+def read_range(path: str, start: int, stop: int) -> bytes:
+    """The lines which start in [start, stop) of a file, ending in a newline."""
+    with open(path, "rb") as f:
+        f.seek(max(start - 1, 0))
+        if start:
+            # skip the end of the line before, unless start is the start of a line
+            f.readline()
+        if f.tell() >= stop:
+            return b""
+        chunk = f.read(stop - f.tell())
+        if not chunk.endswith(b"\n"):
+            # finish the last line, which starts in the range
+            chunk += f.readline()
+    return chunk if chunk.endswith(b"\n") or not chunk else chunk + b"\n"
+
+
+def range_bits(
+    path: str, start: int, stop: int, encoding: str, unpadded: bool
+) -> tuple[bytes, int]:
+    """The hidden bits of a range of a file, packed to send back from a worker."""
+    chunk = read_range(path, start, stop)
+    bits = hidden_bits(chunk, ENCODINGS[encoding], unpadded)
+    return np.packbits(bits).tobytes(), len(bits)
+
+
+def file_bits(
+    path: str, encoding: Encoding, unpadded: bool, jobs: int
+) -> Iterator[np.ndarray]:
+    """Find the hidden bits of a file across a pool of workers, in order."""
+    size = os.path.getsize(path)
+    with ProcessPoolExecutor(jobs) as executor:
+        pending: deque[Future] = deque()
+        for start in range(0, size, CHUNK_SIZE):
+            pending.append(
+                executor.submit(
+                    range_bits, path, start, start + CHUNK_SIZE, encoding.name, unpadded
+                )
+            )
+            if len(pending) > 2 * jobs:
+                yield _unpack(*pending.popleft().result())
+        for future in pending:
+            yield _unpack(*future.result())
+
+
+def _unpack(packed: bytes, count: int) -> np.ndarray:
+    return np.unpackbits(np.frombuffer(packed, dtype=np.uint8), count=count)
+
+
+def pack(bits: Iterator[np.ndarray], bit_order: str = "msb") -> Iterator[bytes]:
+    """Pack bits into bytes as they're found, first bit in the most or least
+    significant bit of each byte.
+
+    Any bits left over at the end make up a final byte on their own, right aligned.
+    """
+    bitorder = "big" if bit_order == "msb" else "little"
+    leftover = np.zeros(0, dtype=np.uint8)
+    for found in bits:
+        found = np.concatenate([leftover, found])
+        whole = len(found) - len(found) % 8
+        leftover = found[whole:]
+        if whole:
+            yield np.packbits(found[:whole], bitorder=bitorder).tobytes()
+
+    if len(leftover):
+        if bit_order == "msb":
+            leftover = np.concatenate(
+                [np.zeros(8 - len(leftover), dtype=np.uint8), leftover]
+            )
+        yield np.packbits(leftover, bitorder=bitorder).tobytes()
+
+
+def extract(
+    path: str,
+    encoding: str = "auto",
+    unpadded: bool = False,
+    bit_order: str = "msb",
+    jobs: int = 1,
+) -> Iterator[bytes]:
+    """Yield the bytes hidden in a file of encoded lines (- for stdin) as they're found."""
+    # the pool only helps files split into several chunks
+    if path == "-" or jobs == 1 or os.path.getsize(path) <= CHUNK_SIZE:
+        input_file = sys.stdin.buffer if path == "-" else open(path, "rb")
+        with input_file:
+            chunks = read_chunks(input_file)
+            first = next(chunks, b"")
+            found = (
+                ENCODINGS[encoding] if encoding != "auto" else detect_encoding(first)
+            )
+            print(f"[info] {path}: {found.name}", file=sys.stderr)
+            bits = (
+                hidden_bits(chunk, found, unpadded) for chunk in chain([first], chunks)
+            )
+            yield from pack(bits, bit_order)
+        return
+
+    if encoding == "auto":
+        with open(path, "rb") as f:
+            found = detect_encoding(f.read(CHUNK_SIZE))
     else:
-        return bytes(out), ""
+        found = ENCODINGS[encoding]
+    print(f"[info] {path}: {found.name}", file=sys.stderr)
+    yield from pack(file_bits(path, found, unpadded, jobs), bit_order)
+
+
+def argument_parser() -> ArgumentParser:
+    parser = ArgumentParser(
+        description="Extract the bits hidden in the unused bits of base-N encoded lines."
+    )
+    parser.add_argument(
+        "inputs",
+        nargs="*",
+        default=["-"],
+        help="Files of encoded lines, by default read from stdin.",
+    )
+    parser.add_argument(
+        "-e",
+        "--encoding",
+        choices=["auto", *ENCODINGS],
+        default="auto",
+        help="The encoding of the lines, by default the smallest alphabet that fits each input.",
+    )
+    parser.add_argument(
+        "--unpadded",
+        action="store_true",
+        help="Also read lines missing their padding, as base64url often is.",
+    )
+    parser.add_argument(
+        "--bit-order",
+        choices=["msb", "lsb"],
+        default="msb",
+        help="Pack the hidden bits into the most or least significant bit of each byte first.",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of workers to split large files between.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Write the hidden bytes to this file (- for stdout) as they're found, instead of printing them at the end.",
+    )
+    return parser
+
+
+def main():
+    args = argument_parser().parse_args()
+
+    output_file = None
+    if args.output is not None:
+        output_file = (
+            sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+        )
+
+    for path in args.inputs:
+        hidden = extract(
+            path, args.encoding, args.unpadded, args.bit_order, args.jobs or 1
+        )
+        if output_file is None:
+            print(b"".join(hidden))
+            continue
 
+        for data in hidden:
+            output_file.write(data)
 
-with open("strings") as f:
-    lines = f.read().splitlines()
+    if output_file is not None:
+        output_file.close()
 
-all_hidden = ""
-for line in lines:
-    data, hidden = decode_base64(line)
-    all_hidden += hidden
 
-out = [int(all_hidden[i : i + 8], 2) for i in range(0, len(all_hidden), 8)]
-print(bytes(out))
+if __name__ == "__main__":
+    main()
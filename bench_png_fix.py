@@ -0,0 +1,459 @@
+#!/usr/bin/env python
+import json
+import logging
+import os
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+
+from argparse import ArgumentParser
+from dataclasses import dataclass, asdict
+from typing import Any, Callable
+
+import numpy as np
+
+import png_fix
+from png_fix import (
+    ADAM7_PASSES,
+    CHANNELS,
+    PNG_SIGNATURE,
+    Chunk,
+    ColorType,
+    InterlaceMethod,
+    PngMetadata,
+)
+
+SIZES = [(64, 64), (512, 384), (1920, 1080)]
+
+PIXEL_FORMATS = [
+    (1, ColorType.Greyscale),
+    (8, ColorType.Greyscale),
+    (4, ColorType.Indexed),
+    (8, ColorType.Truecolor),
+    (16, ColorType.Truecolor),
+    (8, ColorType.TruecolorAlpha),
+]
+
+CORRUPTIONS = ["none", "zeroed-dimensions", "bad-crc", "truncated-idat", "excess-data"]
+
+# mixed is None, Sub and Up, the others filter every scanline the same way, which
+# makes them the slowest to decode
+FILTERS = ["mixed", "average", "paeth"]
+
+# timings within this many seconds of the baseline are noise, not regressions
+NOISE_FLOOR = 1e-3
+
+
+@dataclass
+class Case:
+    width: int
+    height: int
+    bit_depth: int
+    color_type: ColorType
+    interlace_method: InterlaceMethod
+    corruption: str
+    filters: str = "mixed"
+
+    @property
+    def name(self) -> str:
+        # mixed filters are left out so older baselines still match
+        filters = "" if self.filters == "mixed" else f"-{self.filters}"
+        return (
+            f"{self.width}x{self.height}-bd{self.bit_depth}-ct{self.color_type:d}"
+            f"-i{self.interlace_method:d}{filters}-{self.corruption}"
+        )
+
+
+@dataclass
+class StageResult:
+    case: str
+    stage: str
+    seconds: float
+    mb_per_second: float
+    peak_bytes: int
+    ok: bool
+
+
+def make_samples(
+    width: int, height: int, bit_depth: int, color_type: ColorType, rng
+) -> np.ndarray:
+    """Gradients with a little noise, so filters and compression behave like a real image."""
+    channels = CHANNELS[color_type]
+    y, x = np.mgrid[0:height, 0:width]
+    levels = (1 << bit_depth) - 1
+    base = (x / max(width - 1, 1) + y / max(height - 1, 1)) / 2
+    samples = np.stack(
+        [(base + 0.1 * channel) % 1 for channel in range(channels)], axis=-1
+    )
+    samples = samples + rng.normal(0, 0.02, samples.shape)
+    return (np.clip(samples, 0, 1) * levels).round().astype(np.int64)
+
+
+def _pack_rows(samples: np.ndarray, bit_depth: int) -> np.ndarray:
+    rows = samples.reshape(len(samples), -1)
+    if bit_depth == 16:
+        return rows.astype(">u2").view(np.uint8).reshape(len(rows), -1)
+    if bit_depth == 8:
+        return rows.astype(np.uint8)
+
+    per_byte = 8 // bit_depth
+    padded = np.pad(rows, ((0, 0), (0, -rows.shape[1] % per_byte)))
+    grouped = padded.reshape(len(rows), -1, per_byte)
+    shifts = np.arange(8 - bit_depth, -1, -bit_depth)
+    return (grouped << shifts).sum(axis=-1).astype(np.uint8)
+
+
+def _filter_rows(rows: np.ndarray, bpp: int, filters: str, rng) -> np.ndarray:
+    prior = np.vstack([np.zeros((1, rows.shape[1]), np.uint8), rows[:-1]])
+    left = np.zeros_like(rows)
+    left[:, bpp:] = rows[:, :-bpp]
+    above_left = np.zeros_like(rows)
+    above_left[1:] = left[:-1]
+
+    match filters:
+        case "mixed":
+            # a mix of None, Sub and Up filtered scanlines
+            filter_types = rng.integers(0, 3, len(rows))
+            filtered = np.where(
+                filter_types[:, None] == 0,
+                rows,
+                np.where(filter_types[:, None] == 1, rows - left, rows - prior),
+            )
+        case "average":
+            filter_types = np.full(len(rows), 3)
+            average = (left.astype(np.int16) + prior) >> 1
+            filtered = rows - average.astype(np.uint8)
+        case "paeth":
+            filter_types = np.full(len(rows), 4)
+            a, b, c = (x.astype(np.int16) for x in (left, prior, above_left))
+            pa, pb, pc = np.abs(b - c), np.abs(a - c), np.abs(a + b - 2 * c)
+            nearest = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+            filtered = rows - nearest.astype(np.uint8)
+
+    return np.hstack([filter_types[:, None].astype(np.uint8), filtered])
+
+
+def encode_png(case: Case, rng) -> tuple[bytes, np.ndarray]:
+    """The PNG, and the samples it should decode to."""
+    samples = make_samples(
+        case.width, case.height, case.bit_depth, case.color_type, rng
+    )
+    pixel_bits = png_fix.pixel_size_bits(case.bit_depth, case.color_type)
+    bpp = max(pixel_bits // 8, 1)
+
+    if case.interlace_method == InterlaceMethod.Null:
+        passes = [samples]
+    else:
+        passes = [samples[y0::dy, x0::dx] for x0, y0, dx, dy in ADAM7_PASSES]
+
+    raw = b"".join(
+        _filter_rows(_pack_rows(p, case.bit_depth), bpp, case.filters, rng).tobytes()
+        for p in passes
+        if p.size != 0
+    )
+    ihdr = PngMetadata(
+        case.width,
+        case.height,
+        case.bit_depth,
+        case.color_type,
+        png_fix.CompressionMethod.Deflate,
+        png_fix.FilterMethod.AdaptiveFiltering,
+        case.interlace_method,
+    )
+
+    chunks = [Chunk(13, b"IHDR", bytes(ihdr))]
+    if case.color_type == ColorType.Indexed:
+        entries = 1 << case.bit_depth
+        chunks.append(Chunk(entries * 3, b"PLTE", rng.bytes(entries * 3)))
+
+    compressed = zlib.compress(raw, 1)
+    for start in range(0, len(compressed), 1 << 16):
+        idat = compressed[start : start + (1 << 16)]
+        chunks.append(Chunk(len(idat), b"IDAT", idat))
+    chunks.append(Chunk(0, b"IEND", b""))
+
+    for chunk in chunks:
+        chunk.recalc_crc()
+    png = PNG_SIGNATURE + b"".join(bytes(chunk) for chunk in chunks)
+    return png, samples
+
+
+def corrupt(png: bytes, corruption: str, rng) -> bytes:
+    data = bytearray(png)
+    match corruption:
+        case "none":
+            pass
+        case "zeroed-dimensions":
+            # the IHDR CRC still covers the original dimensions
+            data[16:24] = bytes(8)
+        case "bad-crc":
+            first_idat = png.index(b"IDAT")
+            (length,) = struct.unpack_from(">I", png, first_idat - 4)
+            bit = int(rng.integers(0, length * 8))
+            data[first_idat + 4 + bit // 8] ^= 1 << (bit % 8)
+        case "truncated-idat":
+            first_idat = png.index(b"IDAT")
+            data = data[: first_idat + (len(png) - first_idat) * 6 // 10]
+        case "excess-data":
+            data += rng.bytes(4096)
+    return bytes(data)
+
+
+def run_stages(
+    case: Case, path: str, original: bytes, samples: np.ndarray
+) -> list[tuple[str, Callable]]:
+    """The stages to time for a case, each returning whether it did the right thing."""
+    state: dict[str, Any] = {}
+
+    def parse():
+        with open(path, "rb") as f:
+            state["header"], state["chunks"], excess = png_fix.parse_png(f)
+        match case.corruption:
+            case "excess-data":
+                return len(excess) == 4096
+            case "truncated-idat":
+                # the partial chunk is kept so its data can be recovered
+                return len(excess) == 0 and state["chunks"][-1].truncated
+            case _:
+                return len(excess) == 0
+
+    def check_crc():
+        failures = [c.type for c in state["chunks"] if not c.crc_valid()]
+        if case.corruption in ("zeroed-dimensions", "bad-crc"):
+            return len(failures) == 1
+        if case.corruption == "truncated-idat":
+            # a truncated chunk has no CRC to check
+            return [c.type for c in state["chunks"] if c.truncated] == failures
+        return not failures
+
+    def validate():
+        report = png_fix.detect_excess_data(state["chunks"])
+        match case.corruption:
+            case "truncated-idat":
+                return report.truncated
+            case "none" | "excess-data":
+                return (
+                    report.decompressed_size == report.expected_size
+                    and report.bad_scanline is None
+                )
+            case _:
+                return True
+
+    def solve():
+        # without the IDAT data to narrow it down, this times the CRC solver itself
+        if case.corruption != "zeroed-dimensions":
+            return True
+        width, height = struct.unpack(">II", original[16:24])
+        return (width, height) in png_fix.solve_ihdr_dimensions(state["chunks"][0])
+
+    def repair():
+        chunks = state["chunks"]
+        match case.corruption:
+            case "zeroed-dimensions":
+                ihdr = png_fix.bruteforce_ihdr_dimensions(
+                    chunks[0], idat_data=png_fix.read_idat(chunks)
+                )
+                chunks[0] = ihdr
+                return bytes(ihdr.data[:8]) == original[16:24]
+            case "bad-crc":
+                index = next(i for i, c in enumerate(chunks) if c.type == b"IDAT")
+                chunks[index] = png_fix.repair_chunk(
+                    chunks[index], png_fix.find_bitflip_repairs
+                )
+                return chunks[index].crc_valid()
+            case _:
+                return True
+
+    def decode():
+        meta = PngMetadata.from_bytes(state["chunks"][0].data)
+        image = png_fix.decode_image(
+            meta.width,
+            meta.height,
+            meta.bit_depth,
+            meta.color_type,
+            meta.interlace_method,
+            png_fix.read_idat(state["chunks"]),
+        )
+        if case.corruption == "truncated-idat":
+            return True
+        return np.array_equal(image, samples)
+
+    def save():
+        with open(path + ".out", "wb") as f:
+            png_fix.save_png(f, state["header"], state["chunks"])
+        if case.corruption in ("none", "zeroed-dimensions", "bad-crc"):
+            with open(path + ".out", "rb") as f:
+                return f.read() == original
+        return True
+
+    return [
+        ("parse", parse),
+        ("crc", check_crc),
+        ("validate", validate),
+        ("solve", solve),
+        ("repair", repair),
+        ("decode", decode),
+        ("save", save),
+    ]
+
+
+def run_case(case: Case, workdir: str, repeat: int, seed: int) -> list[StageResult]:
+    rng = np.random.default_rng(seed)
+    original, samples = encode_png(case, rng)
+    corrupted = corrupt(original, case.corruption, rng)
+    path = os.path.join(workdir, case.name + ".png")
+    with open(path, "wb") as f:
+        f.write(corrupted)
+
+    megabytes = len(corrupted) / 1e6
+    best = {}
+    ok = {}
+    for _ in range(repeat):
+        for stage, fn in run_stages(case, path, original, samples):
+            start = time.perf_counter()
+            ok[stage] = bool(fn())
+            elapsed = time.perf_counter() - start
+            best[stage] = min(best.get(stage, elapsed), elapsed)
+
+    # measure memory on a separate run, tracing slows everything down
+    peaks = {}
+    tracemalloc.start()
+    for stage, fn in run_stages(case, path, original, samples):
+        tracemalloc.reset_peak()
+        fn()
+        peaks[stage] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return [
+        StageResult(
+            case=case.name,
+            stage=stage,
+            seconds=best[stage],
+            mb_per_second=megabytes / best[stage] if best[stage] else float("inf"),
+            peak_bytes=peaks[stage],
+            ok=ok[stage],
+        )
+        for stage in best
+    ]
+
+
+def compare(
+    results: list[StageResult], baseline: list[dict], tolerance: float
+) -> list[str]:
+    previous = {(r["case"], r["stage"]): r for r in baseline}
+    regressions = []
+    for result in results:
+        if (before := previous.get((result.case, result.stage))) is None:
+            continue
+
+        if before["ok"] and not result.ok:
+            regressions.append(f"{result.case} {result.stage}: no longer succeeds")
+
+        slower = result.seconds - before["seconds"]
+        if slower > NOISE_FLOOR and result.seconds > before["seconds"] * (
+            1 + tolerance
+        ):
+            regressions.append(
+                f"{result.case} {result.stage}: {before['seconds']:.4f}s -> {result.seconds:.4f}s"
+            )
+
+    return regressions
+
+
+def argument_parser() -> ArgumentParser:
+    parser = ArgumentParser(
+        description="Benchmark png_fix against synthetic PNGs with controlled corruptions."
+    )
+
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        default=[f"{w}x{h}" for w, h in SIZES],
+        help="Image sizes to generate, as WIDTHxHEIGHT",
+    )
+    parser.add_argument(
+        "--corruptions", nargs="+", choices=CORRUPTIONS, default=CORRUPTIONS
+    )
+    parser.add_argument(
+        "--filters",
+        nargs="+",
+        choices=FILTERS,
+        default=FILTERS,
+        help="How to filter the scanlines. Average and Paeth are only run uncorrupted.",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Take the best time of this many runs."
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", required=False, help="Save the results as JSON.")
+    parser.add_argument(
+        "--baseline",
+        required=False,
+        help="Compare against results previously saved with --output.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Fraction slower than the baseline a stage may be before it is a regression.",
+    )
+
+    return parser
+
+
+def main():
+    args = argument_parser().parse_args()
+
+    # the corruptions are deliberate, so don't drown the results in warnings
+    png_fix.LOGGER.setLevel(logging.CRITICAL)
+
+    sizes = [tuple(map(int, size.split("x"))) for size in args.sizes]
+    cases = [
+        Case(
+            width, height, bit_depth, color_type, interlace_method, corruption, filters
+        )
+        for width, height in sizes
+        for bit_depth, color_type in PIXEL_FORMATS
+        for interlace_method in InterlaceMethod
+        for filters in args.filters
+        for corruption in args.corruptions
+        # the corruptions don't depend on the filters, so only time them once
+        if filters == "mixed" or corruption == "none"
+    ]
+
+    results = []
+    print(f"{'case':<48} {'stage':<9} {'seconds':>9} {'MB/s':>9} {'peak KiB':>9} ok")
+    with tempfile.TemporaryDirectory() as workdir:
+        for case in cases:
+            for result in run_case(case, workdir, args.repeat, args.seed):
+                results.append(result)
+                print(
+                    f"{result.case:<48} {result.stage:<9} {result.seconds:>9.4f} "
+                    f"{result.mb_per_second:>9.1f} {result.peak_bytes / 1024:>9.0f} "
+                    f"{'yes' if result.ok else 'NO'}"
+                )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump([asdict(result) for result in results], f, indent=1)
+
+    failures = [r for r in results if not r.ok]
+    for failure in failures:
+        print(f"FAILED: {failure.case} {failure.stage}", file=sys.stderr)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+
+    if failures or regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 import logging
 
 TRACE = 5
+logging.addLevelName(TRACE, "TRACE")
 
 class CustomFormatter(logging.Formatter):
 
@@ -20,7 +21,14 @@ class CustomFormatter(logging.Formatter):
         logging.CRITICAL: bold_red + format + reset
     }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # build the formatters once rather than on every record
+        self.formatters = {
+            level: logging.Formatter(fmt) for level, fmt in self.FORMATS.items()
+        }
+        self.default_formatter = logging.Formatter(self.FORMATS[logging.INFO])
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
+        formatter = self.formatters.get(record.levelno, self.default_formatter)
         return formatter.format(record)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+import logging
+import os
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from custom_formatter import CustomFormatter, TRACE
+
+import instrumentation
+import usb_pcap
+from hid_keymaps import LAYOUTS, compile_layout
+from keystrokes_from_pcap import decode_keystrokes, load_reports
+from mouse_move_from_pcap import decode_reports, draw
+
+LOGGER = logging.getLogger(__name__)
+
+
+def decode_stream(
+    kind: str, name: str, reports: list[bytes], output_dir: str, layout: str
+) -> str:
+    """Decode the reports of one device, returning the file the result was saved to."""
+    if kind == "keyboard":
+        path = os.path.join(output_dir, f"{name}-keyboard.txt")
+        keymap = compile_layout(LAYOUTS[layout])
+        with open(path, "w") as f:
+            f.write(decode_keystrokes(load_reports(reports), keymap) + "\n")
+    else:
+        path = os.path.join(output_dir, f"{name}-mouse.png")
+        draw(decode_reports(reports)).save(path)
+
+    return path
+
+
+def argument_parser() -> ArgumentParser:
+    parser = ArgumentParser(
+        description="Split a USB capture by device and decode every keyboard and mouse in it."
+    )
+
+    parser.add_argument(
+        "capture",
+        help="A usbmon / USBPcap pcap or pcapng file, or a Wireshark CSV export with a HID Data column",
+    )
+    parser.add_argument(
+        "--output-dir", default="hid", help="Where to write the output for each device."
+    )
+    parser.add_argument(
+        "--layout", choices=list(LAYOUTS), default="uk", help="The keyboard layout"
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of devices to decode at once.",
+    )
+    parser.add_argument("--log-level", default="WARN", help="Set the log level")
+
+    return parser
+
+
+def main():
+    args = argument_parser().parse_args()
+    level: int | str = (
+        TRACE if args.log_level.upper() == "TRACE" else args.log_level.upper()
+    )
+
+    LOGGER.setLevel(level)
+    ch = logging.StreamHandler()
+    ch.setLevel(level)
+    ch.setFormatter(CustomFormatter())
+    LOGGER.addHandler(ch)
+
+    with instrumentation.stage("read"):
+        streams = usb_pcap.group_streams(usb_pcap.read_reports(args.capture))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    with instrumentation.stage("decode"), ProcessPoolExecutor(args.jobs) as executor:
+        futures = []
+        for key, packets in streams.items():
+            name = usb_pcap.stream_name(key)
+            kind = usb_pcap.classify_stream(packets)
+            LOGGER.info("%s: %d %s reports", name, len(packets), kind)
+            if kind == "other":
+                continue
+
+            # the packets are views of the capture, which can't be sent to the workers
+            reports = [bytes(packet.data) for packet in packets]
+            future = executor.submit(
+                decode_stream, kind, name, reports, args.output_dir, args.layout
+            )
+            futures.append((name, kind, len(packets), future))
+
+        for name, kind, count, future in futures:
+            try:
+                path = future.result()
+            except Exception as e:
+                LOGGER.error("Failed to decode %s as a %s: %r", name, kind, e)
+                continue
+            print(f"{name}\t{kind}\t{count}\t{path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+import enum
+
+from dataclasses import dataclass, field
+
+import numpy as np
+
+# scancodes of the keys which type something different on each layout, in order:
+# letters, the digit row, the punctuation keys and the extra ISO key next to left shift
+PRINTABLE_SCANCODES = [*range(0x04, 0x28), *range(0x2D, 0x39), 0x64]
+# marks a key which types nothing in a layout's shift plane
+NO_CHARACTER = "\0"
+
+CAPSLOCK_SCANCODE = 0x39
+NUMLOCK_SCANCODE = 0x53
+
+# modifier bits:
+# [MSB] right gui, right alt, right shift, right ctrl, left gui, left alt, left shift, left ctrl [LSB]
+MODIFIER_SHIFT = 0b0010_0010
+MODIFIER_ALTGR = 0b0100_0000
+MODIFIER_CTRL = 0b0001_0001
+MODIFIER_ALT = 0b0000_0100
+MODIFIER_GUI = 0b1000_1000
+
+
+class EditAction(enum.IntEnum):
+    Text = 0
+    Ignore = 1
+    Backspace = 2
+    Delete = 3
+    Left = 4
+    Right = 5
+    Up = 6
+    Down = 7
+    Home = 8
+    End = 9
+    CapsLock = 10
+    NumLock = 11
+
+
+@dataclass
+class Layout:
+    name: str
+    # what each of PRINTABLE_SCANCODES types, unshifted and shifted
+    normal: str
+    shift: str
+    # scancode -> character typed with AltGr
+    altgr: dict[int, str] = field(default_factory=dict)
+
+
+LAYOUTS = {
+    layout.name: layout
+    for layout in [
+        Layout(
+            "us",
+            "abcdefghijklmnopqrstuvwxyz1234567890-=[]\\\\;'`,./\\",
+            'ABCDEFGHIJKLMNOPQRSTUVWXYZ!@#$%^&*()_+{}||:"~<>?|',
+        ),
+        Layout(
+            "uk",
+            "abcdefghijklmnopqrstuvwxyz1234567890-=[]\\#;'`,./\\",
+            'ABCDEFGHIJKLMNOPQRSTUVWXYZ!"£$%^&*()_+{}|~:@¬<>?|',
+            {0x21: "€", 0x35: "¦"},
+        ),
+        Layout(
+            "de",
+            "abcdefghijklmnopqrstuvwxzy1234567890ß´ü+##öä^,.-<",
+            "ABCDEFGHIJKLMNOPQRSTUVWXZY!\"§$%&/()=?`Ü*''ÖÄ°;:_>",
+            {
+                0x14: "@",
+                0x08: "€",
+                0x10: "µ",
+                0x1F: "²",
+                0x20: "³",
+                0x24: "{",
+                0x25: "[",
+                0x26: "]",
+                0x27: "}",
+                0x2D: "\\",
+                0x30: "~",
+                0x64: "|",
+            },
+        ),
+        Layout(
+            "fr",
+            "qbcdefghijkl,noparstuvzxyw&é\"'(-è_çà)=^$**mù²;:!<",
+            "QBCDEFGHIJKL?NOPARSTUVZXYW1234567890°+¨£µµM%\0./§>",
+            {
+                0x08: "€",
+                0x1F: "~",
+                0x20: "#",
+                0x21: "{",
+                0x22: "[",
+                0x23: "|",
+                0x24: "`",
+                0x25: "\\",
+                0x26: "^",
+                0x27: "@",
+                0x2D: "]",
+                0x2E: "}",
+                0x30: "¤",
+            },
+        ),
+    ]
+}
+
+# keys which type the same thing on every layout
+COMMON_TEXT = {0x28: "\n", 0x2B: "\t", 0x2C: " "}
+
+COMMON_ACTIONS = {
+    0x2A: EditAction.Backspace,
+    0x4A: EditAction.Home,
+    0x4C: EditAction.Delete,
+    0x4D: EditAction.End,
+    0x4F: EditAction.Right,
+    0x50: EditAction.Left,
+    0x51: EditAction.Down,
+    0x52: EditAction.Up,
+    CAPSLOCK_SCANCODE: EditAction.CapsLock,
+    NUMLOCK_SCANCODE: EditAction.NumLock,
+}
+
+# names of the keys which don't type anything, for the raw output
+KEY_NAMES = {
+    0x29: "ESC",
+    0x2A: "BACKSPACE",
+    **{0x3A + i: f"F{i + 1}" for i in range(12)},
+    0x46: "PRINTSCREEN",
+    0x47: "SCROLLLOCK",
+    0x48: "PAUSE",
+    0x49: "INSERT",
+    0x4A: "HOME",
+    0x4B: "PAGEUP",
+    0x4C: "DELETE",
+    0x4D: "END",
+    0x4E: "PAGEDOWN",
+    0x4F: "RIGHT",
+    0x50: "LEFT",
+    0x51: "DOWN",
+    0x52: "UP",
+    0x65: "MENU",
+    **{0x68 + i: f"F{i + 13}" for i in range(12)},
+}
+
+# the keypad with num lock on, and the keys it doubles as with num lock off
+KEYPAD_TEXT = {
+    0x54: "/",
+    0x55: "*",
+    0x56: "-",
+    0x57: "+",
+    0x58: "\n",
+    **{0x59 + i: str(i + 1) for i in range(9)},
+    0x62: "0",
+    0x63: ".",
+    0x67: "=",
+}
+KEYPAD_NAVIGATION = {
+    0x59: 0x4D,
+    0x5A: 0x51,
+    0x5B: 0x4E,
+    0x5C: 0x50,
+    0x5E: 0x4F,
+    0x5F: 0x4A,
+    0x60: 0x52,
+    0x61: 0x4B,
+    0x62: 0x49,
+    0x63: 0x4C,
+}
+
+
+@dataclass
+class Keymap:
+    """A layout compiled into dense tables indexed by scancode."""
+
+    # (shift + 2 * altgr, scancode) -> text typed, or the key's name if it types nothing
+    text: np.ndarray
+    # which keys caps lock acts as shift for, i.e. letters
+    caps: np.ndarray
+    action: np.ndarray
+    # the keypad with num lock off, as the scancode of the key it acts as
+    keypad: np.ndarray
+    known: np.ndarray
+
+    def translate(
+        self,
+        scancodes: np.ndarray,
+        modifiers: np.ndarray,
+        caps: np.ndarray,
+        numlock: np.ndarray,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """The text and EditAction of each key press, given the lock states when it was pressed."""
+        scancodes = scancodes.astype(np.intp)
+        # the keypad acts as the navigation keys with num lock off
+        scancodes = np.where(numlock, scancodes, self.keypad[scancodes])
+
+        altgr = (modifiers & MODIFIER_ALTGR != 0) | (
+            (modifiers & MODIFIER_CTRL != 0) & (modifiers & MODIFIER_ALT != 0)
+        )
+        shift = (modifiers & MODIFIER_SHIFT != 0) ^ (caps & self.caps[scancodes])
+        text = self.text[shift.astype(np.intp) + 2 * altgr, scancodes]
+
+        action = self.action[scancodes].copy()
+        # shortcuts don't type anything
+        shortcut = ~altgr & (
+            modifiers & (MODIFIER_CTRL | MODIFIER_ALT | MODIFIER_GUI) != 0
+        )
+        action[shortcut & (action == EditAction.Text)] = EditAction.Ignore
+
+        return text, action
+
+
+def compile_layout(layout: Layout) -> Keymap:
+    if not len(layout.normal) == len(layout.shift) == len(PRINTABLE_SCANCODES):
+        raise ValueError(f"Layout {layout.name} doesn't cover every printable key")
+
+    text = np.full((4, 256), "", dtype=object)
+    action = np.full(256, EditAction.Ignore, dtype=np.uint8)
+    known = np.zeros(256, dtype=bool)
+
+    for scancode, normal, shift in zip(
+        PRINTABLE_SCANCODES, layout.normal, layout.shift
+    ):
+        text[0, scancode] = normal
+        text[1, scancode] = shift if shift != NO_CHARACTER else ""
+    for scancode, character in layout.altgr.items():
+        text[2:, scancode] = character
+    for scancode, character in (COMMON_TEXT | KEYPAD_TEXT).items():
+        text[:, scancode] = character
+
+    for scancode in [*PRINTABLE_SCANCODES, *COMMON_TEXT, *KEYPAD_TEXT]:
+        action[scancode] = EditAction.Text
+        known[scancode] = True
+    for scancode, key_action in COMMON_ACTIONS.items():
+        action[scancode] = key_action
+    known[list(KEY_NAMES)] = True
+    known[list(COMMON_ACTIONS)] = True
+    # modifiers reported as keys, and what's reported when too many keys are held
+    known[0xE0:0xE8] = True
+    known[0x01] = True
+
+    caps = np.zeros(256, dtype=bool)
+    for scancode, normal, shift in zip(
+        PRINTABLE_SCANCODES, layout.normal, layout.shift
+    ):
+        caps[scancode] = normal.isalpha() and shift == normal.upper()
+
+    keypad = np.arange(256)
+    for scancode, navigation in KEYPAD_NAVIGATION.items():
+        keypad[scancode] = navigation
+    # 5 on the keypad does nothing with num lock off
+    keypad[0x5D] = 0
+
+    for scancode, name in KEY_NAMES.items():
+        text[:, scancode] = f"[{name}]"
+
+    return Keymap(text, caps, action, keypad, known)
+
+
+class EditBuffer:
+    """Text with a cursor, so editing keys change the text like they would in an editor."""
+
+    def __init__(self):
+        self.before: list[str] = []
+        # the text after the cursor, reversed so moving the cursor is a pop and append
+        self.after: list[str] = []
+
+    def insert(self, text: str):
+        self.before.extend(text)
+
+    def backspace(self):
+        if self.before:
+            self.before.pop()
+
+    def delete(self):
+        if self.after:
+            self.after.pop()
+
+    def left(self) -> bool:
+        if self.before:
+            self.after.append(self.before.pop())
+            return True
+        return False
+
+    def right(self) -> bool:
+        if self.after:
+            self.before.append(self.after.pop())
+            return True
+        return False
+
+    def home(self):
+        while self.before and self.before[-1] != "\n":
+            self.left()
+
+    def end(self):
+        while self.after and self.after[-1] != "\n":
+            self.right()
+
+    def column(self) -> int:
+        column = 0
+        while column < len(self.before) and self.before[-1 - column] != "\n":
+            column += 1
+        return column
+
+    def _to_column(self, column: int):
+        while column and self.after and self.after[-1] != "\n":
+            self.right()
+            column -= 1
+
+    def up(self):
+        column = self.column()
+        self.home()
+        if self.left():
+            self.home()
+            self._to_column(column)
+
+    def down(self):
+        column = self.column()
+        self.end()
+        if self.right():
+            self._to_column(column)
+
+    def apply(self, text: str, action: EditAction):
+        match action:
+            case EditAction.Text:
+                self.insert(text)
+            case EditAction.Backspace:
+                self.backspace()
+            case EditAction.Delete:
+                self.delete()
+            case EditAction.Left:
+                self.left()
+            case EditAction.Right:
+                self.right()
+            case EditAction.Up:
+                self.up()
+            case EditAction.Down:
+                self.down()
+            case EditAction.Home:
+                self.home()
+            case EditAction.End:
+                self.end()
+
+    def __str__(self) -> str:
+        return "".join(self.before) + "".join(reversed(self.after))
@@ -0,0 +1,119 @@
+import atexit
+import json
+import os
+import sys
+import time
+
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field, asdict
+
+# set to "text" (or anything else) or "json" to report stats on exit
+STATS_ENV = "STATS"
+# where to write the report, stderr by default
+STATS_FILE_ENV = "STATS_FILE"
+
+
+@dataclass
+class StageStats:
+    calls: int = 0
+    seconds: float = 0.0
+    counters: dict[str, int] = field(default_factory=dict)
+
+
+class Stats:
+    """Per-stage timers and counters, which cost a single check while disabled.
+
+    Counters are attributed to the innermost running stage, so their rates are
+    relative to the time spent in that stage.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.format = "text"
+        self.output: str | None = None
+        self.stages: dict[str, StageStats] = {}
+        self._running: list[str] = []
+        self._start = time.perf_counter()
+
+    def enable(self, format: str = "text", output: str | None = None):
+        if not self.enabled:
+            atexit.register(self.report)
+        self.enabled = True
+        self.format = format
+        self.output = output
+
+    def stage(self, name: str):
+        if not self.enabled:
+            return nullcontext()
+        return self._stage(name)
+
+    @contextmanager
+    def _stage(self, name: str):
+        stats = self.stages.setdefault(name, StageStats())
+        self._running.append(name)
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            stats.seconds += time.perf_counter() - start
+            stats.calls += 1
+            self._running.pop()
+
+    def count(self, name: str, n: int = 1):
+        if not self.enabled:
+            return
+        stage = self._running[-1] if self._running else "total"
+        counters = self.stages.setdefault(stage, StageStats()).counters
+        counters[name] = counters.get(name, 0) + n
+
+    def as_dict(self) -> dict:
+        total = time.perf_counter() - self._start
+        stages = {}
+        for name, stats in self.stages.items():
+            seconds = total if name == "total" else stats.seconds
+            stages[name] = asdict(stats) | {
+                "rates": {
+                    counter: value / seconds
+                    for counter, value in stats.counters.items()
+                    if seconds
+                }
+            }
+        return {"seconds": total, "stages": stages}
+
+    def format_text(self) -> str:
+        stats = self.as_dict()
+        lines = [f"total: {stats['seconds']:.4f}s"]
+        for name, stage in stats["stages"].items():
+            if name != "total":
+                lines.append(
+                    f"{name}: {stage['seconds']:.4f}s over {stage['calls']} calls"
+                )
+            for counter, value in stage["counters"].items():
+                rate = stage["rates"].get(counter)
+                lines.append(
+                    f"  {counter}: {value}"
+                    + (f" ({rate:.1f}/s)" if rate is not None else "")
+                )
+        return "\n".join(lines) + "\n"
+
+    def report(self):
+        if self.format == "json":
+            text = json.dumps(self.as_dict()) + "\n"
+        else:
+            text = self.format_text()
+
+        if self.output is None or self.output == "-":
+            sys.stderr.write(text)
+        else:
+            with open(self.output, "w") as f:
+                f.write(text)
+
+
+STATS = Stats()
+stage = STATS.stage
+count = STATS.count
+
+if (_format := os.getenv(STATS_ENV)) is not None:
+    STATS.enable(
+        "json" if _format.lower() == "json" else "text", os.getenv(STATS_FILE_ENV)
+    )
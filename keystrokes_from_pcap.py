@@ -1,111 +1,262 @@
 #!/usr/bin/env python
 import numpy as np
-import pandas as pd
-import struct
 import sys
-from collections import defaultdict
+from argparse import ArgumentParser
+
+import instrumentation
+import usb_pcap
+from hid_keymaps import (
+    CAPSLOCK_SCANCODE,
+    LAYOUTS,
+    MODIFIER_ALT,
+    MODIFIER_CTRL,
+    MODIFIER_GUI,
+    NUMLOCK_SCANCODE,
+    EditAction,
+    EditBuffer,
+    Keymap,
+    compile_layout,
+)
+
 
 def warn(msg):
     yellow = "\x1b[0;33m"
     white = "\x1b[0;37m"
     print(f"{yellow}[warn] {msg}{white}", file=sys.stderr)
 
-CAPSLOCK_SCANCODE = 0x39
-CAPSLOCK_SENTINEL = "[CAPSLOCK]"
 
-def main():
-    if len(sys.argv) != 2:
-        print(f"Usage: {sys.argv[0]} <wireshark csv file>")
-        sys.exit(0)
-
-    df = pd.read_csv(sys.argv[1], index_col=0)
-
-    capdata = df["HID Data"].dropna().reset_index(drop=True)
-
-    data = ""
-    prev_pressed = [0] * 6
-    caps = False
-    for i, hid_data in enumerate(capdata):
-        modifiers, _pad, *pressed = bytes.fromhex(hid_data)
-        # modifier bits: 
-        # [MSB] right gui, right alt, right shift, right ctrl, left gui, left alt, left shift, left ctrl [LSB]
-        shift = modifiers & 0b0010_0010 != 0
-        upper = caps ^ shift
+def argument_parser():
+    parser = ArgumentParser(
+        description="Recover keystrokes from a USB keyboard capture."
+    )
+    parser.add_argument(
+        "capture",
+        help="A usbmon / USBPcap pcap or pcapng file, or a Wireshark CSV export with a HID Data column. - reads a capture from stdin, e.g. from tcpdump -w -",
+    )
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="Print keystrokes as they are captured, waiting for the capture to grow like tail -f",
+    )
+    parser.add_argument(
+        "--layout", choices=list(LAYOUTS), default="uk", help="The keyboard layout"
+    )
+    parser.add_argument(
+        "--numlock-off",
+        action="store_true",
+        help="Num lock was off at the start of the capture, so the keypad starts as arrow keys",
+    )
+    parser.add_argument(
+        "--raw",
+        action="store_true",
+        help="Print editing keys as [BACKSPACE], [LEFT], ... instead of applying them, and shortcuts as [CTRL+c]",
+    )
+    return parser
+
+
+# bytes in a boot protocol keyboard report: modifiers, padding and six scancodes
+REPORT_SIZE = 8
+
+
+def load_reports(reports) -> np.ndarray:
+    """Stack HID reports into an (N, 8) array, padding or truncating odd sized ones."""
+    reports = list(reports)
+    if all(len(report) == REPORT_SIZE for report in reports):
+        data = np.frombuffer(b"".join(reports), dtype=np.uint8)
+        return data.reshape(-1, REPORT_SIZE)
+
+    array = np.zeros((len(reports), REPORT_SIZE), dtype=np.uint8)
+    for i, report in enumerate(reports):
+        report = bytes(report[:REPORT_SIZE])
+        array[i, : len(report)] = np.frombuffer(report, dtype=np.uint8)
+    return array
+
+
+def _lock_state(rows: np.ndarray, pressed: np.ndarray, reports: int, initial: bool):
+    """Whether a lock key was on for each report, it applies from the report after it is pressed."""
+    toggles = np.bincount(rows[pressed], minlength=reports)
+    return (np.cumsum(toggles) - toggles + initial) % 2 == 1
+
+
+SHORTCUT_MODIFIERS = {"CTRL": MODIFIER_CTRL, "ALT": MODIFIER_ALT, "GUI": MODIFIER_GUI}
+
+
+def _raw_text(
+    keymap: Keymap,
+    scancodes: np.ndarray,
+    modifiers: np.ndarray,
+    text: np.ndarray,
+    action: np.ndarray,
+) -> str:
+    """What each key press shows as with --raw, with shortcuts named like [CTRL+c]."""
+    text = text.copy()
+    shortcut = (
+        (action == EditAction.Ignore)
+        & (keymap.action[scancodes] == EditAction.Text)
+        & (text != "")
+    )
+    for i in np.flatnonzero(shortcut).tolist():
+        held = [
+            name for name, mask in SHORTCUT_MODIFIERS.items() if modifiers[i] & mask
+        ]
+        text[i] = f"[{'+'.join(held)}+{text[i]}]"
+    return "".join(text)
+
+
+def decode_keystrokes(
+    reports: np.ndarray,
+    keymap: Keymap | None = None,
+    numlock: bool = True,
+    raw: bool = False,
+) -> str:
+    if keymap is None:
+        keymap = compile_layout(LAYOUTS["uk"])
+
+    modifiers = reports[:, 0]
+    pressed = reports[:, 2:]
+
+    # keys are left packed so everything after the first zero is ignored
+    held = np.logical_and.accumulate(pressed != 0, axis=1)
+    rows, columns = np.nonzero(held)
+    scancodes = pressed[rows, columns]
+
+    # and only keys which weren't held in the previous report are new presses
+    prev_pressed = np.zeros_like(pressed)
+    prev_pressed[1:] = pressed[:-1]
+    new = ~(prev_pressed[rows] == scancodes[:, None]).any(axis=1)
+    rows, scancodes = rows[new], scancodes[new]
+
+    known = keymap.known[scancodes]
+    for i, k in zip(rows[~known], scancodes[~known]):
+        warn(f"unrecognised scancode: k=0x{k:02x} @ {i}")
+
+    caps = _lock_state(rows, scancodes == CAPSLOCK_SCANCODE, len(reports), False)
+    numlock = _lock_state(rows, scancodes == NUMLOCK_SCANCODE, len(reports), numlock)
+    text, action = keymap.translate(
+        scancodes, modifiers[rows], caps[rows], numlock[rows]
+    )
+
+    if raw:
+        return _raw_text(keymap, scancodes, modifiers[rows], text, action)
+
+    editing = (action >= EditAction.Backspace) & (action <= EditAction.End)
+    if not editing.any():
+        # nothing to edit, so skip the edit buffer
+        return "".join(text[action == EditAction.Text])
+
+    # insert the text typed between each edit in one go
+    typed = np.where(action == EditAction.Text, text, "").tolist()
+    actions = action.tolist()
+    buffer = EditBuffer()
+    start = 0
+    for i in np.flatnonzero(editing).tolist():
+        buffer.insert("".join(typed[start:i]))
+        buffer.apply("", actions[i])
+        start = i + 1
+    buffer.insert("".join(typed[start:]))
+    return str(buffer)
+
+
+class KeystrokeDecoder:
+    """Decodes a report at a time like decode_keystrokes, for following a capture.
+
+    Editing keys can't change what has already been printed, so they are shown like
+    with --raw.
+    """
+
+    def __init__(self, keymap: Keymap, numlock: bool = True):
+        self.keymap = keymap
+        self.prev_pressed = [0] * 6
+        self.caps = False
+        self.numlock = numlock
+
+    def feed(self, report) -> str:
+        modifiers, _pad, *pressed = bytes(report[:REPORT_SIZE])
+        new = []
         for k in pressed:
             # keys are left packed so if we see a zero we are at the end
             if k == 0:
                 break
+            if k not in self.prev_pressed:
+                new.append(k)
+        self.prev_pressed = pressed
 
-            if k in prev_pressed:
-                continue
+        for k in new:
+            if not self.keymap.known[k]:
+                warn(f"unrecognised scancode: k=0x{k:02x}")
+
+        scancodes = np.array(new, dtype=np.uint8)
+        held = np.full(len(new), modifiers)
+        text, action = self.keymap.translate(
+            scancodes,
+            held,
+            np.full(len(new), self.caps),
+            np.full(len(new), self.numlock),
+        )
+        # lock keys apply from the next report
+        self.caps ^= new.count(CAPSLOCK_SCANCODE) % 2 == 1
+        self.numlock ^= new.count(NUMLOCK_SCANCODE) % 2 == 1
+        return _raw_text(self.keymap, scancodes, held, text, action)
 
-            if (key := keymap.get((upper, k))) is None:
-                warn(f"unrecognised scancode: k=0x{k:02x} @ {i}")
+
+def follow(args, keymap: Keymap):
+    """Print keystrokes as they are captured, in constant memory."""
+    classifier = usb_pcap.StreamClassifier()
+    decoders: dict[tuple[int, int, int], KeystrokeDecoder] = {}
+    last_key = None
+
+    input_file = sys.stdin.buffer if args.capture == "-" else open(args.capture, "rb")
+    with input_file:
+        for packet in usb_pcap.stream_hid_reports(input_file, args.follow):
+            if classifier.classify(packet) != "keyboard":
                 continue
 
-            if key == CAPSLOCK_SENTINEL:
-                caps = not caps
+            key = (packet.bus, packet.device, packet.endpoint)
+            if key not in decoders:
+                decoders[key] = KeystrokeDecoder(keymap, not args.numlock_off)
+            if not (text := decoders[key].feed(packet.data)):
                 continue
 
-            data += key
-        prev_pressed = pressed
-
-    print(data)
-
-# These are from USB HID usage tables
-# https://source.android.com/docs/core/interaction/input/keyboard-devices
-keymap = {
-    (False, 0x04): "a", (True, 0x04): "A",
-    (False, 0x05): "b", (True, 0x05): "B",
-    (False, 0x06): "c", (True, 0x06): "C",
-    (False, 0x07): "d", (True, 0x07): "D",
-    (False, 0x08): "e", (True, 0x08): "E",
-    (False, 0x09): "f", (True, 0x09): "F",
-    (False, 0x0A): "g", (True, 0x0A): "G",
-    (False, 0x0B): "h", (True, 0x0B): "H",
-    (False, 0x0C): "i", (True, 0x0C): "I",
-    (False, 0x0D): "j", (True, 0x0D): "J",
-    (False, 0x0E): "k", (True, 0x0E): "K",
-    (False, 0x0F): "l", (True, 0x0F): "L",
-    (False, 0x10): "m", (True, 0x10): "M",
-    (False, 0x11): "n", (True, 0x11): "N",
-    (False, 0x12): "o", (True, 0x12): "O",
-    (False, 0x13): "p", (True, 0x13): "P",
-    (False, 0x14): "q", (True, 0x14): "Q",
-    (False, 0x15): "r", (True, 0x15): "R",
-    (False, 0x16): "s", (True, 0x16): "S",
-    (False, 0x17): "t", (True, 0x17): "T",
-    (False, 0x18): "u", (True, 0x18): "U",
-    (False, 0x19): "v", (True, 0x19): "V",
-    (False, 0x1A): "w", (True, 0x1A): "W",
-    (False, 0x1B): "x", (True, 0x1B): "X",
-    (False, 0x1C): "y", (True, 0x1C): "Y",
-    (False, 0x1D): "z", (True, 0x1D): "Z",
-    (False, 0x1E): "1", (True, 0x1E): "!",
-    (False, 0x1F): "2", (True, 0x1F): '"',
-    (False, 0x20): "3", (True, 0x20): "£",
-    (False, 0x21): "4", (True, 0x21): "$",
-    (False, 0x22): "5", (True, 0x22): "%",
-    (False, 0x23): "6", (True, 0x23): "^",
-    (False, 0x24): "7", (True, 0x24): "&",
-    (False, 0x25): "8", (True, 0x25): "*",
-    (False, 0x26): "9", (True, 0x26): "(",
-    (False, 0x27): "0", (True, 0x27): ")",
-    (False, 0x28): "\n",(True, 0x28): "\n",
-    (False, 0x2A): "[DEL]",(True, 0x2A): "[DEL]",
-    (False, 0x2C): " ", (True, 0x2C): " ",
-    (False, 0x2D): "-", (True, 0x2D): "_",
-    (False, 0x2F): "[", (True, 0x2F): "{",
-    (False, 0x30): "]", (True, 0x30): "}",
-    (False, 0x31): "\\",(True, 0x31): "|",
-    (False, 0x32): "#", (True, 0x32): "~",
-    (False, 0x33): ";", (True, 0x33): ":",
-    (False, 0x34): "'", (True, 0x34): "@",
-    (False, 0x36): ",", (True, 0x36): "<",
-    (False, 0x37): ".", (True, 0x37): ">",
-    (False, 0x38): "/", (True, 0x38): "?",
-    (False, CAPSLOCK_SCANCODE): CAPSLOCK_SENTINEL, (True, CAPSLOCK_SCANCODE): CAPSLOCK_SENTINEL,
-}
+            # only label the output once there is more than one keyboard
+            if len(decoders) > 1 and key != last_key:
+                print(f"\n[{usb_pcap.stream_name(key)}]")
+            last_key = key
+            print(text, end="", flush=True)
+    print()
+
+
+def main():
+    args = argument_parser().parse_args()
+    keymap = compile_layout(LAYOUTS[args.layout])
+
+    if args.follow or args.capture == "-":
+        try:
+            follow(args, keymap)
+        except KeyboardInterrupt:
+            print()
+        return
+
+    with instrumentation.stage("read"):
+        streams = usb_pcap.group_streams(usb_pcap.read_reports(args.capture))
+
+    keyboards = {
+        key: packets
+        for key, packets in streams.items()
+        if usb_pcap.classify_stream(packets) == "keyboard"
+    }
+    if not keyboards:
+        warn("no device looks like a keyboard, decoding them all")
+        keyboards = streams
+
+    for key, packets in keyboards.items():
+        with instrumentation.stage("decode"):
+            reports = load_reports(packet.data for packet in packets)
+            data = decode_keystrokes(reports, keymap, not args.numlock_off, args.raw)
+            instrumentation.count("reports", len(reports))
+
+        if len(keyboards) > 1:
+            print(f"[{usb_pcap.stream_name(key)}]")
+        print(data)
 
 
 if __name__ == "__main__":
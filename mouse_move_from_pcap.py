@@ -1,103 +1,866 @@
 #!/usr/bin/env python
-import pandas as pd
-import struct
+import logging
 import sys
-from collections import namedtuple
-from PIL import Image, ImageDraw
+from argparse import ArgumentParser
+from collections import deque, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import cached_property
+from itertools import repeat
+from typing import Iterator
+from PIL import Image
+import numpy as np
 import os
 
+import instrumentation
+import usb_pcap
+from custom_formatter import CustomFormatter, TRACE
+
+LOGGER = logging.getLogger(__name__)
+
 DIFFERENTIATE_BUTTONS = os.getenv("DIFFERENTIATE_BUTTONS") is not None
 DRAW_WIDTH = int(os.getenv("DRAW_WIDTH", "0"))
 
-MouseHIDData = namedtuple(
-    "MouseHIDData",
-    ["x_off", "y_off", "wheel", "pan", "left_click", "right_click", "middle_click"],
-)
-
 MousePosition = namedtuple(
     "MousePosition",
     ["x", "y", "left_click", "right_click", "middle_click"],
 )
 
+# the decoded reports, only the first 8 buttons are kept
+MOTION_DTYPE = np.dtype(
+    [("dx", "<i4"), ("dy", "<i4"), ("wheel", "i1"), ("pan", "i1"), ("buttons", "u1")]
+)
+# movements are limited to the larger of these, or this many times the 99th percentile
+OUTLIER_MIN_DELTA = 256
+OUTLIER_FACTOR = 8
+# the largest side of a drawing before it gets downsampled
+MAX_CANVAS_SIZE = 4096
+# the most pixels to rasterize at once
+RASTER_CHUNK_POINTS = 1 << 18
 
-def u12_to_i12(u12: int) -> int:
-    mask_lower_11 = (1 << 11) - 1
-    return (u12 >> 11) * -0x800 + (u12 & mask_lower_11)
+# the shortest time to show a frame of an animation for, as browsers slow down shorter ones
+MIN_FRAME_MS = 20
 
+LEFT_BUTTON = 1
+RIGHT_BUTTON = 2
+MIDDLE_BUTTON = 4
+# buttons past back and forward, which are usually padding
+UNUSED_BUTTONS = 0b1110_0000
 
-def parse_packed_xy(xy: bytes) -> tuple[int, int]:
-    xy_int = struct.unpack("<I", xy + bytes([0]))[0]
-    x_u12 = xy_int & ((1 << 12) - 1)
-    y_u12 = xy_int >> 12
-    return u12_to_i12(x_u12), u12_to_i12(y_u12)
+# how many reports to try each format on
+DETECT_SAMPLE_SIZE = 4096
+# how many reports to hold back when following a capture, to detect the format from
+FOLLOW_DETECT_REPORTS = 64
+# the fraction of reports whose length (and report id) must fit a format
+DETECT_THRESHOLD = 0.9
+# how much a matching report id scales down a format's implausibility
+REPORT_ID_PRIOR = 0.9
+# the most a mouse moves in a typical report
+MAX_TYPICAL_DELTA = 256
+# how much setting unused button bits counts against a format
+UNUSED_BUTTONS_PENALTY = 4
 
 
-def main():
-    if len(sys.argv) != 2:
-        print(f"Usage: {sys.argv[0]} <wireshark csv file>")
-        sys.exit(0)
+@dataclass
+class ReportFormat:
+    name: str
+    # the lengths of the reports sent by devices using this format
+    lengths: range
+    # field -> (offset, numpy type), from report_id, buttons, x, y, wheel and pan
+    fields: dict[str, tuple[int, str]]
+    report_id: int | None = None
+    # x and y are 12 bit values packed into 3 bytes, in an xy field
+    packed: bool = False
+    # x and y are positions rather than movements, as sent by tablets and digitizers
+    absolute: bool = False
+
+    @cached_property
+    def dtype(self) -> np.dtype:
+        offsets = [offset for offset, _ in self.fields.values()]
+        formats = [np.dtype(format) for _, format in self.fields.values()]
+        return np.dtype(
+            {
+                "names": list(self.fields),
+                "formats": formats,
+                "offsets": offsets,
+                "itemsize": max(o + f.itemsize for o, f in zip(offsets, formats)),
+            }
+        )
+
+    def parse(self, reports) -> np.ndarray:
+        """Parse every report into an array of self.dtype, padding or truncating odd sized ones."""
+        size = self.dtype.itemsize
+        data = b"".join(
+            report if len(report) == size else bytes(report[:size]).ljust(size, b"\0")
+            for report in reports
+        )
+        return np.frombuffer(data, dtype=self.dtype)
+
+    def motion(self, parsed: np.ndarray) -> np.ndarray:
+        """Convert parsed reports into a MOTION_DTYPE array."""
+        if self.packed:
+            xy = parsed["xy"].astype(np.int32)
+            packed = xy[:, 0] | (xy[:, 1] << 8) | (xy[:, 2] << 16)
+            x = sign_extend(packed & 0xFFF, 12)
+            y = sign_extend(packed >> 12, 12)
+        else:
+            x = parsed["x"].astype(np.int32)
+            y = parsed["y"].astype(np.int32)
+
+        motion = np.zeros(len(parsed), dtype=MOTION_DTYPE)
+        if self.absolute:
+            motion["dx"] = np.diff(x, prepend=x[:1])
+            motion["dy"] = np.diff(y, prepend=y[:1])
+        else:
+            motion["dx"] = x
+            motion["dy"] = y
+        motion["buttons"] = parsed["buttons"] & 0xFF
+        for field in ("wheel", "pan"):
+            if field in self.fields:
+                motion[field] = parsed[field]
+        return motion
+
+
+REPORT_FORMATS = {
+    report_format.name: report_format
+    for report_format in [
+        # buttons, X, Y and an optional wheel
+        ReportFormat(
+            "boot",
+            range(3, 5),
+            {"buttons": (0, "u1"), "x": (1, "i1"), "y": (2, "i1"), "wheel": (3, "i1")},
+        ),
+        # the same with a report id in front
+        ReportFormat(
+            "boot-report-id",
+            range(4, 6),
+            {
+                "report_id": (0, "u1"),
+                "buttons": (1, "u1"),
+                "x": (2, "i1"),
+                "y": (3, "i1"),
+                "wheel": (4, "i1"),
+            },
+            report_id=1,
+        ),
+        # buttons, 16 bit X and Y, wheel and pan
+        ReportFormat(
+            "relative-16",
+            range(6, 9),
+            {
+                "buttons": (0, "u1"),
+                "x": (1, "<i2"),
+                "y": (3, "<i2"),
+                "wheel": (5, "i1"),
+                "pan": (6, "i1"),
+            },
+        ),
+        # report id, 16 buttons, 12 bit X and Y packed into 3 bytes, wheel and pan
+        ReportFormat(
+            "packed-12",
+            range(7, 9),
+            {
+                "report_id": (0, "u1"),
+                "buttons": (1, "<u2"),
+                "xy": (3, "(3,)u1"),
+                "wheel": (6, "i1"),
+                "pan": (7, "i1"),
+            },
+            report_id=2,
+            packed=True,
+        ),
+        # buttons and the absolute 16 bit X and Y of a tablet or digitizer pen
+        ReportFormat(
+            "absolute",
+            range(5, 10),
+            {"buttons": (0, "u1"), "x": (1, "<u2"), "y": (3, "<u2")},
+            absolute=True,
+        ),
+    ]
+}
+
+
+def sign_extend(values: np.ndarray, bits: int) -> np.ndarray:
+    shift = 32 - bits
+    return (values.astype(np.int32) << shift) >> shift
+
+
+def implausibility(motion: np.ndarray) -> float:
+    """How unlike a hand moving a mouse the movements look, lower is more plausible.
+
+    Real movements change smoothly from one report to the next, relative to how far
+    the mouse moves, while the wrong format decodes other fields or the wrong bytes
+    as movements, which either jump around, never move at all or move further in
+    most reports than anyone moves a mouse in a few milliseconds.
+    """
+    dx = motion["dx"].astype(np.int64)
+    dy = motion["dy"].astype(np.int64)
+    if not (dx.any() and dy.any()):
+        return float("inf")
+
+    size = np.maximum(np.abs(dx), np.abs(dy))
+    if np.median(size[size != 0]) > MAX_TYPICAL_DELTA:
+        return float("inf")
+
+    jerk = np.abs(np.diff(dx)).sum() + np.abs(np.diff(dy)).sum()
+    distance = np.abs(dx).sum() + np.abs(dy).sum()
+    unused = np.count_nonzero(motion["buttons"] & UNUSED_BUTTONS) / len(motion)
+    return float(jerk / distance) + UNUSED_BUTTONS_PENALTY * unused
+
+
+def fitting_formats(reports: list) -> list[tuple[ReportFormat, np.ndarray]]:
+    """The formats whose lengths and report id fit most of the reports, with the reports
+    parsed in that format."""
+    lengths = np.array([len(report) for report in reports])
+
+    fits = []
+    for report_format in REPORT_FORMATS.values():
+        if np.isin(lengths, report_format.lengths).mean() < DETECT_THRESHOLD:
+            continue
+
+        parsed = report_format.parse(reports)
+        if report_format.report_id is not None:
+            matches = parsed["report_id"] == report_format.report_id
+            if matches.mean() < DETECT_THRESHOLD:
+                continue
+
+        fits.append((report_format, parsed))
+
+    return fits
+
+
+def format_score(report_format: ReportFormat, motion: np.ndarray) -> float:
+    """How implausible the movements are in a format, lower is better.
+
+    A constant first byte is a little more likely to be a report id than buttons held
+    down, so formats whose report id matches get a small head start, which decides
+    between otherwise equally plausible formats.
+    """
+    score = implausibility(motion)
+    if report_format.report_id is not None:
+        score *= REPORT_ID_PRIOR
+    return score
+
+
+def detect_format(reports: list) -> ReportFormat:
+    """Guess the format of a device's reports from their lengths, report ids and how
+    plausible the movements they decode to are."""
+    sample = reports[:DETECT_SAMPLE_SIZE]
+
+    candidates = []
+    for report_format, parsed in fitting_formats(sample):
+        score = format_score(report_format, report_format.motion(parsed))
+        if score != float("inf"):
+            candidates.append((score, report_format))
+
+    if not candidates:
+        LOGGER.warning("no report format fits the reports, trying them all")
+        candidates = [
+            (
+                implausibility(report_format.motion(report_format.parse(sample))),
+                report_format,
+            )
+            for report_format in REPORT_FORMATS.values()
+        ]
+
+    # ties go to the first format in REPORT_FORMATS
+    return min(candidates, key=lambda candidate: candidate[0])[1]
+
+
+def decode_reports(reports, report_format: ReportFormat | None = None) -> np.ndarray:
+    """Decode mouse reports into a MOTION_DTYPE array, detecting their format if it isn't given."""
+    reports = list(reports)
+    if report_format is None:
+        report_format = detect_format(reports)
+
+    parsed = report_format.parse(reports)
+
+    if report_format.report_id is not None:
+        unrecognised = np.flatnonzero(parsed["report_id"] != report_format.report_id)
+        if len(unrecognised):
+            LOGGER.warning(
+                "%d reports with an unrecognised report_id, first @ %d: %d",
+                len(unrecognised),
+                unrecognised[0],
+                parsed["report_id"][unrecognised[0]],
+            )
+
+    return report_format.motion(parsed)
+
+
+def limit_outliers(motion: np.ndarray, max_delta: int | None = None) -> np.ndarray:
+    """Scale down movements larger than max_delta on either axis, keeping their direction.
+
+    By default the limit is a multiple of the 99th percentile movement, so a few
+    corrupt reports can't blow up the size of the drawing.
+    """
+    dx = motion["dx"].astype(np.int64)
+    dy = motion["dy"].astype(np.int64)
+    size = np.maximum(np.abs(dx), np.abs(dy))
+
+    if max_delta is None:
+        moving = size[size != 0]
+        typical = int(np.percentile(moving, 99)) if len(moving) else 0
+        max_delta = max(OUTLIER_MIN_DELTA, OUTLIER_FACTOR * typical)
+
+    outliers = size > max_delta
+    if not outliers.any():
+        return motion
+
+    LOGGER.warning(
+        "limiting %d movements larger than %d", np.count_nonzero(outliers), max_delta
+    )
+    motion = motion.copy()
+    motion["dx"][outliers] = dx[outliers] * max_delta // size[outliers]
+    motion["dy"][outliers] = dy[outliers] * max_delta // size[outliers]
+    return motion
+
+
+def trajectory(motion: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """The position before the first report and after every report, shifted so the
+    top left of the bounding box is (0, 0)."""
+    x = np.zeros(len(motion) + 1, dtype=np.int64)
+    y = np.zeros(len(motion) + 1, dtype=np.int64)
+    np.cumsum(motion["dx"], out=x[1:])
+    np.cumsum(motion["dy"], out=y[1:])
+    return (x - x.min()).astype(np.int32), (y - y.min()).astype(np.int32)
+
+
+def segment_colours(buttons: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """The colour of each segment, and which segments get drawn at all."""
+    if DIFFERENTIATE_BUTTONS:
+        colours = np.stack(
+            [
+                np.where(buttons & LEFT_BUTTON, 0xFF, 0x00),
+                np.where(buttons & RIGHT_BUTTON, 0xFF, 0x00),
+                np.where(buttons & MIDDLE_BUTTON, 0xFF, 0x00),
+            ],
+            axis=1,
+        ).astype(np.uint8)
+        return colours, np.ones(len(buttons), dtype=bool)
+
+    colours = np.zeros((len(buttons), 3), dtype=np.uint8)
+    return colours, buttons & (LEFT_BUTTON | RIGHT_BUTTON | MIDDLE_BUTTON) != 0
+
+
+def _rasterize_chunk(canvas, x0, y0, dx, dy, steps, colours):
+    # every point along every segment, stepping one pixel along its longer axis
+    points = steps + 1
+    segment = np.repeat(np.arange(len(points)), points)
+    t = np.arange(int(points.sum())) - np.repeat(np.cumsum(points) - points, points)
+
+    step = np.maximum(steps, 1)[segment]
+    # round to the nearest pixel in integer arithmetic
+    px = x0[segment] + (2 * t * dx[segment] + step) // (2 * step)
+    py = y0[segment] + (2 * t * dy[segment] + step) // (2 * step)
+
+    height, width, _ = canvas.shape
+    first = -(DRAW_WIDTH // 2)
+    for ox in range(first, first + max(DRAW_WIDTH, 1)):
+        for oy in range(first, first + max(DRAW_WIDTH, 1)):
+            x = px + ox
+            y = py + oy
+            inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+            # later segments are drawn over earlier ones
+            canvas[y[inside], x[inside]] = colours[segment[inside]]
+
 
-    df = pd.read_csv(sys.argv[1], index_col=0)
+def rasterize(
+    canvas: np.ndarray,
+    x0: np.ndarray,
+    y0: np.ndarray,
+    x1: np.ndarray,
+    y1: np.ndarray,
+    colours: np.ndarray,
+):
+    """Draw the segments (x0, y0) -> (x1, y1) into canvas, an (height, width, 3) array.
 
-    capdata = df["HID Data"].dropna().reset_index(drop=True)
+    Segments are drawn in chunks of at most RASTER_CHUNK_POINTS pixels, so memory use
+    doesn't depend on the length of the trajectory.
+    """
+    dx = x1 - x0
+    dy = y1 - y0
+    steps = np.maximum(np.abs(dx), np.abs(dy))
+    ends = np.cumsum(steps + 1)
 
-    hid_data: list[MouseHIDData] = []
-    for row in capdata:
-        report_id, buttons, xy, wheel, pan = struct.unpack(
-            "<BH3sbb", bytes.fromhex(row)
+    start = 0
+    while start < len(steps):
+        done = int(ends[start - 1]) if start else 0
+        stop = int(np.searchsorted(ends, done + RASTER_CHUNK_POINTS, side="right"))
+        chunk = slice(start, max(stop, start + 1))
+        _rasterize_chunk(
+            canvas,
+            x0[chunk],
+            y0[chunk],
+            dx[chunk],
+            dy[chunk],
+            steps[chunk],
+            colours[chunk],
         )
+        start = chunk.stop
 
-        if report_id != 2:
-            print(f"[warn] report_id not recognised: {report_id = }")
 
-        lm_clicked = buttons & 1 == 1
-        rm_clicked = buttons & 2 == 2
-        mm_clicked = buttons & 4 == 4
+def segments(
+    x: np.ndarray, y: np.ndarray, buttons: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """The start and end points and colours of the segments of the trajectory which
+    get drawn, in the order they're drawn."""
+    colours, drawn = segment_colours(buttons)
+    index = np.flatnonzero(drawn)
+    x = x.astype(np.int64)
+    y = y.astype(np.int64)
+    return x[index], y[index], x[index + 1], y[index + 1], colours[index]
 
-        x, y = parse_packed_xy(xy)
 
-        hid_data += [MouseHIDData(x, y, wheel, pan, lm_clicked, rm_clicked, mm_clicked)]
+def fit_canvas(
+    x: np.ndarray, y: np.ndarray, max_size: int
+) -> tuple[np.ndarray, np.ndarray, int, int]:
+    """Downsample a trajectory so neither side of its canvas is larger than max_size,
+    returning the points and the width and height of the canvas."""
+    width = int(x.max()) + 1
+    height = int(y.max()) + 1
+    if max(width, height) <= max_size:
+        return x.astype(np.int64), y.astype(np.int64), width, height
 
-    relative_positions = [MousePosition(0, 0, False, False, False)]
-    for data in hid_data:
-        last = relative_positions[-1]
-        new_pos = last.x + data.x_off, last.y + data.y_off
-        relative_positions += [MousePosition(*new_pos, *data[4:])]
+    scale = (max_size - 1) / (max(width, height) - 1)
+    LOGGER.warning(
+        "drawing is %dx%d, downsampling by %.1f to fit in %dx%d",
+        width,
+        height,
+        1 / scale,
+        max_size,
+        max_size,
+    )
+    return (
+        np.rint(x * scale).astype(np.int64),
+        np.rint(y * scale).astype(np.int64),
+        int(np.rint((width - 1) * scale)) + 1,
+        int(np.rint((height - 1) * scale)) + 1,
+    )
 
-    min_x = min(pos.x for pos in relative_positions)
-    min_y = min(pos.y for pos in relative_positions)
-    x_shift = -min_x
-    y_shift = -min_y
 
-    positions = [
-        MousePosition(pos.x + x_shift, pos.y + y_shift, *pos[2:])
-        for pos in relative_positions
-    ]
+def draw(
+    motion: np.ndarray,
+    max_size: int = MAX_CANVAS_SIZE,
+    max_delta: int | None = None,
+) -> Image.Image:
+    """Draw the trajectory, downsampled so neither side is larger than max_size."""
+    x, y = trajectory(limit_outliers(motion, max_delta))
+    x, y, width, height = fit_canvas(x, y, max_size)
+    x0, y0, x1, y1, colours = segments(x, y, motion["buttons"])
+
+    canvas = np.full((height, width, 3), 0xFF, dtype=np.uint8)
+    rasterize(canvas, x0, y0, x1, y1, colours)
+    return Image.fromarray(canvas)
+
+
+def frame_bounds(
+    motion: np.ndarray, timestamps: np.ndarray, split_by: str, window: float
+) -> list[tuple[int, int]]:
+    """Split the reports into frames, either "time" windows of window seconds or
+    "stroke"s of the same buttons held down, returning the [start, stop) report
+    indices of every frame with something drawn in it."""
+    _, drawn = segment_colours(motion["buttons"])
+
+    if split_by == "time":
+        windows = int((timestamps[-1] - timestamps[0]) // window) + 1
+        edges = timestamps[0] + window * np.arange(windows + 1)
+        starts = np.searchsorted(timestamps, edges)
+        bounds = zip(starts[:-1].tolist(), starts[1:].tolist())
+    else:
+        held = motion["buttons"] & (LEFT_BUTTON | RIGHT_BUTTON | MIDDLE_BUTTON)
+        starts = np.flatnonzero(np.diff(held, prepend=-1) != 0)
+        bounds = zip(starts.tolist(), [*starts[1:].tolist(), len(motion)])
+
+    # the number of drawn segments before each report, to find frames with any in
+    before = np.concatenate([[0], np.cumsum(drawn)])
+    return [(start, stop) for start, stop in bounds if before[stop] > before[start]]
+
+
+def frame_durations(
+    timestamps: np.ndarray, bounds: list[tuple[int, int]], window: float
+) -> list[float]:
+    """How long to show each frame for, to play the frames back in real time."""
+    starts = [timestamps[start] for start, _ in bounds]
+    if not bounds:
+        return []
+    _, stop = bounds[-1]
+    last = max(window, timestamps[stop - 1] - starts[-1])
+    return [*np.diff(starts).tolist(), last]
+
+
+def draw_frames(
+    motion: np.ndarray,
+    bounds: list[tuple[int, int]],
+    max_size: int = MAX_CANVAS_SIZE,
+    max_delta: int | None = None,
+    clear: bool = False,
+) -> Iterator[np.ndarray]:
+    """Draw each frame onto the same canvas, yielding the canvas after each one.
+
+    Each frame only draws its own segments over the ones before, or over a blank
+    canvas if clear is set. The canvas is reused, so copy it to keep it.
+    """
+    x, y = trajectory(limit_outliers(motion, max_delta))
+    x, y, width, height = fit_canvas(x, y, max_size)
+    colours, drawn = segment_colours(motion["buttons"])
+
+    canvas = np.full((height, width, 3), 0xFF, dtype=np.uint8)
+    for start, stop in bounds:
+        if clear:
+            canvas.fill(0xFF)
+        index = start + np.flatnonzero(drawn[start:stop])
+        rasterize(
+            canvas, x[index], y[index], x[index + 1], y[index + 1], colours[index]
+        )
+        yield canvas
+
+
+def save_frame(canvas: np.ndarray, path: str, quantize: bool = False):
+    img = Image.fromarray(canvas)
+    if quantize:
+        # GIFs need a palette, which is the slow part of encoding them
+        img = img.quantize()
+    if path:
+        img.save(path)
+    return img
 
-    img_width = max(pos.x for pos in positions) + 1
-    img_height = max(pos.y for pos in positions) + 1
-    img = Image.new(mode="RGB", size=(img_width, img_height), color=(0xFF, 0xFF, 0xFF))
-    img_draw = ImageDraw.Draw(img)
-
-    for last_pos, pos in zip(positions, positions[1:]):
-        if DIFFERENTIATE_BUTTONS:
-            pixel = (
-                0xFF if pos.left_click else 0x00,
-                0xFF if pos.right_click else 0x00,
-                0xFF if pos.middle_click else 0x00,
+
+def encode_frames(
+    frames: Iterator[np.ndarray],
+    paths: Iterator[str],
+    jobs: int | None = None,
+    quantize: bool = False,
+) -> Iterator[Image.Image]:
+    """Encode frames with a pool of workers, yielding the images in order and keeping
+    a few frames in flight."""
+    jobs = jobs or os.cpu_count() or 1
+    with ProcessPoolExecutor(jobs) as executor:
+        pending: deque[Future] = deque()
+        for canvas, path in zip(frames, paths):
+            # copy the canvas now, it's drawn over before the pool gets to send it
+            pending.append(executor.submit(save_frame, canvas.copy(), path, quantize))
+            if len(pending) > 2 * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def write_frames(
+    frames: Iterator[np.ndarray], paths: Iterator[str], jobs: int | None = None
+):
+    """Encode frames to PNGs with a pool of workers, keeping a few frames in flight."""
+    for _ in encode_frames(frames, paths, jobs):
+        pass
+
+
+def write_animation(
+    frames: Iterator[np.ndarray],
+    durations: list[float],
+    path: str,
+    jobs: int | None = None,
+):
+    """Write an animated GIF, or APNG for a .png path, showing each frame for its duration."""
+    quantize = path.lower().endswith(".gif")
+    images = encode_frames(frames, repeat(""), jobs, quantize)
+    if (first := next(images, None)) is None:
+        return
+    # the GIF writer takes the frames as they're encoded, the APNG one goes over them
+    # twice so needs them all up front
+    rest = images if quantize else list(images)
+    first.save(
+        path,
+        save_all=True,
+        append_images=rest,
+        duration=[max(MIN_FRAME_MS, round(1000 * d)) for d in durations],
+        loop=0,
+    )
+
+
+def draw_tiles(
+    motion: np.ndarray, tile_size: int, max_delta: int | None = None
+) -> Iterator[tuple[int, int, Image.Image]]:
+    """Draw the trajectory at full size as tile_size square tiles, yielding the
+    column, row and image of every tile with something drawn on it."""
+    x, y = trajectory(limit_outliers(motion, max_delta))
+    x0, y0, x1, y1, colours = segments(x, y, motion["buttons"])
+    if not len(colours):
+        return
+
+    left = np.minimum(x0, x1) - DRAW_WIDTH
+    right = np.maximum(x0, x1) + DRAW_WIDTH
+    top = np.minimum(y0, y1) - DRAW_WIDTH
+    bottom = np.maximum(y0, y1) + DRAW_WIDTH
+
+    for row in range(
+        max(int(top.min()), 0) // tile_size, int(bottom.max()) // tile_size + 1
+    ):
+        tile_top = row * tile_size
+        in_row = (bottom >= tile_top) & (top < tile_top + tile_size)
+        if not in_row.any():
+            continue
+
+        for col in range(
+            max(int(left[in_row].min()), 0) // tile_size,
+            int(right[in_row].max()) // tile_size + 1,
+        ):
+            tile_left = col * tile_size
+            index = np.flatnonzero(
+                in_row & (right >= tile_left) & (left < tile_left + tile_size)
             )
+            if not len(index):
+                continue
 
-            img_draw.line(
-                [(last_pos.x, last_pos.y), (pos.x, pos.y)], fill=pixel, width=DRAW_WIDTH
+            canvas = np.full((tile_size, tile_size, 3), 0xFF, dtype=np.uint8)
+            rasterize(
+                canvas,
+                x0[index] - tile_left,
+                y0[index] - tile_top,
+                x1[index] - tile_left,
+                y1[index] - tile_top,
+                colours[index],
             )
-        elif pos.left_click or pos.right_click or pos.middle_click:
-            img_draw.line(
-                [(last_pos.x, last_pos.y), (pos.x, pos.y)],
-                fill=(0, 0, 0),
-                width=DRAW_WIDTH,
+            yield col, row, Image.fromarray(canvas)
+
+
+class MouseDecoder:
+    """Tracks the position of a mouse a report at a time, for following a capture.
+
+    Without a format, the first reports are held back until there are enough to detect
+    it from like detect_format does, as a single report can't tell a report id from
+    a button held down.
+    """
+
+    def __init__(self, report_format: ReportFormat | None = None):
+        self.report_format = report_format
+        self.position = MousePosition(0, 0, False, False, False)
+        self.pending = []
+
+    def feed(self, report) -> list[MousePosition]:
+        """The positions after the report, and any held back before it."""
+        if self.report_format is not None:
+            return [self._advance(report)]
+
+        self.pending.append(report)
+        if len(self.pending) < FOLLOW_DETECT_REPORTS:
+            return []
+        return self.flush()
+
+    def flush(self) -> list[MousePosition]:
+        """The positions after the reports held back, e.g. at the end of a capture."""
+        if not self.pending:
+            return []
+        if self.report_format is None:
+            self.report_format = detect_format(self.pending)
+            LOGGER.info("decoding as %s reports", self.report_format.name)
+
+        pending, self.pending = self.pending, []
+        return [self._advance(report) for report in pending]
+
+    def _advance(self, report) -> MousePosition:
+        parsed = self.report_format.parse([report])
+        (motion,) = self.report_format.motion(parsed).tolist()
+        dx, dy, _, _, buttons = motion
+
+        if self.report_format.absolute:
+            x, y = parsed["x"].item(), parsed["y"].item()
+        else:
+            x, y = self.position.x + dx, self.position.y + dy
+
+        self.position = MousePosition(
+            x,
+            y,
+            buttons & LEFT_BUTTON != 0,
+            buttons & RIGHT_BUTTON != 0,
+            buttons & MIDDLE_BUTTON != 0,
+        )
+        return self.position
+
+
+def follow(args):
+    """Print the mouse position after every report as it is captured, in constant memory.
+
+    Each line is: device, timestamp, x, y, left, right and middle button.
+    """
+    classifier = usb_pcap.StreamClassifier()
+    report_format = REPORT_FORMATS.get(args.format)
+    decoders: dict[tuple[int, int, int], MouseDecoder] = {}
+    # timestamps of the reports each decoder is holding back
+    timestamps: dict[tuple[int, int, int], deque[float]] = {}
+
+    def show(key, positions):
+        for pos in positions:
+            print(
+                usb_pcap.stream_name(key),
+                f"{timestamps[key].popleft():.6f}",
+                pos.x,
+                pos.y,
+                int(pos.left_click),
+                int(pos.right_click),
+                int(pos.middle_click),
+                sep="\t",
+                flush=True,
             )
 
-    img.save("out.png")
+    input_file = sys.stdin.buffer if args.capture == "-" else open(args.capture, "rb")
+    try:
+        with input_file:
+            for packet in usb_pcap.stream_hid_reports(input_file, args.follow):
+                if classifier.classify(packet) != "mouse":
+                    continue
+
+                key = (packet.bus, packet.device, packet.endpoint)
+                if key not in decoders:
+                    decoders[key] = MouseDecoder(report_format)
+                    timestamps[key] = deque()
+                timestamps[key].append(packet.timestamp)
+                show(key, decoders[key].feed(packet.data))
+    finally:
+        # devices which sent too few reports to detect their format from
+        for key, decoder in decoders.items():
+            show(key, decoder.flush())
+
+
+def argument_parser():
+    parser = ArgumentParser(
+        description="Draw the movements of a USB mouse from a capture."
+    )
+    parser.add_argument(
+        "capture",
+        help="A usbmon / USBPcap pcap or pcapng file, or a Wireshark CSV export with a HID Data column. - reads a capture from stdin, e.g. from tcpdump -w -",
+    )
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="Print positions as they are captured instead of drawing, waiting for the capture to grow like tail -f",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["auto", *REPORT_FORMATS],
+        default="auto",
+        help="The format of the mouse reports, by default guessed for each device",
+    )
+    parser.add_argument(
+        "--frames",
+        choices=["time", "stroke"],
+        help="Draw a frame for every --window seconds, or every stroke made with the same buttons held, to tell apart strokes drawn over each other",
+    )
+    parser.add_argument(
+        "--window",
+        type=float,
+        default=1.0,
+        help="How many seconds of movement to draw in each frame",
+    )
+    parser.add_argument(
+        "--clear-frames",
+        action="store_true",
+        help="Draw each frame on a blank canvas instead of over the frames before",
+    )
+    parser.add_argument(
+        "--animate",
+        choices=["gif", "apng"],
+        help="Write the frames as an animation played back in real time instead of a PNG per frame",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of frames to encode at once.",
+    )
+    parser.add_argument(
+        "--max-delta",
+        type=int,
+        help="Scale down movements larger than this many pixels, by default a multiple of the typical movement",
+    )
+    parser.add_argument(
+        "--max-size",
+        type=int,
+        default=MAX_CANVAS_SIZE,
+        help="Downsample drawings larger than this many pixels across",
+    )
+    parser.add_argument(
+        "--tile-size",
+        type=int,
+        help="Write the drawing at full size as tiles this many pixels square, instead of downsampling it",
+    )
+    parser.add_argument("--log-level", default="INFO", help="Set the log level")
+    return parser
+
+
+def main():
+    args = argument_parser().parse_args()
+    level: int | str = (
+        TRACE if args.log_level.upper() == "TRACE" else args.log_level.upper()
+    )
+
+    LOGGER.setLevel(level)
+    ch = logging.StreamHandler()
+    ch.setLevel(level)
+    ch.setFormatter(CustomFormatter())
+    LOGGER.addHandler(ch)
+
+    if args.follow or args.capture == "-":
+        try:
+            follow(args)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    with instrumentation.stage("read"):
+        streams = usb_pcap.group_streams(usb_pcap.read_reports(args.capture))
+
+    mice = {
+        key: packets
+        for key, packets in streams.items()
+        if usb_pcap.classify_stream(packets) == "mouse"
+    }
+    if not mice:
+        LOGGER.warning("no device looks like a mouse, decoding them all")
+        mice = streams
+
+    for key, packets in mice.items():
+        with instrumentation.stage("decode"):
+            reports = [packet.data for packet in packets]
+            report_format = REPORT_FORMATS.get(args.format) or detect_format(reports)
+            LOGGER.info(
+                "decoding %s as %s reports",
+                usb_pcap.stream_name(key),
+                report_format.name,
+            )
+            motion = decode_reports(reports, report_format)
+            instrumentation.count("reports", len(motion))
+
+        # keep the old name when there's only the one mouse
+        name = "out" if len(mice) == 1 else f"out-{usb_pcap.stream_name(key)}"
+
+        if args.frames is not None:
+            timestamps = np.array([packet.timestamp for packet in packets])
+            bounds = frame_bounds(motion, timestamps, args.frames, args.window)
+            frames = draw_frames(
+                motion, bounds, args.max_size, args.max_delta, args.clear_frames
+            )
+
+            with instrumentation.stage("frames"):
+                if args.animate is not None:
+                    durations = frame_durations(timestamps, bounds, args.window)
+                    write_animation(
+                        frames, durations, f"{name}.{args.animate}", args.jobs
+                    )
+                else:
+                    paths = (f"{name}-{i:05d}.png" for i in range(len(bounds)))
+                    write_frames(frames, paths, args.jobs)
+                instrumentation.count("frames", len(bounds))
+            continue
+
+        with instrumentation.stage("draw"):
+            if args.tile_size is None:
+                draw(motion, args.max_size, args.max_delta).save(f"{name}.png")
+                continue
+
+            tiles = draw_tiles(motion, args.tile_size, args.max_delta)
+            for col, row, img in tiles:
+                img.save(f"{name}-{col}-{row}.png")
+                instrumentation.count("tiles")
 
 
 if __name__ == "__main__":
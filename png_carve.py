@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+import logging
+import heapq
+import os
+
+from argparse import ArgumentParser
+from dataclasses import dataclass
+from custom_formatter import CustomFormatter, TRACE
+from png_fix import PNG_SIGNATURE, iter_chunk_headers, map_file
+
+LOGGER = logging.getLogger(__name__)
+
+IHDR_PREFIX = b"\x00\x00\x00\x0dIHDR"
+IEND_CHUNK = b"\x00\x00\x00\x00IEND\xaeB`\x82"
+
+# a PNG signature, or the start of an IHDR chunk whose signature may have been damaged
+CARVE_PATTERNS = [PNG_SIGNATURE, IHDR_PREFIX]
+
+# how far to look for an IEND chunk when the chain of chunk lengths is broken
+MAX_CARVE_SIZE = 1 << 28
+
+
+@dataclass
+class CarvedPng:
+    # offset of the signature, or where it should have been
+    start: int
+    # offset of the first chunk
+    chunks_start: int
+    end: int
+    # whether the signature was intact
+    signature: bool
+    # whether the chain of chunk lengths led all the way to an IEND chunk
+    chain_intact: bool
+    # whether the PNG ends with an IEND chunk at all
+    complete: bool
+    chunks: int
+
+
+def walk_chunk_chain(buf: memoryview, offset: int) -> tuple[int, int, bool]:
+    """Follow chunk lengths from ``offset`` while they lead to plausible chunks.
+
+    Returns the offset the chain ends at, the number of chunks in it and whether it
+    ended with an IEND chunk.
+    """
+    end = offset
+    count = 0
+    for offset, length, chunk_type in iter_chunk_headers(buf, offset):
+        if not chunk_type.isalpha() or length >= 1 << 31:
+            break
+
+        end = offset + 12 + length
+        count += 1
+        if chunk_type == b"IEND":
+            return end, count, True
+
+    return end, count, False
+
+
+def _find_all(haystack, needle: bytes):
+    position = haystack.find(needle)
+    while position != -1:
+        yield position, needle
+        position = haystack.find(needle, position + 1)
+
+
+def find_patterns(haystack, patterns: list[bytes]):
+    """Find every occurrence of any of the patterns, in order of position.
+
+    Each pattern gets its own find() scan, which is much faster than a regex alternation.
+    """
+    return heapq.merge(*(_find_all(haystack, pattern) for pattern in patterns))
+
+
+def find_carve_starts(haystack) -> list[tuple[int, int, bool]]:
+    """The (start, offset of the first chunk, whether the signature is intact) of every
+    PNG, in order."""
+    starts = []
+    last_signature = None
+    for position, pattern in find_patterns(haystack, CARVE_PATTERNS):
+        if pattern == PNG_SIGNATURE:
+            starts.append((position, position + 8, True))
+            last_signature = position
+        elif position - 8 != last_signature:
+            # an IHDR without a signature in front, so where it should have been, or
+            # the start of the input if there's no room for one
+            starts.append((max(position - 8, 0), position, False))
+    return starts
+
+
+def find_pngs(buf: memoryview, max_size: int = MAX_CARVE_SIZE):
+    haystack = buf.obj
+    starts = find_carve_starts(haystack)
+    for i, (start, chain_start, signature) in enumerate(starts):
+        # a broken PNG can't extend into the next one
+        limit = min(len(buf), start + max_size)
+        if i + 1 < len(starts):
+            limit = min(limit, max(starts[i + 1][0], chain_start))
+
+        end, chunks, chain_intact = walk_chunk_chain(buf, chain_start)
+        complete = chain_intact
+        if not chain_intact:
+            end = min(end, limit)
+            # a corrupted length field breaks the chain, so look for the IEND instead
+            iend = haystack.find(IEND_CHUNK, end, limit)
+            if iend != -1:
+                end = iend + len(IEND_CHUNK)
+                complete = True
+            elif end + 8 <= limit and bytes(buf[end + 4 : end + 8]).isalpha():
+                # keep a plausible chunk which was cut off by the end of the input, or
+                # by the next PNG
+                end = limit
+                chunks += 1
+
+        LOGGER.log(
+            TRACE, "Found PNG at %#x-%#x, %d chunks in the chain", start, end, chunks
+        )
+        yield CarvedPng(
+            start, chain_start, end, signature, chain_intact, complete, chunks
+        )
+
+
+def save_carved(buf: memoryview, png: CarvedPng, path: str):
+    with open(path, "wb") as f:
+        if png.signature:
+            f.write(buf[png.start : png.end])
+        else:
+            f.write(PNG_SIGNATURE)
+            f.write(buf[png.chunks_start : png.end])
+
+
+def argument_parser() -> ArgumentParser:
+    parser = ArgumentParser(
+        description="Find and extract every PNG embedded in a file, e.g. a memory dump, pcap or disk image."
+    )
+
+    parser.add_argument("input_file")
+    parser.add_argument(
+        "--output-dir", default="carved", help="Where to write the carved PNGs."
+    )
+    parser.add_argument(
+        "--max-size",
+        type=int,
+        default=MAX_CARVE_SIZE,
+        help="Furthest to look for an IEND chunk when a PNG's chunk lengths are corrupted.",
+    )
+    parser.add_argument(
+        "--list", action="store_true", help="Only list the PNGs found, don't save them."
+    )
+    parser.add_argument("--log-level", default="WARN", help="Set the log level")
+
+    return parser
+
+
+def main():
+    args = argument_parser().parse_args()
+    level: int | str = (
+        TRACE if args.log_level.upper() == "TRACE" else args.log_level.upper()
+    )
+
+    LOGGER.setLevel(level)
+    ch = logging.StreamHandler()
+    ch.setLevel(level)
+    ch.setFormatter(CustomFormatter())
+    LOGGER.addHandler(ch)
+
+    with open(args.input_file, "rb") as input_file:
+        buf = map_file(input_file)
+
+    if not args.list:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    for png in find_pngs(buf, args.max_size):
+        if not png.signature:
+            LOGGER.warning("PNG at %#x has a corrupted signature", png.start)
+        if not png.complete:
+            LOGGER.warning(
+                "PNG at %#x has no IEND chunk, it may be truncated", png.start
+            )
+        elif not png.chain_intact:
+            LOGGER.warning("PNG at %#x has a corrupted chunk length", png.start)
+
+        print(f"{png.start:#x}\t{png.end - png.start}\t{png.chunks} chunks")
+        if not args.list:
+            save_carved(
+                buf, png, os.path.join(args.output_dir, f"{png.start:012x}.png")
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,35 @@
 #!/usr/bin/env python
 import binascii
 import enum
+import glob
+import io
+import json
 import itertools as it
 import logging
+import math
+import mmap
+import multiprocessing
+import os
 import random
 import struct
+import sys
+import tempfile
+import threading
+import time
 import zlib
 
+import numpy as np
 from io import Reader, Writer
-from argparse import ArgumentParser
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass, field, asdict
+from functools import partial
+from typing import Any, Callable
 from custom_formatter import CustomFormatter, TRACE
 
+import instrumentation
+
 LOGGER = logging.getLogger(__name__)
 
 
@@ -87,16 +105,11 @@ class PngMetadata:
 class Chunk:
     length: int
     type: bytes
-    data: bytes
+    # a memoryview into the input file when parsed, to avoid copying chunk bodies
+    data: bytes | memoryview
     crc: int = field(default=0)
-
-    def __post_init__(self):
-        if binascii.crc32(self.type + self.data) != self.crc:
-            LOGGER.warning("CRC32 for %s chunk is incorrect", self.type)
-            if self.type == b"IHDR":
-                LOGGER.warning(
-                    "Metadata contents: %s", PngMetadata.from_bytes(self.data)
-                )
+    # cut off by the end of the file, so data is shorter than length and there's no CRC
+    truncated: bool = field(default=False)
 
     def __bytes__(self) -> bytes:
         return (
@@ -106,47 +119,173 @@ class Chunk:
             + struct.pack("!I", self.crc)
         )
 
+    def iovecs(self) -> list[bytes | memoryview]:
+        return [
+            struct.pack(">I", self.length) + self.type,
+            self.data,
+            struct.pack("!I", self.crc),
+        ]
+
+    def calc_crc(self) -> int:
+        return binascii.crc32(self.data, binascii.crc32(self.type))
+
+    def crc_valid(self) -> bool:
+        return self.calc_crc() == self.crc
+
+    def check_crc(self) -> bool:
+        """Check the CRC, warning if it doesn't match. Chunks are only checked on demand."""
+        if self.truncated:
+            LOGGER.warning(
+                "%s chunk is truncated, %d of %d bytes remain",
+                self.type,
+                len(self.data),
+                self.length,
+            )
+            return False
+        if self.crc_valid():
+            return True
+
+        LOGGER.warning("CRC32 for %s chunk is incorrect", self.type)
+        if self.type == b"IHDR":
+            try:
+                meta = PngMetadata.from_bytes(self.data)
+            except (ValueError, struct.error):
+                # a corrupted field can hold a value which isn't a valid enum member
+                meta = bytes(self.data)
+            LOGGER.warning("Metadata contents: %s", meta)
+
+        return False
+
     def recalc_crc(self):
-        self.crc = binascii.crc32(self.type + self.data)
+        self.crc = self.calc_crc()
 
     def log(self, action: str):
+        # called for every chunk read and written, so return early when it's all disabled
+        if not LOGGER.isEnabledFor(logging.INFO):
+            return
+
         LOGGER.info("%s %s chunk", action, self.type)
         LOGGER.debug("\tlength = %d", self.length)
-        LOGGER.log(TRACE, "\tdata = %s", self.data)
+        if LOGGER.isEnabledFor(TRACE):
+            LOGGER.log(TRACE, "\tdata = %s", bytes(self.data))
         LOGGER.debug("\tlength = %08x", self.crc)
 
 
-def read_header(pngfile: Reader[bytes]) -> bytes:
-    header = pngfile.read(8)
-    if header != b"\x89PNG\r\n\x1a\n":
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def map_file(input_file: Reader[bytes]) -> memoryview:
+    """Map the input file into memory, falling back to reading it for pipes and empty files."""
+    try:
+        mapping = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        buf = memoryview(input_file.read())
+        instrumentation.count("bytes read", len(buf))
+        return buf
+
+    instrumentation.count("bytes read", len(mapping))
+    if hasattr(mmap, "MADV_SEQUENTIAL"):
+        mapping.madvise(mmap.MADV_SEQUENTIAL)
+    return memoryview(mapping)
+
+
+def read_header(buf: memoryview) -> bytes:
+    header = bytes(buf[:8])
+    if header != PNG_SIGNATURE:
         LOGGER.error("%s is not a PNG file", header)
     LOGGER.log(TRACE, "Read header: %s", header)
     return header
 
 
-def write_header(pngfile: Writer[bytes], header: bytes):
-    pngfile.write(header)
-    LOGGER.log(TRACE, "Wrote header: %s", header)
-
+def read_chunk(buf: memoryview, offset: int) -> tuple[Chunk, int] | None:
+    """Read the chunk starting at ``offset``, returning it and the offset of the next chunk.
 
-def read_chunk(pngfile: Reader[bytes]) -> Chunk | None:
+    A chunk cut off by the end of the file is returned as truncated with whatever data
+    remains, so a partial IDAT can still be decompressed.
+    """
+    data_start = offset + 8
     try:
-        (length,) = struct.unpack(">I", pngfile.read(4))
-        chunk_type = pngfile.read(4)
-        chunk_data = pngfile.read(length)
-        (crc,) = struct.unpack("!I", pngfile.read(4))
+        length, chunk_type = struct.unpack_from(">I4s", buf, offset)
     except struct.error:
         return None
 
-    chunk = Chunk(length, chunk_type, chunk_data, crc)
+    try:
+        (crc,) = struct.unpack_from("!I", buf, data_start + length)
+    except struct.error:
+        # anything which isn't a chunk type is left over as excess data
+        if not chunk_type.isalpha():
+            return None
+        chunk = Chunk(length, chunk_type, buf[data_start:], truncated=True)
+        chunk.log(action="Read truncated")
+        return chunk, len(buf)
+
+    chunk = Chunk(length, chunk_type, buf[data_start : data_start + length], crc)
 
     chunk.log(action="Read")
-    return chunk
+    return chunk, data_start + length + 4
 
 
-def write_chunk(pngfile: Writer[bytes], chunk: Chunk):
-    pngfile.write(bytes(chunk))
-    chunk.log(action="Wrote")
+def iter_chunks(buf: memoryview, offset: int = 8):
+    """Lazily read chunks from ``offset``, up to and including the IEND chunk."""
+    while (read := read_chunk(buf, offset)) is not None:
+        chunk, offset = read
+        instrumentation.count("chunks parsed")
+        yield chunk
+        if chunk.type == b"IEND":
+            return
+
+
+# the signature, and an IHDR chunk up to the end of its data
+IHDR_END = 8 + 8 + 13
+
+
+def read_metadata(input_file: Reader[bytes]) -> PngMetadata:
+    """Read the metadata without parsing anything more of the file than needed.
+
+    The IHDR should be the first chunk, so this is normally a single small read.
+    """
+    head = input_file.read(IHDR_END)
+    read_header(memoryview(head))
+    if head[12:16] == b"IHDR" and len(head) == IHDR_END:
+        return PngMetadata.from_bytes(head[16:IHDR_END])
+
+    LOGGER.warning("IHDR is not the first chunk, searching for it")
+    input_file.seek(0)
+    for chunk in iter_chunks(map_file(input_file)):
+        if chunk.type == b"IHDR":
+            return PngMetadata.from_bytes(chunk.data)
+
+    raise Exception("No IHDR chunk found")
+
+
+def iter_chunk_headers(buf: memoryview, offset: int = 8):
+    """Walk the chain of chunk length fields from ``offset`` without touching chunk bodies.
+
+    Yields (offset, length, type) for every chunk which fits in the buffer.
+    """
+    while True:
+        try:
+            length, chunk_type = struct.unpack_from(">I4s", buf, offset)
+        except struct.error:
+            return
+        if offset + 12 + length > len(buf):
+            return
+
+        yield offset, length, chunk_type
+        offset += 12 + length
+
+
+def _writev_all(fd: int, buffers: list[bytes | memoryview]):
+    iov_max = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024
+    buffers = [memoryview(buffer).cast("B") for buffer in buffers if len(buffer)]
+    while buffers:
+        written = os.writev(fd, buffers[:iov_max])
+        # drop everything which was written, and the written prefix of a partial buffer
+        while buffers and written >= len(buffers[0]):
+            written -= len(buffers[0])
+            buffers.pop(0)
+        if written:
+            buffers[0] = buffers[0][written:]
 
 
 def set_metadata_property(chunk: Chunk, kv_pair: str) -> Chunk:
@@ -170,24 +309,660 @@ def set_metadata_property(chunk: Chunk, kv_pair: str) -> Chunk:
     return chunk
 
 
-def bruteforce_ihdr_dimensions(chunk: Chunk) -> Chunk:
-    for width, height in it.product(range(1, 10000), range(1, 10000)):
-        new_chunk = chunk
-        new_chunk.data = struct.pack(">II", width, height) + chunk.data[8:]
-        new_chunk.recalc_crc()
+MAX_BRUTEFORCE_DIMENSION = 9999
+# the CRC fixes 32 bits, so over the full 31 bit range of each dimension there are
+# around 2^30 matches, which is too many to list, let alone try
+MAX_DIMENSION_MATCHES = 1 << 16
+
+
+def _crc32_columns(payload: bytes, offset: int, size: int, bits: int) -> list[int]:
+    """Contribution of the low ``bits`` bits of the big-endian field at ``offset`` to the CRC32 of ``payload``.
+
+    CRC32 is affine over GF(2), so flipping a bit always XORs the same value into the CRC
+    regardless of the rest of the message.
+    """
+    base_crc = binascii.crc32(payload)
+    field = int.from_bytes(payload[offset : offset + size], "big")
+    columns = []
+    for bit in range(bits):
+        flipped = bytearray(payload)
+        flipped[offset : offset + size] = (field ^ (1 << bit)).to_bytes(size, "big")
+        columns.append(binascii.crc32(flipped) ^ base_crc)
+    return columns
+
+
+def _gf2_eliminate(columns: list[int]) -> tuple[dict[int, tuple[int, int]], list[int]]:
+    """Reduce ``columns`` to an echelon basis keyed by pivot bit.
+
+    Each basis entry records which of the original columns were XORed together to make
+    it, and the null space is returned as bitmasks over the original columns.
+    """
+    basis: dict[int, tuple[int, int]] = {}
+    null_space = []
+    for i, column in enumerate(columns):
+        combination = 1 << i
+        while column:
+            pivot = column.bit_length() - 1
+            if pivot not in basis:
+                basis[pivot] = (column, combination)
+                break
+            basis_column, basis_combination = basis[pivot]
+            column ^= basis_column
+            combination ^= basis_combination
+        else:
+            null_space.append(combination)
+
+    return basis, null_space
+
+
+def _gf2_solve(basis: dict[int, tuple[int, int]], target: int) -> int | None:
+    """Find a set of columns which XOR to ``target``, as a bitmask over the columns."""
+    solution = 0
+    while target:
+        pivot = target.bit_length() - 1
+        if pivot not in basis:
+            return None
+        basis_column, basis_combination = basis[pivot]
+        target ^= basis_column
+        solution ^= basis_combination
+
+    return solution
+
+
+def _iter_affine_space(offset: int, basis: list[int]):
+    # walk the space in gray code order so each step is a single XOR
+    value = offset
+    yield value
+    for i in range(1, 1 << len(basis)):
+        value ^= basis[(i & -i).bit_length() - 1]
+        yield value
+
+
+def _xor_columns(columns: list[int], value: int) -> int:
+    out = 0
+    for column in columns:
+        if value & 1:
+            out ^= column
+        value >>= 1
+    return out
+
+
+def area_prior(width: int, height: int) -> float:
+    return width * height
+
+
+def aspect_ratio_prior(ratio: float, width: int, height: int) -> float:
+    return abs(math.log(width / height / ratio))
+
+
+@dataclass
+class _DimensionSearch:
+    target: int
+    width_columns: list[int]
+    height_columns: list[int]
+    low_width_bits: int
+    low_height_bits: int
+    max_width: int
+    max_height: int
+    limit: int
+    basis: dict[int, tuple[int, int]]
+    null_space: list[int]
+    stop: Any
+
+
+_DIMENSION_SEARCH: _DimensionSearch | None = None
+
+# how many candidates to try between checks of the shared stop flag
+_STOP_CHECK_INTERVAL = 1 << 12
+
+
+def _init_dimension_search(
+    payload: bytes,
+    crc: int,
+    low_width_bits: int,
+    low_height_bits: int,
+    max_width: int,
+    max_height: int,
+    limit: int,
+    stop,
+):
+    global _DIMENSION_SEARCH
+
+    width_columns = _crc32_columns(payload, 4, 4, 32)
+    height_columns = _crc32_columns(payload, 8, 4, 32)
+    basis, null_space = _gf2_eliminate(
+        width_columns[:low_width_bits] + height_columns[:low_height_bits]
+    )
+
+    _DIMENSION_SEARCH = _DimensionSearch(
+        target=crc ^ binascii.crc32(payload),
+        width_columns=width_columns,
+        height_columns=height_columns,
+        low_width_bits=low_width_bits,
+        low_height_bits=low_height_bits,
+        max_width=max_width,
+        max_height=max_height,
+        limit=limit,
+        basis=basis,
+        null_space=null_space,
+        stop=stop,
+    )
+
+
+def _search_dimension_block(block: tuple[int, int]) -> list[tuple[int, int]]:
+    """Search the dimensions whose high bits are fixed to ``block``."""
+    search = _DIMENSION_SEARCH
+    if search.stop.is_set():
+        return []
+
+    width_base = block[0] << search.low_width_bits
+    height_base = block[1] << search.low_height_bits
+    target = (
+        search.target
+        ^ _xor_columns(search.width_columns, width_base)
+        ^ _xor_columns(search.height_columns, height_base)
+    )
+
+    solution = _gf2_solve(search.basis, target)
+    if solution is None:
+        return []
+
+    width_mask = (1 << search.low_width_bits) - 1
+    candidates = []
+    for i, value in enumerate(_iter_affine_space(solution, search.null_space)):
+        if i % _STOP_CHECK_INTERVAL == 0 and i != 0 and search.stop.is_set():
+            break
+
+        width = width_base | (value & width_mask)
+        height = height_base | (value >> search.low_width_bits)
+        if 0 < width <= search.max_width and 0 < height <= search.max_height:
+            candidates.append((width, height))
+            if len(candidates) >= search.limit:
+                search.stop.set()
+                break
+
+    return candidates
+
+
+def _split_bits(width_bits: int, height_bits: int, blocks: int) -> tuple[int, int]:
+    """Choose how many high bits of the width and height to fix for each search block."""
+    split_width = split_height = 0
+    while (1 << (split_width + split_height)) < blocks:
+        if split_width < width_bits and (
+            split_height == height_bits
+            or width_bits - split_width >= height_bits - split_height
+        ):
+            split_width += 1
+        elif split_height < height_bits:
+            split_height += 1
+        else:
+            break
+    return split_width, split_height
+
+
+def _block_centre(high: int, low_bits: int, maximum: int) -> int:
+    start = max(high << low_bits, 1)
+    end = min((high + 1) << low_bits, maximum + 1)
+    return (start + end) // 2
+
+
+def solve_ihdr_dimensions(
+    chunk: Chunk,
+    max_width: int = MAX_BRUTEFORCE_DIMENSION,
+    max_height: int = MAX_BRUTEFORCE_DIMENSION,
+    jobs: int = 1,
+    prior: Callable[[int, int], float] | None = None,
+    first_only: bool = False,
+    limit: int = MAX_DIMENSION_MATCHES,
+) -> list[tuple[int, int]]:
+    """Find every (width, height) up to the given bounds which matches the IHDR CRC.
+
+    Rather than trying every pair, the CRC is treated as a linear system over the bits
+    of the width and height, so the cost is proportional to the number of matches.
+
+    The space is split into blocks by fixing the high bits of the width and height,
+    which are searched in the order given by ``prior`` (lowest first) across ``jobs``
+    processes. With ``first_only`` every worker stops once any match is found.
+
+    The CRC only fixes 32 of the bits, so large bounds have far too many matches to
+    enumerate, e.g. around 2^30 over every valid PNG dimension. The search stops after
+    ``limit`` matches, which with a ``prior`` are the most likely ones.
+    """
+    if first_only:
+        limit = 1
+    width_bits = max_width.bit_length()
+    height_bits = max_height.bit_length()
+
+    expected_matches = 1 << max(width_bits + height_bits - 32, 0)
+    if expected_matches > limit:
+        LOGGER.warning(
+            "Up to %dx%d there are around %d dimensions matching the CRC, "
+            "stopping after the first %d",
+            max_width,
+            max_height,
+            expected_matches,
+            limit,
+        )
+
+    if jobs > 1 or prior is not None or first_only:
+        # enough blocks to keep every worker busy and give the prior something to order
+        blocks = max(jobs * 16, 256)
+    else:
+        blocks = 1
+    split_width, split_height = _split_bits(width_bits, height_bits, blocks)
+    low_width_bits = width_bits - split_width
+    low_height_bits = height_bits - split_height
+
+    tasks = list(
+        it.product(
+            range((max_width >> low_width_bits) + 1),
+            range((max_height >> low_height_bits) + 1),
+        )
+    )
+    if prior is not None:
+        tasks.sort(
+            key=lambda block: prior(
+                _block_centre(block[0], low_width_bits, max_width),
+                _block_centre(block[1], low_height_bits, max_height),
+            )
+        )
+    LOGGER.debug("Searching %d blocks of IHDR dimensions on %d jobs", len(tasks), jobs)
+    instrumentation.count("dimensions searched", (max_width + 1) * (max_height + 1))
+
+    search_args = (
+        # only the width and height are searched, so zero them in the payload
+        chunk.type + b"\x00" * 8 + bytes(chunk.data[8:]),
+        chunk.crc,
+        low_width_bits,
+        low_height_bits,
+        max_width,
+        max_height,
+        limit,
+    )
+
+    candidates = []
+    if jobs > 1:
+        ctx = multiprocessing.get_context()
+        stop = ctx.Event()
+        with ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=ctx,
+            initializer=_init_dimension_search,
+            initargs=(*search_args, stop),
+        ) as executor:
+            for found in executor.map(_search_dimension_block, tasks):
+                candidates += found
+                if len(candidates) >= limit:
+                    stop.set()
+                    executor.shutdown(cancel_futures=True)
+                    break
+    else:
+        _init_dimension_search(*search_args, threading.Event())
+        for block in tasks:
+            candidates += _search_dimension_block(block)
+            if len(candidates) >= limit:
+                break
+
+    del candidates[limit:]
+    candidates.sort(key=lambda wh: (prior(*wh), wh) if prior is not None else wh)
+    return candidates
+
+
+def inferred_ihdr_dimensions(
+    chunk: Chunk, idat_data: bytes, max_width: int, max_height: int
+) -> list[tuple[int, int]]:
+    """Check the dimensions which fit the decompressed IDAT data against the IHDR CRC."""
+    bit_depth, color_type, _, _, interlace_method = chunk.data[8:13]
+    if pixel_size_bits(bit_depth, color_type) is None or interlace_method not in list(
+        InterlaceMethod
+    ):
+        return []
+
+    inferred = infer_dimensions(
+        idat_data, max_width, max_height, [(bit_depth, color_type)], [interlace_method]
+    )
+    values = [
+        (candidate.width << 32) | candidate.height
+        for candidate in inferred
+        if candidate.valid_filters == candidate.scanlines
+    ]
+    LOGGER.debug("Checking %d dimensions inferred from the IDAT data", len(values))
+
+    matches = bruteforce_field(chunk, 0, 8, values)
+    return [(value >> 32, value & 0xFFFFFFFF) for value in matches]
+
+
+def bruteforce_ihdr_dimensions(
+    chunk: Chunk,
+    max_width: int = MAX_BRUTEFORCE_DIMENSION,
+    max_height: int = MAX_BRUTEFORCE_DIMENSION,
+    jobs: int = 1,
+    prior: Callable[[int, int], float] | None = None,
+    first_only: bool = False,
+    idat_data: bytes | None = None,
+    limit: int = MAX_DIMENSION_MATCHES,
+) -> Chunk:
+    candidates = []
+    if idat_data:
+        candidates = inferred_ihdr_dimensions(chunk, idat_data, max_width, max_height)
+
+    if not candidates:
+        candidates = solve_ihdr_dimensions(
+            chunk, max_width, max_height, jobs, prior, first_only, limit
+        )
+    if not candidates:
+        raise Exception(
+            f"Failed to find valid size by bruteforce up to {max_width}x{max_height} pixels"
+        )
+
+    for width, height in candidates:
+        LOGGER.info("found matching CRC, width = %d, height = %d", width, height)
+
+    if len(candidates) > 1:
+        LOGGER.warning(
+            "%d dimensions match the CRC, using the first: %s",
+            len(candidates),
+            candidates[0],
+        )
+
+    width, height = candidates[0]
+    return Chunk(
+        chunk.length,
+        chunk.type,
+        struct.pack(">II", width, height) + chunk.data[8:],
+        chunk.crc,
+    )
+
+
+def _make_crc32_table() -> np.ndarray:
+    table = np.arange(256, dtype=np.uint32)
+    for _ in range(8):
+        table = np.where(table & 1, (table >> 1) ^ np.uint32(0xEDB88320), table >> 1)
+    return table.astype(np.uint32)
+
+
+CRC32_TABLE = _make_crc32_table()
+
+# the top byte of each table entry is unique, which lets a CRC step be undone
+_CRC32_TABLE_BY_TOP_BYTE = np.argsort(CRC32_TABLE >> 24)
+
+# rows of candidates to score in each call to the CRC kernel
+CRC_BATCH_SIZE = 1 << 16
+
+
+def _crc32_zero_step(register: int) -> int:
+    return int(CRC32_TABLE[register & 0xFF]) ^ (register >> 8)
+
 
-        LOGGER.log(TRACE, "trying: width = %d, height = %d", width, height)
+def _crc32_zero_unstep(register: int) -> int:
+    index = int(_CRC32_TABLE_BY_TOP_BYTE[register >> 24])
+    return (((register ^ int(CRC32_TABLE[index])) << 8) & 0xFFFFFFFF) | index
 
-        if new_chunk.crc == chunk.crc:
-            LOGGER.info("found matching CRC, width = %d, height = %d", width, height)
 
-            return new_chunk
+def _gf2_matrix_tables(columns) -> np.ndarray:
+    """Byte-wise lookup tables for applying a 32x32 matrix over GF(2) to uint32 arrays."""
+    columns = np.asarray(columns, dtype=np.uint32)
+    values = np.arange(256)
+    tables = np.zeros((4, 256), dtype=np.uint32)
+    for bit in range(32):
+        tables[bit // 8][(values >> (bit % 8)) & 1 == 1] ^= columns[bit]
+    return tables
 
-    raise Exception(
-        "Failed to find valid size by bruteforce between 1 and 10000 pixels"
+
+def _gf2_apply(tables: np.ndarray, x: np.ndarray) -> np.ndarray:
+    return (
+        tables[0][x & 0xFF]
+        ^ tables[1][(x >> 8) & 0xFF]
+        ^ tables[2][(x >> 16) & 0xFF]
+        ^ tables[3][x >> 24]
+    )
+
+
+def _gf2_compose(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # columns of a @ b are the columns of b transformed by a
+    return _gf2_matrix_tables(
+        _gf2_apply(a, _gf2_apply(b, np.uint32(1) << np.arange(32, dtype=np.uint32)))
     )
 
 
+_CRC32_ZERO_STEP = _gf2_matrix_tables([_crc32_zero_step(1 << bit) for bit in range(32)])
+_CRC32_ZERO_UNSTEP = _gf2_matrix_tables(
+    [_crc32_zero_unstep(1 << bit) for bit in range(32)]
+)
+
+
+def _gf2_power(tables: np.ndarray, exponent: int) -> np.ndarray:
+    result = _gf2_matrix_tables(np.uint32(1) << np.arange(32, dtype=np.uint32))
+    while exponent:
+        if exponent & 1:
+            result = _gf2_compose(tables, result)
+        tables = _gf2_compose(tables, tables)
+        exponent >>= 1
+    return result
+
+
+def _gf2_orbit(tables: np.ndarray, start: np.ndarray, count: int) -> np.ndarray:
+    """Apply increasing powers of a matrix to ``start``, returning ``count`` rows."""
+    orbit = np.empty((count, *np.shape(start)), dtype=np.uint32)
+    orbit[0] = start
+    size = 1
+    while size < count:
+        step = min(size, count - size)
+        orbit[size : size + step] = _gf2_apply(tables, orbit[:step])
+        tables = _gf2_compose(tables, tables)
+        size *= 2
+    return orbit
+
+
+def crc32_batch(payloads: np.ndarray, crc: int = 0, suffix: bytes = b"") -> np.ndarray:
+    """CRC32 of every row of a (N, L) uint8 array, each followed by ``suffix``.
+
+    Like binascii.crc32, ``crc`` is the CRC of any data preceding the rows.
+    """
+    instrumentation.count("CRCs calculated", len(payloads))
+    register = np.full(len(payloads), crc ^ 0xFFFFFFFF, dtype=np.uint32)
+    for column in np.ascontiguousarray(payloads.T):
+        register = CRC32_TABLE[(register ^ column) & 0xFF] ^ (register >> 8)
+
+    if suffix:
+        # running the suffix through the register is affine, so apply it to every
+        # row at once as a matrix plus the contribution of the suffix itself
+        suffix_register = binascii.crc32(suffix, 0xFFFFFFFF) ^ 0xFFFFFFFF
+        register = _gf2_apply(
+            _gf2_power(_CRC32_ZERO_STEP, len(suffix)), register
+        ) ^ np.uint32(suffix_register)
+
+    return register ^ np.uint32(0xFFFFFFFF)
+
+
+def bruteforce_field(chunk: Chunk, offset: int, size: int, values) -> list[int]:
+    """Find the values of the big-endian field at ``offset`` in the chunk data which match its CRC."""
+    prefix_crc = binascii.crc32(chunk.type + bytes(chunk.data[:offset]))
+    suffix = bytes(chunk.data[offset + size :])
+    shifts = np.arange(8 * (size - 1), -1, -8, dtype=np.uint64)
+
+    matches = []
+    values = np.asarray(values, dtype=np.uint64)
+    for start in range(0, len(values), CRC_BATCH_SIZE):
+        batch = values[start : start + CRC_BATCH_SIZE]
+        payloads = ((batch[:, None] >> shifts) & 0xFF).astype(np.uint8)
+        crcs = crc32_batch(payloads, prefix_crc, suffix)
+        matches += batch[crcs == chunk.crc].tolist()
+
+    return matches
+
+
+IHDR_FIELD_OFFSETS = {
+    "bit_depth": 8,
+    "color_type": 9,
+    "compression_method": 10,
+    "filter_method": 11,
+    "interlace_method": 12,
+}
+
+
+def bruteforce_ihdr_field(chunk: Chunk, name: str) -> Chunk:
+    matches = bruteforce_field(chunk, IHDR_FIELD_OFFSETS[name], 1, range(256))
+    if not matches:
+        raise Exception(f"Failed to find a value for {name} which matches the CRC")
+
+    for value in matches:
+        LOGGER.info("found matching CRC, %s = %d", name, value)
+
+    offset = IHDR_FIELD_OFFSETS[name]
+    data = bytearray(chunk.data)
+    data[offset] = matches[0]
+    return Chunk(chunk.length, chunk.type, bytes(data), chunk.crc)
+
+
+@dataclass
+class ChunkRepair:
+    # (offset, xor mask) pairs, offsets are into the chunk type, data and CRC concatenated
+    flips: list[tuple[int, int]]
+
+    def apply(self, chunk: Chunk) -> Chunk:
+        raw = bytearray(chunk.type + chunk.data + struct.pack("!I", chunk.crc))
+        for offset, mask in self.flips:
+            raw[offset] ^= mask
+
+        (crc,) = struct.unpack("!I", raw[-4:])
+        return Chunk(chunk.length, bytes(raw[:4]), bytes(raw[4:-4]), crc)
+
+
+def _crc_syndrome(chunk: Chunk) -> int:
+    return binascii.crc32(chunk.data, binascii.crc32(chunk.type)) ^ chunk.crc
+
+
+def find_byte_repairs(chunk: Chunk) -> list[ChunkRepair]:
+    """Find every single corrupted byte which would explain a chunk's CRC mismatch."""
+    syndrome = _crc_syndrome(chunk)
+    if syndrome == 0:
+        return []
+
+    repairs = []
+
+    # a corrupted byte in the CRC itself only touches one byte of the syndrome
+    syndrome_bytes = struct.pack("!I", syndrome)
+    if sum(b != 0 for b in syndrome_bytes) == 1:
+        offset = next(i for i, b in enumerate(syndrome_bytes) if b != 0)
+        repairs.append(
+            ChunkRepair([(4 + len(chunk.data) + offset, syndrome_bytes[offset])])
+        )
+
+    # an error of d in the byte k from the end changes the CRC by zero_step^k(table[d]),
+    # so undo k steps from the syndrome and look for a table entry
+    payload_length = 4 + len(chunk.data)
+    unstepped = _gf2_orbit(_CRC32_ZERO_UNSTEP, np.uint32(syndrome), payload_length)
+    table_index = np.argsort(CRC32_TABLE)
+    positions = np.searchsorted(CRC32_TABLE[table_index], unstepped)
+    positions = np.minimum(positions, 255)
+    errors = table_index[positions]
+    for k in np.flatnonzero(CRC32_TABLE[errors] == unstepped):
+        repairs.append(ChunkRepair([(payload_length - 1 - int(k), int(errors[k]))]))
+
+    return repairs
+
+
+# the n bits of a chunk have about (8n)^2 / 2 pairs to match one of 2^32 CRC syndromes,
+# so past 8 KiB the two flip repairs are mostly chance and the search takes gigabytes
+MAX_TWO_FLIP_CHUNK_SIZE = 1 << 13
+# more matching repairs than this is no evidence for any one of them
+MAX_AMBIGUOUS_REPAIRS = 4
+
+
+def find_bitflip_repairs(
+    chunk: Chunk, max_flips: int = 2, max_two_flip_size: int = MAX_TWO_FLIP_CHUNK_SIZE
+) -> list[ChunkRepair]:
+    """Find every set of up to ``max_flips`` (1 or 2) bit flips which would explain a
+    chunk's CRC mismatch, including flips in the CRC itself.
+
+    Pairs of flips are only searched for when no single flip is the unique repair and
+    the chunk is no larger than ``max_two_flip_size``.
+    """
+    syndrome = _crc_syndrome(chunk)
+    if syndrome == 0:
+        return []
+
+    payload_length = 4 + len(chunk.data)
+    bits = np.uint32(1) << np.arange(8, dtype=np.uint32)
+
+    # syndrome of each single bit flip, the last byte of the payload first
+    syndromes = _gf2_orbit(_CRC32_ZERO_STEP, CRC32_TABLE[bits], payload_length)
+    syndromes = syndromes.ravel()
+
+    # a bit flip in the stored CRC changes the syndrome by just that bit
+    crc_bits = np.uint32(1) << np.arange(32, dtype=np.uint32)
+    syndromes = np.concatenate([syndromes, crc_bits])
+
+    def flip(i: int) -> tuple[int, int]:
+        """The offset and mask of the bit flip with the i-th syndrome."""
+        if i < 8 * payload_length:
+            return payload_length - 1 - i // 8, 1 << (i % 8)
+        i -= 8 * payload_length
+        return payload_length + 3 - i // 8, 1 << (i % 8)
+
+    repairs = [
+        ChunkRepair([flip(int(i))]) for i in np.flatnonzero(syndromes == syndrome)
+    ]
+
+    if len(repairs) == 1:
+        return repairs
+    if max_flips >= 2 and len(chunk.data) > max_two_flip_size:
+        LOGGER.warning(
+            "%s chunk is %d bytes, too large to search for pairs of bit flips",
+            chunk.type,
+            len(chunk.data),
+        )
+    elif max_flips >= 2:
+        _, partners, flips = np.intersect1d(
+            syndromes,
+            syndromes ^ np.uint32(syndrome),
+            assume_unique=True,
+            return_indices=True,
+        )
+        for i, j in zip(flips, partners):
+            if i < j:
+                repairs.append(ChunkRepair([flip(int(i)), flip(int(j))]))
+
+    return repairs
+
+
+def repair_chunk(
+    chunk: Chunk, find_repairs: Callable[[Chunk], list[ChunkRepair]]
+) -> Chunk:
+    if chunk.crc_valid():
+        return chunk
+    if chunk.truncated:
+        LOGGER.warning("Can't repair truncated %s chunk", chunk.type)
+        return chunk
+
+    repairs = find_repairs(chunk)
+    if not repairs:
+        LOGGER.warning("Found no repair for %s chunk", chunk.type)
+        return chunk
+
+    if len(repairs) > MAX_AMBIGUOUS_REPAIRS:
+        LOGGER.warning(
+            "%d repairs match the CRC of %s chunk, too many to choose one",
+            len(repairs),
+            chunk.type,
+        )
+        return chunk
+
+    for repair in repairs:
+        LOGGER.info("found repair for %s chunk: %s", chunk.type, repair.flips)
+
+    if len(repairs) > 1:
+        LOGGER.warning(
+            "%d repairs match the CRC of %s chunk, using the first: %s",
+            len(repairs),
+            chunk.type,
+            repairs[0].flips,
+        )
+
+    return repairs[0].apply(chunk)
+
+
 def randomise_plte(chunk: Chunk):
     new_chunk = Chunk(
         length=chunk.length,
@@ -202,123 +977,902 @@ def randomise_plte(chunk: Chunk):
     return new_chunk
 
 
-def parse_file_chunks(input_file: Reader[bytes]):
-    chunks = []
-    while (chunk := read_chunk(input_file)) is not None:
-        chunks.append(chunk)
-        if chunk.type == b"IEND":
-            break
+def parse_file_chunks(buf: memoryview, offset: int = 8):
+    chunks = list(iter_chunks(buf, offset))
+    if chunks and chunks[-1].truncated:
+        return chunks, buf[len(buf) :]
+    end = offset + sum(12 + chunk.length for chunk in chunks)
+    return chunks, buf[end:]
 
-    excess = input_file.read()
-    if len(excess) != 0:
-        try:
-            with open("excess", "wb") as f:
-                f.write(excess)
-            LOGGER.warning("Excess data detected and saved to ./excess")
-        except Exception as e:
-            LOGGER.warning("Excess data detected but failed to save", exc_info=e)
 
-    return chunks
+def parse_png(
+    input_file: Reader[bytes],
+) -> tuple[bytes, list[Chunk], memoryview]:
+    """Parse a PNG into its header, chunks and any excess data after the IEND chunk."""
+    buf = map_file(input_file)
+    header = read_header(buf)
+    chunks, excess = parse_file_chunks(buf)
+    return header, chunks, excess
 
 
-def parse_png(input_file: Reader[bytes]) -> tuple[bytes, list[Chunk]]:
-    header = read_header(input_file)
-    chunks = parse_file_chunks(input_file)
-    return header, chunks
+def save_png(output_file: Writer[bytes], header: bytes, chunks: list[Chunk]):
+    buffers = [header]
+    for chunk in chunks:
+        buffers += chunk.iovecs()
+
+    # gather the chunk bodies straight from the input mapping rather than joining them
+    try:
+        fd = output_file.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        fd = None
 
+    if fd is not None and hasattr(os, "writev"):
+        output_file.flush()
+        _writev_all(fd, buffers)
+    else:
+        for buffer in buffers:
+            output_file.write(buffer)
 
-def save_png(output_file: Writer[bytes], header: bytes, chunks: list[Chunk]):
-    write_header(output_file, header)
+    LOGGER.log(TRACE, "Wrote header: %s", header)
     for chunk in chunks:
-        write_chunk(output_file, chunk)
+        chunk.log(action="Wrote")
 
 
-def detect_excess_data(chunks: list[Chunk]):
-    try:
-        meta = PngMetadata.from_bytes(chunks[0].data)
-    except Exception as e:
-        LOGGER.exception("Invalid metadata chunk", exc_info=e)
-        return
+def save_png_file(path: str, header: bytes, chunks: list[Chunk]):
+    """Save a PNG to ``path`` by writing a temporary file and moving it into place.
 
+    The chunks can be views into the mapped input, which may be the file being
+    replaced, so it mustn't be truncated until they've all been written.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".png_fix-", suffix=".png")
     try:
-        compressed_data = b"".join(
-            chunk.data for chunk in chunks if chunk.type == b"IDAT"
-        )
-        data = zlib.decompress(compressed_data)
-    except Exception as e:
-        LOGGER.exception("Failed to decompress IDAT chunk data", exc_info=e)
-        return
+        with os.fdopen(fd, "wb") as f:
+            save_png(f, header, chunks)
+        try:
+            os.chmod(temp_path, os.stat(path).st_mode & 0o7777)
+        except FileNotFoundError:
+            os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+# largest piece of decompressed data to hold at once when not reading whole scanlines
+DECOMPRESS_READ_SIZE = 1 << 16
+
+
+class IdatStream:
+    """File-like reader over the decompressed contents of the IDAT chunks.
+
+    Data is inflated a chunk at a time and only as far as each read needs, so memory
+    stays bounded by the read size rather than the size of the image.
+    """
+
+    def __init__(self, chunks: list[Chunk]):
+        self._inputs = (chunk.data for chunk in chunks if chunk.type == b"IDAT")
+        self._decompressor = zlib.decompressobj()
+        self._pending: bytes | memoryview = b""
+        # decompressed bytes returned so far
+        self.position = 0
+        # compressed bytes consumed so far
+        self.consumed = 0
+        self.error: zlib.error | None = None
+
+    @property
+    def eof(self) -> bool:
+        return self._decompressor.eof
+
+    def read(self, size: int) -> bytes:
+        out = bytearray()
+        while len(out) < size and not self.eof and self.error is None:
+            if not self._pending:
+                # inflate can have output left over after consuming all of its input
+                if piece := self._decompressor.decompress(b"", size - len(out)):
+                    out += piece
+                    continue
+                if (pending := next(self._inputs, None)) is None:
+                    break
+                self._pending = pending
 
-    # compute the size in bits of each pixel in the scanline
-    match meta.bit_depth, meta.color_type:
+            try:
+                piece = self._decompressor.decompress(self._pending, size - len(out))
+            except zlib.error as e:
+                self.error = e
+                break
+
+            tail = self._decompressor.unconsumed_tail
+            self.consumed += len(self._pending) - len(tail)
+            self._pending = tail
+            out += piece
+
+        self.position += len(out)
+        return bytes(out)
+
+
+@dataclass
+class IdatReport:
+    decompressed_size: int = 0
+    expected_size: int | None = None
+    # complete scanlines read before the data ran out
+    scanlines: int = 0
+    bad_scanline: int | None = None
+    bad_offset: int | None = None
+    bad_filter: int | None = None
+    truncated: bool = False
+    error: str | None = None
+    error_offset: int | None = None
+
+
+def pixel_size_bits(bit_depth: int, color_type: int) -> int | None:
+    """Size in bits of each pixel, or None for an illegal combination."""
+    match bit_depth, color_type:
         case (1 | 2 | 4 | 8 | 16, ColorType.Greyscale):
-            pixel_size_bits = meta.bit_depth
+            return bit_depth
         case (8 | 16, ColorType.Truecolor):
-            pixel_size_bits = meta.bit_depth * 3
+            return bit_depth * 3
         case (1 | 2 | 4 | 8, ColorType.Indexed):
-            pixel_size_bits = meta.bit_depth
+            return bit_depth
         case (8 | 16, ColorType.GreyscaleAlpha):
-            pixel_size_bits = meta.bit_depth * 2
+            return bit_depth * 2
         case (8 | 16, ColorType.TruecolorAlpha):
-            pixel_size_bits = meta.bit_depth * 4
+            return bit_depth * 4
         case _:
-            LOGGER.error(
-                "Cannot check for excess data, header has illegal combination of bit_depth (%d) and color_type (%s)",
-                meta.bit_depth,
-                meta.color_type,
-            )
-            return
+            return None
+
+
+# (x offset, y offset, x step, y step) of each Adam7 pass
+ADAM7_PASSES = [
+    (0, 0, 8, 8),
+    (4, 0, 8, 8),
+    (0, 4, 4, 8),
+    (2, 0, 4, 4),
+    (0, 2, 2, 4),
+    (1, 0, 2, 2),
+    (0, 1, 1, 2),
+]
+
 
-    # 1 for the filter byte
-    if meta.interlace_method == 0:
-        scanline_size_bytes = 1 + (pixel_size_bits * meta.width + 7) // 8
-        calc_data_size = scanline_size_bytes * meta.height
+def adam7_pass_dimensions(width: int, height: int) -> list[tuple[int, int]]:
+    return [
+        (
+            (width - x0 + dx - 1) // dx if width > x0 else 0,
+            (height - y0 + dy - 1) // dy if height > y0 else 0,
+        )
+        for x0, y0, dx, dy in ADAM7_PASSES
+    ]
+
+
+def scanline_layout(
+    width: int, height: int, interlace_method: int, pixel_bits: int
+) -> list[tuple[int, int]]:
+    """Number of scanlines and the size of each, including the filter byte, per pass of the image."""
+    if interlace_method == InterlaceMethod.Null:
+        passes = [(width, height)]
     else:
-        # fml I guess this is where I finally understand adam7
-        adam7 = [
-            [1, 6, 4, 6, 2, 6, 4, 6],
-            [7, 7, 7, 7, 7, 7, 7, 7],
-            [5, 6, 5, 6, 5, 6, 5, 6],
-            [7, 7, 7, 7, 7, 7, 7, 7],
-            [3, 6, 4, 6, 3, 6, 4, 6],
-            [7, 7, 7, 7, 7, 7, 7, 7],
-            [5, 6, 5, 6, 5, 6, 5, 6],
-            [7, 7, 7, 7, 7, 7, 7, 7],
-        ]
+        passes = adam7_pass_dimensions(width, height)
 
-        calc_data_size = 0
-        for y in range(meta.height):
-            num_px_in_scanline = {i:0 for i in range(1, 8)}
-            for x in range(meta.width):
-                adam7_pass = adam7[y % 8][x % 8]
-                num_px_in_scanline[adam7_pass] += 1
+    # empty passes have no scanlines at all, not even filter bytes
+    return [
+        (pass_height, 1 + (pixel_bits * pass_width + 7) // 8)
+        for pass_width, pass_height in passes
+        if pass_width != 0 and pass_height != 0
+    ]
 
-            # add on the size of each scanline for this row
-            for num_px in num_px_in_scanline.values():
-                if num_px == 0:
-                    continue
 
-                calc_data_size += 1 + (num_px * pixel_size_bits + 7) // 8
+def layout_size(layout: list[tuple[int, int]]) -> int:
+    return sum(rows * row_size for rows, row_size in layout)
+
+
+MAX_PNG_DIMENSION = (1 << 31) - 1
+
+
+def _solve_monotonic(
+    f: Callable[[int], int], target: int, hi: int = MAX_PNG_DIMENSION
+) -> tuple[int, int] | None:
+    """Find the range of x in [1, hi] where the non-decreasing function f(x) == target."""
+
+    def first_at_least(value: int) -> int:
+        lo_x, hi_x = 1, hi + 1
+        while lo_x < hi_x:
+            mid = (lo_x + hi_x) // 2
+            if f(mid) < value:
+                lo_x = mid + 1
+            else:
+                hi_x = mid
+        return lo_x
+
+    start = first_at_least(target)
+    if start > hi or f(start) != target:
+        return None
+    return start, first_at_least(target + 1) - 1
 
-    if len(data) < calc_data_size:
+
+def check_scanlines(stream: IdatStream, report: IdatReport, rows: int, row_size: int):
+    """Read ``rows`` scanlines from the stream, checking each filter byte as it arrives."""
+    for _ in range(rows):
+        scanline = stream.read(row_size)
+        if len(scanline) < row_size:
+            return
+
+        if scanline[0] > 4 and report.bad_scanline is None:
+            # scanlines are numbered across every pass of an interlaced image
+            report.bad_scanline = report.scanlines
+            report.bad_offset = stream.position - row_size
+            report.bad_filter = scanline[0]
+            LOGGER.warning(
+                "Invalid filter type %d on scanline %d, at offset %d of the decompressed data",
+                report.bad_filter,
+                report.bad_scanline,
+                report.bad_offset,
+            )
+
+        report.scanlines += 1
+
+
+def detect_excess_data(chunks: list[Chunk]) -> IdatReport | None:
+    try:
+        meta = PngMetadata.from_bytes(chunks[0].data)
+    except Exception as e:
+        LOGGER.exception("Invalid metadata chunk", exc_info=e)
+        return
+
+    # compute the size in bits of each pixel in the scanline
+    if (pixel_bits := pixel_size_bits(meta.bit_depth, meta.color_type)) is None:
+        LOGGER.error(
+            "Cannot check for excess data, header has illegal combination of bit_depth (%d) and color_type (%s)",
+            meta.bit_depth,
+            meta.color_type,
+        )
+        return
+
+    layout = scanline_layout(meta.width, meta.height, meta.interlace_method, pixel_bits)
+    calc_data_size = layout_size(layout)
+
+    report = IdatReport(expected_size=calc_data_size)
+    stream = IdatStream(chunks)
+    for rows, row_size in layout:
+        check_scanlines(stream, report, rows, row_size)
+
+    # count whatever is left over without holding onto it
+    while stream.read(DECOMPRESS_READ_SIZE):
+        pass
+    report.decompressed_size = stream.position
+
+    if stream.error is not None:
+        report.error = str(stream.error)
+        report.error_offset = stream.consumed
+        LOGGER.warning(
+            "Failed to decompress IDAT chunk data after %d compressed bytes: %s",
+            stream.consumed,
+            stream.error,
+        )
+    elif not stream.eof:
+        report.truncated = True
+        LOGGER.warning(
+            "IDAT data is truncated, recovered %d bytes (%d complete scanlines)",
+            report.decompressed_size,
+            report.scanlines,
+        )
+
+    data_size = report.decompressed_size
+    if data_size < calc_data_size:
         LOGGER.warning("There is less data in the IDAT chunks than expected")
-    elif len(data) > calc_data_size:
+    elif data_size > calc_data_size:
         LOGGER.warning("There is more data in the IDAT chunks than expected")
     else:
-        return
+        return report
 
-    LOGGER.warning("len(data) = %d, calc_data_size = %d", len(data), calc_data_size)
+    LOGGER.warning("len(data) = %d, calc_data_size = %d", data_size, calc_data_size)
 
-    if meta.interlace_method == 1:
-        return
+    if report.truncated or report.error is not None:
+        return report
 
-    if len(data) % scanline_size_bytes != 0:
-        LOGGER.warning("Scanline size does not divide data size, width probably wrong")
+    def size_with(width: int, height: int) -> int:
+        return layout_size(
+            scanline_layout(width, height, meta.interlace_method, pixel_bits)
+        )
+
+    heights = _solve_monotonic(lambda h: size_with(meta.width, h), data_size)
+    if heights is None:
+        LOGGER.warning("No height fits the data size, width probably wrong")
+        if (
+            widths := _solve_monotonic(lambda w: size_with(w, meta.height), data_size)
+        ) is not None:
+            LOGGER.warning("Widths which fit the data size: %d to %d", *widths)
     else:
-        LOGGER.warning(
-            "Scanline size divides data size, correct height: %d",
-            len(data) // scanline_size_bytes,
+        LOGGER.warning("Data size fits the width, correct height: %d", heights[0])
+
+    return report
+
+
+def read_idat(chunks: list[Chunk]) -> bytes:
+    """Decompress all of the IDAT data, or as much of it as can be recovered."""
+    stream = IdatStream(chunks)
+    data = bytearray()
+    while piece := stream.read(DECOMPRESS_READ_SIZE):
+        data += piece
+    return bytes(data)
+
+
+# every legal (bit_depth, color_type) combination
+PIXEL_FORMATS = [
+    (bit_depth, color_type)
+    for color_type in ColorType
+    for bit_depth in (1, 2, 4, 8, 16)
+    if pixel_size_bits(bit_depth, color_type) is not None
+]
+
+
+INFERRED_DIMENSIONS_SHOWN = 20
+
+
+@dataclass
+class DimensionCandidate:
+    width: int
+    height: int
+    bit_depth: int
+    color_type: ColorType
+    interlace_method: InterlaceMethod
+    scanlines: int
+    valid_filters: int
+
+    @property
+    def score(self) -> float:
+        return self.valid_filters / self.scanlines
+
+
+def _width_range(row_bytes: int, pixel_bits: int, max_width: int) -> range:
+    # widths whose scanlines (without the filter byte) are exactly row_bytes long
+    return range(
+        max((row_bytes - 1) * 8 // pixel_bits + 1, 1),
+        min(row_bytes * 8 // pixel_bits, max_width) + 1,
+    )
+
+
+def _non_interlaced_dimensions(
+    data_size: int, pixel_bits: int, max_width: int, max_height: int
+):
+    # every scanline is the same size, so the height must divide the data size
+    divisors = np.arange(1, math.isqrt(data_size) + 1)
+    divisors = divisors[data_size % divisors == 0]
+    heights = np.unique(np.concatenate([divisors, data_size // divisors]))
+
+    for height in heights[heights <= max_height].tolist():
+        row_bytes = data_size // height - 1
+        for width in _width_range(row_bytes, pixel_bits, max_width):
+            yield width, height
+
+
+def _interlaced_sizes(widths: np.ndarray, heights: np.ndarray, pixel_bits: int):
+    total = np.zeros(np.broadcast(widths, heights).shape, dtype=np.int64)
+    for x0, y0, dx, dy in ADAM7_PASSES:
+        pass_widths = (widths - x0 + dx - 1) // dx
+        pass_heights = (heights - y0 + dy - 1) // dy
+        total += np.where(
+            (pass_widths > 0) & (pass_heights > 0),
+            pass_heights * (1 + (pass_widths * pixel_bits + 7) // 8),
+            0,
         )
+    return total
+
+
+def _interlaced_dimensions(
+    data_size: int, pixel_bits: int, max_width: int, max_height: int
+):
+    # the size only grows with the width, so binary search it for every height at once
+    heights = np.arange(1, min(max_height, data_size) + 1, dtype=np.int64)
+
+    def first_width_reaching(size: int) -> np.ndarray:
+        lo = np.ones_like(heights)
+        hi = np.full_like(heights, max_width + 1)
+        while np.any(lo < hi):
+            mid = (lo + hi) // 2
+            below = _interlaced_sizes(mid, heights, pixel_bits) < size
+            lo = np.where(below & (lo < hi), mid + 1, lo)
+            hi = np.where(below | (lo >= hi), hi, mid)
+        return lo
+
+    first = first_width_reaching(data_size)
+    last = first_width_reaching(data_size + 1) - 1
+    fits = (first <= max_width) & (
+        _interlaced_sizes(np.minimum(first, max_width), heights, pixel_bits)
+        == data_size
+    )
+    for height, start, end in zip(heights[fits], first[fits], last[fits]):
+        for width in range(int(start), int(end) + 1):
+            yield width, int(height)
+
+
+def _filter_byte_offsets(layout: list[tuple[int, int]]) -> np.ndarray:
+    offsets = []
+    start = 0
+    for rows, row_size in layout:
+        offsets.append(start + np.arange(rows, dtype=np.int64) * row_size)
+        start += rows * row_size
+    return np.concatenate(offsets) if offsets else np.zeros(0, dtype=np.int64)
+
+
+def infer_dimensions(
+    data: bytes,
+    max_width: int = MAX_BRUTEFORCE_DIMENSION,
+    max_height: int = MAX_BRUTEFORCE_DIMENSION,
+    pixel_formats: list[tuple[int, int]] = PIXEL_FORMATS,
+    interlace_methods: list[InterlaceMethod] = list(InterlaceMethod),
+) -> list[DimensionCandidate]:
+    """Find every image layout whose size matches the decompressed IDAT data.
+
+    Candidates are ranked by the fraction of their scanlines which start with a valid
+    filter type (0-4), which is almost always every scanline for the right layout.
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    valid = buf <= 4
+
+    by_pixel_bits: dict[int, list[tuple[int, int]]] = {}
+    for bit_depth, color_type in pixel_formats:
+        pixel_bits = pixel_size_bits(bit_depth, color_type)
+        by_pixel_bits.setdefault(pixel_bits, []).append((bit_depth, color_type))
+
+    candidates = []
+    for pixel_bits, formats in by_pixel_bits.items():
+        for interlace_method in interlace_methods:
+            if interlace_method == InterlaceMethod.Null:
+                dimensions = _non_interlaced_dimensions(
+                    len(data), pixel_bits, max_width, max_height
+                )
+            else:
+                dimensions = _interlaced_dimensions(
+                    len(data), pixel_bits, max_width, max_height
+                )
+
+            for width, height in dimensions:
+                offsets = _filter_byte_offsets(
+                    scanline_layout(width, height, interlace_method, pixel_bits)
+                )
+                valid_filters = int(np.count_nonzero(valid[offsets]))
+                for bit_depth, color_type in formats:
+                    candidates.append(
+                        DimensionCandidate(
+                            width=width,
+                            height=height,
+                            bit_depth=bit_depth,
+                            color_type=ColorType(color_type),
+                            interlace_method=InterlaceMethod(interlace_method),
+                            scanlines=len(offsets),
+                            valid_filters=valid_filters,
+                        )
+                    )
+
+    # a few scanlines can start with valid filter types by chance, so favour more of them
+    candidates.sort(
+        key=lambda candidate: (candidate.score, candidate.scanlines), reverse=True
+    )
+    return candidates
+
+
+CHANNELS = {
+    ColorType.Greyscale: 1,
+    ColorType.Truecolor: 3,
+    ColorType.Indexed: 1,
+    ColorType.GreyscaleAlpha: 2,
+    ColorType.TruecolorAlpha: 4,
+}
+
+
+def unfilter_scanline(
+    filter_type: int, row: np.ndarray, prior: np.ndarray, bpp: int
+) -> np.ndarray:
+    """Undo the None, Sub or Up filter of a scanline, which vectorize along the row."""
+    match filter_type:
+        case 0:
+            return row
+        case 1:
+            # Sub is a running sum of every bpp-th byte, which wraps in uint8
+            return np.cumsum(row.reshape(-1, bpp), axis=0, dtype=np.uint8).ravel()
+        case 2:
+            return row + prior
+        case _:
+            raise ValueError(f"Invalid filter type {filter_type}")
+
+
+# the fewest rows to unfilter together along anti-diagonals
+MIN_WAVEFRONT_ROWS = 64
+
+
+def _unfilter_wavefront(
+    filters: np.ndarray, rows: np.ndarray, prior: np.ndarray, bpp: int
+) -> np.ndarray:
+    """Unfilter scanlines of any filter type, an anti-diagonal of pixels at a time.
+
+    Average and Paeth depend on the pixel decoded to the left, so they can't be done a
+    row at a time with array ops. A pixel only depends on the pixels to its left, above
+    and above left though, which are all on earlier anti-diagonals, so every pixel of
+    an anti-diagonal can be unfiltered at once, across all of the rows and channels.
+    """
+    height, row_bytes = rows.shape
+    width = row_bytes // bpp
+
+    # skewed[x + y, y] is pixel (x, y), so each anti-diagonal is contiguous
+    skewed = np.zeros((width + height - 1, height, bpp), dtype=np.uint8)
+    pixels = rows.reshape(height, width, bpp)
+    for y in range(height):
+        skewed[y : y + width, y] = pixels[y]
+
+    kinds = filters[:, None]
+    is_sub, is_up, is_average, is_paeth = (
+        (kinds == kind).astype(np.int16) for kind in range(1, 5)
+    )
+    average, paeth = is_average.any(), is_paeth.any()
+
+    prior = prior.reshape(width, bpp).astype(np.int16)
+    # the last two anti-diagonals by y + 1, the first entry being the pixel above row 0
+    # and anything past the end of a diagonal being the zeroes left of column 0
+    last = np.zeros((height + 1, bpp), dtype=np.int16)
+    before = np.zeros((height + 1, bpp), dtype=np.int16)
+    for d in range(width + height - 1):
+        lo, hi = max(0, d - width + 1), min(height, d + 1)
+        if lo == 0:
+            last[0] = prior[d] if d < width else 0
+            before[0] = prior[d - 1] if 0 < d <= width else 0
+
+        # left, above and above left
+        a = last[lo + 1 : hi + 1]
+        b = last[lo:hi]
+        c = before[lo:hi]
+        predictor = a * is_sub[lo:hi] + b * is_up[lo:hi]
+        if average:
+            predictor += ((a + b) >> 1) * is_average[lo:hi]
+        if paeth:
+            pa = np.abs(b - c)
+            pb = np.abs(a - c)
+            pc = np.abs(a + b - 2 * c)
+            nearest = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+            predictor += nearest * is_paeth[lo:hi]
+
+        diagonal = skewed[d, lo:hi]
+        value = (diagonal + predictor) & 0xFF
+        diagonal[...] = value
+        # the oldest diagonal is finished with, so it becomes the newest
+        before[lo + 1 : hi + 1] = value
+        before, last = last, before
+
+    out = np.empty_like(pixels)
+    for y in range(height):
+        out[y] = skewed[y : y + width, y]
+    return out.reshape(height, row_bytes)
+
+
+def unfilter_scanlines(scanlines: np.ndarray, bpp: int) -> np.ndarray:
+    """Undo the filters of a pass's scanlines, each prefixed by its filter type."""
+    filters = scanlines[:, 0]
+    if (invalid := filters[filters > 4]).size:
+        raise ValueError(f"Invalid filter type {invalid[0]}")
+
+    rows = np.empty((len(scanlines), scanlines.shape[1] - 1), dtype=np.uint8)
+    prior = np.zeros(rows.shape[1], dtype=np.uint8)
+
+    # rows before the first Average or Paeth filter can be done a row at a time
+    serial = np.flatnonzero(filters >= 3)
+    split = serial[0] if len(serial) else len(rows)
+    for y in range(split):
+        prior = rows[y] = unfilter_scanline(filters[y], scanlines[y, 1:], prior, bpp)
+
+    # the rest in bands, so the skewed copy stays within twice their size
+    band = max(rows.shape[1] // bpp, MIN_WAVEFRONT_ROWS)
+    for start in range(split, len(rows), band):
+        end = start + band
+        rows[start:end] = _unfilter_wavefront(
+            filters[start:end], scanlines[start:end, 1:], prior, bpp
+        )
+        prior = rows[min(end, len(rows)) - 1]
+
+    return rows
+
+
+def _unpack_samples(
+    rows: np.ndarray, width: int, bit_depth: int, channels: int
+) -> np.ndarray:
+    """Split unfiltered scanlines into a (rows, width, channels) array of samples."""
+    if bit_depth == 16:
+        samples = rows.view(">u2").astype(np.uint16)
+    elif bit_depth == 8:
+        samples = rows
+    else:
+        shifts = np.arange(8 - bit_depth, -1, -bit_depth, dtype=np.uint8)
+        samples = (rows[:, :, None] >> shifts) & ((1 << bit_depth) - 1)
+        samples = samples.reshape(len(rows), -1)
+
+    return samples[:, : width * channels].reshape(len(rows), width, channels)
+
+
+def decode_image(
+    width: int,
+    height: int,
+    bit_depth: int,
+    color_type: int,
+    interlace_method: int,
+    data: bytes,
+) -> np.ndarray:
+    """Decode decompressed IDAT data into a (height, width, channels) array of samples.
+
+    Missing data, e.g. from a truncated file, leaves the rest of the image zeroed.
+    """
+    pixel_bits = pixel_size_bits(bit_depth, color_type)
+    if pixel_bits is None:
+        raise ValueError(
+            f"Illegal combination of bit_depth ({bit_depth}) and color_type ({color_type})"
+        )
+
+    channels = CHANNELS[ColorType(color_type)]
+    bpp = max(pixel_bits // 8, 1)
+    image = np.zeros(
+        (height, width, channels), dtype=np.uint16 if bit_depth == 16 else np.uint8
+    )
+
+    if interlace_method == InterlaceMethod.Null:
+        passes = [(0, 0, 1, 1, width, height)]
+    else:
+        passes = [
+            (*adam7_pass, pass_width, pass_height)
+            for adam7_pass, (pass_width, pass_height) in zip(
+                ADAM7_PASSES, adam7_pass_dimensions(width, height)
+            )
+        ]
+
+    buf = np.frombuffer(data, dtype=np.uint8)
+    offset = 0
+    for x0, y0, dx, dy, pass_width, pass_height in passes:
+        if pass_width == 0 or pass_height == 0:
+            continue
+
+        row_size = 1 + (pixel_bits * pass_width + 7) // 8
+        available = min(pass_height, (len(buf) - offset) // row_size)
+        scanlines = buf[offset : offset + available * row_size].reshape(-1, row_size)
+        offset += pass_height * row_size
+
+        rows = unfilter_scanlines(scanlines, bpp)
+        samples = _unpack_samples(rows, pass_width, bit_depth, channels)
+        image[y0::dy, x0::dx][:available] = samples
+
+        if available < pass_height:
+            LOGGER.warning("Image data ran out after %d scanlines of a pass", available)
+            break
+
+    return image
+
+
+def smoothness_score(image: np.ndarray, bit_depth: int = 8) -> float:
+    """Mean difference between adjacent pixels, as a fraction of the sample range.
+
+    Real images change gradually from row to row and from pixel to pixel, so the right
+    layout scores lowest. Comparing neighbours within a row is what tells apart pixel
+    formats which split the data into the same rows.
+    """
+    if len(image) < 2:
+        # there's nothing to compare, so it's no evidence for the layout
+        return math.inf
+
+    scale = (1 << bit_depth) - 1
+    samples = image.astype(np.int32)
+    diffs = [np.abs(np.diff(samples, axis=0)).mean()]
+    if samples.shape[1] > 1:
+        diffs.append(np.abs(np.diff(samples, axis=1)).mean())
+    return float(np.mean(diffs)) / scale
+
+
+def distinct_layouts(candidates: list[DimensionCandidate]) -> list[DimensionCandidate]:
+    """The first candidate of every distinct scanline layout worth decoding.
+
+    Pixel formats with the same number of bits per pixel split the data into the same
+    scanlines, so they're all as plausible as each other and only the first is kept.
+    Single row layouts can't be scored, so they're dropped.
+    """
+    seen = set()
+    layouts = []
+    for candidate in candidates:
+        if candidate.height < 2:
+            continue
+        key = (
+            candidate.width,
+            candidate.height,
+            pixel_size_bits(candidate.bit_depth, candidate.color_type),
+            candidate.interlace_method,
+        )
+        if key not in seen:
+            seen.add(key)
+            layouts.append(candidate)
+    return layouts
+
+
+def rank_decoded_dimensions(
+    data: bytes, candidates: list[DimensionCandidate]
+) -> list[tuple[float, DimensionCandidate]]:
+    """Decode each candidate layout and rank them by smoothness, smoothest first."""
+    ranked = []
+    for candidate in candidates:
+        try:
+            image = decode_image(
+                candidate.width,
+                candidate.height,
+                candidate.bit_depth,
+                candidate.color_type,
+                candidate.interlace_method,
+                data,
+            )
+        except ValueError:
+            continue
+        ranked.append((smoothness_score(image, candidate.bit_depth), candidate))
+
+    ranked.sort(key=lambda scored: scored[0])
+    return ranked
+
+
+VGA_PALETTE = [
+    (0x00, 0x00, 0x00),
+    (0x00, 0x00, 0xAA),
+    (0x00, 0xAA, 0x00),
+    (0x00, 0xAA, 0xAA),
+    (0xAA, 0x00, 0x00),
+    (0xAA, 0x00, 0xAA),
+    (0xAA, 0x55, 0x00),
+    (0xAA, 0xAA, 0xAA),
+    (0x55, 0x55, 0x55),
+    (0x55, 0x55, 0xFF),
+    (0x55, 0xFF, 0x55),
+    (0x55, 0xFF, 0xFF),
+    (0xFF, 0x55, 0x55),
+    (0xFF, 0x55, 0xFF),
+    (0xFF, 0xFF, 0x55),
+    (0xFF, 0xFF, 0xFF),
+]
+
+WEB_SAFE_PALETTE = list(it.product(range(0, 256, 51), repeat=3))
+
+XTERM_PALETTE = (
+    VGA_PALETTE
+    + list(it.product((0, 95, 135, 175, 215, 255), repeat=3))
+    + [(v, v, v) for v in range(8, 248, 10)]
+)
+
+KNOWN_PALETTES = {
+    "vga": VGA_PALETTE,
+    "web-safe": WEB_SAFE_PALETTE,
+    "xterm": XTERM_PALETTE,
+}
+
+# how many candidate palettes to score at once
+PALETTE_BATCH_SIZE = 64
+
+
+def _ramp(entries: int) -> np.ndarray:
+    levels = np.linspace(0, 255, entries).round().astype(np.uint8)
+    return np.repeat(levels[:, None], 3, axis=1)
+
+
+def palette_candidates(
+    histogram: np.ndarray, random_palettes: int, rng: np.random.Generator
+) -> list[tuple[str, np.ndarray]]:
+    """Generate candidate (entries, 3) palettes for an image with the given index histogram."""
+    entries = len(histogram)
+    ramp = _ramp(entries)
+    candidates = [("grey", ramp), ("grey-inverted", ramp[::-1])]
+    candidates += [
+        (name, np.resize(np.array(palette, dtype=np.uint8), (entries, 3)))
+        for name, palette in KNOWN_PALETTES.items()
+    ]
+
+    # hand out the colours of each palette in order of how common each index is
+    by_frequency = np.argsort(-histogram, kind="stable")
+    for name, palette in list(candidates):
+        sorted_palette = np.empty_like(palette)
+        sorted_palette[by_frequency] = palette
+        candidates.append((f"{name}-by-frequency", sorted_palette))
+
+    # the most common index is often the background behind text
+    for name, background, foreground in (
+        ("black-on-white", 255, 0),
+        ("white-on-black", 0, 255),
+    ):
+        palette = np.full((entries, 3), foreground, dtype=np.uint8)
+        palette[by_frequency[0]] = background
+        candidates.append((name, palette))
+
+    candidates += [
+        (f"random-{i}", rng.integers(0, 256, (entries, 3), dtype=np.uint8))
+        for i in range(random_palettes)
+    ]
+    return candidates
+
+
+def score_palettes(
+    palettes: np.ndarray, histogram: np.ndarray, neighbours: np.ndarray
+) -> np.ndarray:
+    """Score a (K, entries, 3) batch of palettes for an image, higher is better.
+
+    The score is how much more the brightness differs between random pixels than between
+    neighbouring ones: high contrast which forms structure rather than noise. Rendering
+    each palette is a lookup of the index array, so these statistics come straight from
+    counts of indices and of neighbouring index pairs, without touching the pixels.
+    """
+    instrumentation.count("palettes scored", len(palettes))
+    luma = palettes.astype(np.float32) @ np.array([0.299, 0.587, 0.114], np.float32)
+    differences = np.abs(luma[:, :, None] - luma[:, None, :])
+
+    frequencies = histogram / max(histogram.sum(), 1)
+    random_pairs = np.outer(frequencies, frequencies)
+    neighbour_pairs = neighbours / max(neighbours.sum(), 1)
+
+    return ((random_pairs - neighbour_pairs) * differences).sum(axis=(1, 2))
+
+
+def decode_indices(chunks: list[Chunk]) -> np.ndarray:
+    meta = PngMetadata.from_bytes(chunks[0].data)
+    if meta.color_type != ColorType.Indexed:
+        raise ValueError(f"Image is not indexed, color_type is {meta.color_type}")
+
+    image = decode_image(
+        meta.width,
+        meta.height,
+        meta.bit_depth,
+        meta.color_type,
+        meta.interlace_method,
+        read_idat(chunks),
+    )
+    return image[:, :, 0]
+
+
+def search_plte(
+    chunks: list[Chunk], top_k: int, random_palettes: int = 256
+) -> list[tuple[float, str, Chunk]]:
+    """Find the top_k best scoring palettes for an indexed image, as PLTE chunks."""
+    meta = PngMetadata.from_bytes(chunks[0].data)
+    plte = next((chunk for chunk in chunks if chunk.type == b"PLTE"), None)
+    entries = plte.length // 3 if plte is not None else 1 << meta.bit_depth
+
+    # decode once, every palette is then just a different view of the same indices
+    indices = np.minimum(decode_indices(chunks), entries - 1).astype(np.int64)
+    histogram = np.bincount(indices.ravel(), minlength=entries)
+    neighbours = np.bincount(
+        np.concatenate(
+            [
+                (indices[:, :-1] * entries + indices[:, 1:]).ravel(),
+                (indices[:-1, :] * entries + indices[1:, :]).ravel(),
+            ]
+        ),
+        minlength=entries * entries,
+    ).reshape(entries, entries)
+
+    candidates = palette_candidates(histogram, random_palettes, np.random.default_rng())
+    palettes = np.stack([palette for _, palette in candidates])
+    scores = np.concatenate(
+        [
+            score_palettes(
+                palettes[start : start + PALETTE_BATCH_SIZE], histogram, neighbours
+            )
+            for start in range(0, len(palettes), PALETTE_BATCH_SIZE)
+        ]
+    )
+    LOGGER.info("Scored %d candidate palettes", len(candidates))
+
+    best = []
+    for i in np.argsort(-scores, kind="stable")[:top_k]:
+        name, palette = candidates[i]
+        chunk = Chunk(entries * 3, b"PLTE", palette.tobytes())
+        chunk.recalc_crc()
+        best.append((float(scores[i]), name, chunk))
+    return best
+
+
+def replace_plte(chunks: list[Chunk], plte: Chunk) -> list[Chunk]:
+    if any(chunk.type == b"PLTE" for chunk in chunks):
+        return [plte if chunk.type == b"PLTE" else chunk for chunk in chunks]
+
+    # PLTE has to come before the first IDAT chunk
+    first_idat = next(
+        (i for i, chunk in enumerate(chunks) if chunk.type == b"IDAT"), len(chunks)
+    )
+    return chunks[:first_idat] + [plte] + chunks[first_idat:]
 
 
 def argument_parser() -> ArgumentParser:
@@ -326,16 +1880,106 @@ def argument_parser() -> ArgumentParser:
 
     parser.add_argument("--input-file")
     parser.add_argument("--output-file", required=False)
+    parser.add_argument(
+        "--excess-file",
+        default="excess",
+        help="Where to save any data found after the IEND chunk.",
+    )
+    parser.add_argument(
+        "--batch",
+        nargs="+",
+        metavar="PATH",
+        help="Process every file in these directories / globs across --jobs processes.",
+    )
+    parser.add_argument(
+        "--output-dir",
+        required=False,
+        help="Where --batch writes repaired files, and their excess data as <name>.excess",
+    )
+    parser.add_argument(
+        "--report",
+        required=False,
+        help="Write a JSON Lines report of each file processed, - for stdout. --batch defaults to stdout.",
+    )
     parser.add_argument(
         "--fix-ihdr",
         action="store_true",
-        help="Brute force values to find the right dimensions for the image, using the CRC to verify the chunk data.",
+        help="Solve for the dimensions of the image which match the CRC of the IHDR chunk.",
+    )
+    parser.add_argument(
+        "--max-width",
+        type=int,
+        default=MAX_BRUTEFORCE_DIMENSION,
+        help="Largest width to consider with --fix-ihdr.",
+    )
+    parser.add_argument(
+        "--max-height",
+        type=int,
+        default=MAX_BRUTEFORCE_DIMENSION,
+        help="Largest height to consider with --fix-ihdr.",
+    )
+    parser.add_argument(
+        "--max-matches",
+        type=int,
+        default=MAX_DIMENSION_MATCHES,
+        help="Stop the --fix-ihdr search after this many dimensions match the CRC.",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of processes to split the --fix-ihdr search, or --batch files, across.",
+    )
+    parser.add_argument(
+        "--prior",
+        choices=["area", "aspect"],
+        required=False,
+        help="Search --fix-ihdr candidates by smallest area, or closest to --aspect-ratio, first.",
+    )
+    parser.add_argument(
+        "--aspect-ratio",
+        default="1:1",
+        help="Expected width:height ratio for --prior aspect, e.g. 16:9",
+    )
+    parser.add_argument(
+        "--first-match",
+        action="store_true",
+        help="Stop the --fix-ihdr search as soon as any worker finds a match.",
+    )
+    parser.add_argument(
+        "--fix-ihdr-field",
+        choices=list(IHDR_FIELD_OFFSETS),
+        required=False,
+        help="Brute force a single byte field of the IHDR chunk using its CRC.",
+    )
+    parser.add_argument(
+        "--fix-chunk-bitflip",
+        action="store_true",
+        help="Find 1-2 flipped bits in any chunk whose CRC doesn't match.",
+    )
+    parser.add_argument(
+        "--fix-chunk-byte",
+        action="store_true",
+        help="Find a single corrupted byte in any chunk whose CRC doesn't match.",
     )
     parser.add_argument(
         "--rand-plte",
         action="store_true",
         help="Insert random data into the PLTE chunk if one exists.",
     )
+    parser.add_argument(
+        "--search-plte",
+        type=int,
+        metavar="K",
+        required=False,
+        help="Score many candidate palettes for an indexed image and save the top K, as <output>.plte<rank>.png",
+    )
+    parser.add_argument(
+        "--random-palettes",
+        type=int,
+        default=256,
+        help="Number of random palettes to include in --search-plte.",
+    )
     parser.add_argument(
         "--fix-crc", action="store_true", help="Correct the CRC32 for every chunk"
     )
@@ -346,10 +1990,319 @@ def argument_parser() -> ArgumentParser:
         help="Change a PNG metadata property, e.g. --set height=1200",
     )
     parser.add_argument("--print-metadata", required=False, action="store_true")
+    parser.add_argument(
+        "--infer-dimensions",
+        action="store_true",
+        help="List the image layouts which fit the decompressed IDAT data, best first.",
+    )
+    parser.add_argument(
+        "--rank-dimensions",
+        type=int,
+        metavar="N",
+        required=False,
+        help="Decode every distinct inferred image layout and show the N smoothest.",
+    )
+    parser.add_argument(
+        "--decode",
+        metavar="NPY_FILE",
+        required=False,
+        help="Decode the (repaired) image and save its samples as a NumPy array.",
+    )
+
+    parser.add_argument(
+        "--stats",
+        choices=["text", "json"],
+        required=False,
+        help="Report the time spent in each stage and counters on exit, also enabled by the STATS environment variable.",
+    )
+    parser.add_argument(
+        "--stats-file",
+        required=False,
+        help="Where to write the --stats report, stderr by default.",
+    )
 
     return parser
 
 
+def needs_chunks(args: Namespace, output_path: str | None) -> bool:
+    """Whether any of the requested operations need more than the file's metadata."""
+    return bool(
+        output_path
+        or args.infer_dimensions
+        or args.rank_dimensions
+        or args.decode
+        or args.set
+        or args.fix_chunk_bitflip
+        or args.fix_chunk_byte
+        or args.fix_ihdr_field
+        or args.fix_ihdr
+        or args.rand_plte
+        or args.search_plte
+        or args.fix_crc
+    )
+
+
+@contextmanager
+def timed(timings: dict[str, float], name: str):
+    """Time a stage of processing a file, for both its report and the stats."""
+    start = time.perf_counter()
+    with instrumentation.stage(name):
+        yield
+    timings[name] = time.perf_counter() - start
+
+
+def process_file(
+    args: Namespace,
+    input_path: str,
+    output_path: str | None,
+    excess_path: str | None,
+    jobs: int = 1,
+) -> dict[str, Any]:
+    """Parse, validate and repair a single PNG, returning a report of what was found."""
+    report: dict[str, Any] = {"input_file": input_path, "output_file": output_path}
+    timings = report["timings"] = {}
+    # in batch mode stdout is the JSON Lines report, so keep it to the reports
+    output = sys.stderr if args.batch else sys.stdout
+
+    if args.print_metadata and not needs_chunks(args, output_path):
+        # nothing else was asked for, so skip the CRC checks and IDAT decompression
+        with timed(timings, "parse"), open(input_path, "rb", buffering=0) as input_file:
+            meta = read_metadata(input_file)
+        print(meta, file=output)
+        report["metadata"] = asdict(meta)
+        return report
+
+    with timed(timings, "parse"), open(input_path, "rb") as input_file:
+        header, chunks, excess = parse_png(input_file)
+
+    report["crc_failures"] = [
+        chunk.type.decode(errors="replace") for chunk in chunks if not chunk.check_crc()
+    ]
+    report["excess_bytes"] = len(excess)
+    if len(excess) != 0 and excess_path is not None:
+        try:
+            with open(excess_path, "wb") as f:
+                f.write(excess)
+            LOGGER.warning("Excess data detected and saved to %s", excess_path)
+            report["excess_file"] = excess_path
+        except Exception as e:
+            LOGGER.warning("Excess data detected but failed to save", exc_info=e)
+
+    if args.print_metadata:
+        meta = PngMetadata.from_bytes(chunks[0].data)
+        print(meta, file=output)
+
+    if args.infer_dimensions:
+        candidates = infer_dimensions(
+            read_idat(chunks), max_width=args.max_width, max_height=args.max_height
+        )
+        for candidate in candidates[:INFERRED_DIMENSIONS_SHOWN]:
+            print(candidate, file=output)
+        report["inferred_dimensions"] = [
+            asdict(candidate) for candidate in candidates[:INFERRED_DIMENSIONS_SHOWN]
+        ]
+
+    if args.rank_dimensions:
+        data = read_idat(chunks)
+        candidates = distinct_layouts(
+            [
+                candidate
+                for candidate in infer_dimensions(
+                    data, max_width=args.max_width, max_height=args.max_height
+                )
+                if candidate.valid_filters == candidate.scanlines
+            ]
+        )
+        ranked = rank_decoded_dimensions(data, candidates)[: args.rank_dimensions]
+        for score, candidate in ranked:
+            print(f"{score:.4f}", candidate, file=output)
+        report["ranked_dimensions"] = [
+            {"score": score, **asdict(candidate)} for score, candidate in ranked
+        ]
+
+    with timed(timings, "repair"):
+        if args.set:
+            chunks = [
+                (
+                    set_metadata_property(chunk, args.set)
+                    if chunk.type == b"IHDR"
+                    else chunk
+                )
+                for chunk in chunks
+            ]
+
+        if args.fix_chunk_bitflip:
+            chunks = [repair_chunk(chunk, find_bitflip_repairs) for chunk in chunks]
+
+        if args.fix_chunk_byte:
+            chunks = [repair_chunk(chunk, find_byte_repairs) for chunk in chunks]
+
+        if args.fix_ihdr_field:
+            chunks = [
+                (
+                    bruteforce_ihdr_field(chunk, args.fix_ihdr_field)
+                    if chunk.type == b"IHDR"
+                    else chunk
+                )
+                for chunk in chunks
+            ]
+
+        if args.fix_ihdr:
+            match args.prior:
+                case "area":
+                    prior = area_prior
+                case "aspect":
+                    width, _, height = args.aspect_ratio.partition(":")
+                    prior = partial(aspect_ratio_prior, int(width) / int(height))
+                case _:
+                    prior = None
+
+            chunks = [
+                (
+                    bruteforce_ihdr_dimensions(
+                        chunk,
+                        max_width=args.max_width,
+                        max_height=args.max_height,
+                        jobs=jobs,
+                        prior=prior,
+                        first_only=args.first_match,
+                        idat_data=read_idat(chunks),
+                        limit=args.max_matches,
+                    )
+                    if chunk.type == b"IHDR"
+                    else chunk
+                )
+                for chunk in chunks
+            ]
+
+        if args.rand_plte:
+            chunks = [
+                randomise_plte(chunk) if chunk.type == b"PLTE" else chunk
+                for chunk in chunks
+            ]
+
+        if args.fix_crc:
+            for chunk in chunks:
+                chunk.recalc_crc()
+
+    if args.search_plte:
+        with timed(timings, "search_plte"):
+            stem, _ = os.path.splitext(output_path or input_path)
+            report["palettes"] = []
+            for rank, (score, name, plte) in enumerate(
+                search_plte(chunks, args.search_plte, args.random_palettes)
+            ):
+                path = f"{stem}.plte{rank}.png"
+                save_png_file(path, header, replace_plte(chunks, plte))
+                print(f"{score:.2f}\t{name}\t{path}", file=output)
+                report["palettes"].append({"score": score, "name": name, "file": path})
+
+    try:
+        report["metadata"] = asdict(PngMetadata.from_bytes(chunks[0].data))
+    except Exception:
+        report["metadata"] = None
+
+    if args.decode:
+        meta = PngMetadata.from_bytes(chunks[0].data)
+        image = decode_image(
+            meta.width,
+            meta.height,
+            meta.bit_depth,
+            meta.color_type,
+            meta.interlace_method,
+            read_idat(chunks),
+        )
+        np.save(args.decode, image)
+
+    with timed(timings, "validate"):
+        idat_report = detect_excess_data(chunks)
+    report["idat"] = asdict(idat_report) if idat_report is not None else None
+
+    if output_path:
+        with timed(timings, "save"):
+            save_png_file(output_path, header, chunks)
+
+    return report
+
+
+# files handed to each batch worker at a time
+BATCH_CHUNKSIZE = 16
+
+
+def _process_batch_file(
+    args: Namespace, paths: tuple[str, str | None, str | None]
+) -> dict[str, Any]:
+    input_path, output_path, excess_path = paths
+    try:
+        return process_file(args, input_path, output_path, excess_path)
+    except Exception as e:
+        LOGGER.exception("Failed to process %s", input_path, exc_info=e)
+        return {"input_file": input_path, "error": repr(e)}
+
+
+def batch_inputs(patterns: list[str]) -> list[tuple[str, str]]:
+    """Expand directories (recursively) and globs into (input path, output name) pairs.
+
+    Files are named relative to the directory they were found under, so the outputs of
+    identically named files from different directories don't collide.
+    """
+    inputs = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, dirs, files in os.walk(pattern):
+                dirs.sort()
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    inputs.append((path, os.path.relpath(path, pattern)))
+        else:
+            for path in sorted(glob.glob(pattern, recursive=True)):
+                if os.path.isfile(path):
+                    inputs.append((path, os.path.basename(path)))
+
+    # disambiguate anything which still collides
+    seen: dict[str, int] = {}
+    named = []
+    for path, name in inputs:
+        count = seen.get(name, 0)
+        seen[name] = count + 1
+        if count:
+            stem, ext = os.path.splitext(name)
+            name = f"{stem}.{count}{ext}"
+        named.append((path, name))
+
+    return named
+
+
+def run_batch(args: Namespace):
+    jobs = []
+    for input_path, name in batch_inputs(args.batch):
+        if args.output_dir is not None:
+            output_path = os.path.join(args.output_dir, name)
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            excess_path = output_path + ".excess"
+        else:
+            output_path = excess_path = None
+        jobs.append((input_path, output_path, excess_path))
+
+    LOGGER.info("Processing %d files on %d jobs", len(jobs), args.jobs)
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        reports = executor.map(
+            partial(_process_batch_file, args), jobs, chunksize=BATCH_CHUNKSIZE
+        )
+        write_reports(args.report or "-", reports)
+
+
+def write_reports(path: str, reports):
+    report_file = sys.stdout if path == "-" else open(path, "w")
+    for report in reports:
+        report_file.write(json.dumps(report) + "\n")
+        report_file.flush()
+
+    if report_file is not sys.stdout:
+        report_file.close()
+
+
 def main():
     args = argument_parser().parse_args()
     level: int | str = (
@@ -363,40 +2316,19 @@ def main():
     ch.setFormatter(CustomFormatter())
     LOGGER.addHandler(ch)
 
-    input_file = open(args.input_file, "rb")
-    header, chunks = parse_png(input_file)
+    if args.stats:
+        instrumentation.STATS.enable(args.stats, args.stats_file)
 
-    if args.print_metadata:
-        meta = PngMetadata.from_bytes(chunks[0].data)
-        print(meta)
-
-    if args.set:
-        chunks = [
-            (set_metadata_property(chunk, args.set) if chunk.type == b"IHDR" else chunk)
-            for chunk in chunks
-        ]
-
-    if args.fix_ihdr:
-        chunks = [
-            (bruteforce_ihdr_dimensions(chunk) if chunk.type == b"IHDR" else chunk)
-            for chunk in chunks
-        ]
-
-    if args.rand_plte:
-        chunks = [
-            randomise_plte(chunk) if chunk.type == b"PLTE" else chunk
-            for chunk in chunks
-        ]
-
-    if args.fix_crc:
-        for chunk in chunks:
-            chunk.recalc_crc()
-
-    detect_excess_data(chunks)
+    if args.batch:
+        with instrumentation.stage("batch"):
+            run_batch(args)
+        return
 
-    if args.output_file:
-        with open(args.output_file, "wb") as f:
-            save_png(f, header, chunks)
+    report = process_file(
+        args, args.input_file, args.output_file, args.excess_file, jobs=args.jobs
+    )
+    if args.report is not None:
+        write_reports(args.report, [report])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,25 @@
+import struct
+import zlib
+
+
+def chunk(chunk_type: bytes, data: bytes) -> bytes:
+    crc = zlib.crc32(chunk_type + data)
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", crc)
+
+
+def make_png(width: int, height: int) -> bytes:
+    """An 8 bit RGB gradient."""
+    rows = b"".join(
+        b"\0"
+        + b"".join(
+            bytes((x * 4 % 256, y * 4 % 256, (x + y) % 256)) for x in range(width)
+        )
+        for y in range(height)
+    )
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", ihdr)
+        + chunk(b"IDAT", zlib.compress(rows))
+        + chunk(b"IEND", b"")
+    )
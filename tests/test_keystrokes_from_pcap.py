@@ -0,0 +1,33 @@
+from hid_keymaps import LAYOUTS, compile_layout
+from keystrokes_from_pcap import KeystrokeDecoder, decode_keystrokes, load_reports
+
+CTRL = 0x01
+C, V = 0x06, 0x19
+
+
+def report(modifiers=0, *keys):
+    return bytes([modifiers, 0, *keys, *[0] * (6 - len(keys))])
+
+
+# typing "c", then copying and pasting with ctrl held
+REPORTS = [
+    report(0, C),
+    report(),
+    report(CTRL),
+    report(CTRL, C),
+    report(CTRL),
+    report(CTRL, V),
+    report(),
+]
+
+
+def test_raw_names_shortcuts():
+    keymap = compile_layout(LAYOUTS["uk"])
+    reports = load_reports(REPORTS)
+    assert decode_keystrokes(reports, keymap, raw=True) == "c[CTRL+c][CTRL+v]"
+    assert decode_keystrokes(reports, keymap) == "c"
+
+
+def test_follow_names_shortcuts():
+    decoder = KeystrokeDecoder(compile_layout(LAYOUTS["uk"]))
+    assert "".join(map(decoder.feed, REPORTS)) == "c[CTRL+c][CTRL+v]"
@@ -0,0 +1,87 @@
+import struct
+
+import numpy as np
+
+from PIL import Image
+
+from mouse_move_from_pcap import MouseDecoder, detect_format, write_animation
+
+
+def smooth_path(n: int = 2000) -> tuple[np.ndarray, np.ndarray]:
+    """Movements of a hand drawing curves, changing speed and direction gradually."""
+    rng = np.random.default_rng(3)
+    direction = np.cumsum(rng.normal(0, 0.3, n))
+    speed = np.abs(np.cumsum(rng.normal(0, 0.5, n))) % 15
+    dx = np.rint(speed * np.cos(direction)).astype(int)
+    dy = np.rint(speed * np.sin(direction)).astype(int)
+    return dx, dy
+
+
+def test_tablet_with_button_held_is_absolute():
+    # a constant first byte of 1 looks like the report id of boot-report-id
+    dx, dy = smooth_path()
+    x = np.cumsum(dx) + 20000
+    y = np.cumsum(dy) + 20000
+    reports = [struct.pack("<BHH", 1, x[i], y[i]) for i in range(len(x))]
+
+    assert detect_format(reports).name == "absolute"
+
+
+def test_boot_mouse_with_report_id():
+    dx, dy = smooth_path()
+    buttons = (np.arange(len(dx)) // 50) % 2
+    reports = [
+        struct.pack("<BBbbb", 1, buttons[i], dx[i], dy[i], 0) for i in range(len(dx))
+    ]
+
+    assert detect_format(reports).name == "boot-report-id"
+
+
+def test_boot_mouse_with_button_held():
+    dx, dy = smooth_path()
+    reports = [struct.pack("<Bbbb", 1, dx[i], dy[i], 0) for i in range(len(dx))]
+
+    assert detect_format(reports).name == "boot"
+
+
+def test_warnings_stay_off_stdout(capsys, caplog):
+    # 7 byte reports don't fit any format
+    detect_format([bytes(7)] * 10)
+
+    assert capsys.readouterr().out == ""
+    assert "no report format fits" in caplog.text
+
+
+def test_follow_boot_mouse_with_button_held_first():
+    # the held button makes the first report look like it has a report id
+    dx, dy = smooth_path(200)
+    dx[0], dy[0] = 5, 0
+    reports = [
+        struct.pack("<Bbbb", int(i == 0), dx[i], dy[i], 0) for i in range(len(dx))
+    ]
+
+    decoder = MouseDecoder()
+    positions = [pos for report in reports for pos in decoder.feed(report)]
+    positions += decoder.flush()
+
+    assert decoder.report_format.name == "boot"
+    assert len(positions) == len(reports)
+    assert tuple(positions[0]) == (5, 0, True, False, False)
+    assert tuple(positions[-1][:2]) == (dx.sum(), dy.sum())
+
+
+def test_write_animation_streams_every_frame(tmp_path):
+    def frames():
+        canvas = np.zeros((8, 8, 3), dtype=np.uint8)
+        for i in range(20):
+            # drawn over in place, like draw_frames does
+            canvas[:] = i * 10
+            yield canvas
+
+    for name in ["drawing.gif", "drawing.png"]:
+        path = str(tmp_path / name)
+        write_animation(frames(), [0.1] * 20, path, jobs=2)
+        with Image.open(path) as img:
+            assert img.n_frames == 20
+            img.seek(19)
+            assert img.convert("RGB").getpixel((0, 0)) == (190, 190, 190)
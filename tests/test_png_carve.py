@@ -0,0 +1,35 @@
+from helpers import make_png
+from png_carve import find_pngs, save_carved
+from png_fix import PNG_SIGNATURE
+
+
+def carve(data: bytes):
+    return list(find_pngs(memoryview(data)))
+
+
+def test_truncated_png_stops_at_the_next_png():
+    truncated = make_png(32, 32)[:200]
+    whole = make_png(8, 8)
+    data = b"junk" + truncated + b"more junk" + whole
+
+    first, second = carve(data)
+
+    assert first.start == 4
+    assert first.end <= second.start
+    assert not first.complete
+    assert second.start == data.index(whole)
+    assert second.end == len(data)
+    assert second.complete
+
+
+def test_ihdr_without_room_for_a_signature(tmp_path):
+    png = make_png(8, 8)
+    data = png[len(PNG_SIGNATURE) :]
+
+    (carved,) = carve(data)
+    assert carved.start == 0
+    assert not carved.signature
+
+    path = tmp_path / "carved.png"
+    save_carved(memoryview(data), carved, str(path))
+    assert path.read_bytes() == png
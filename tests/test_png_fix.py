@@ -0,0 +1,169 @@
+import io
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+import png_fix
+from helpers import make_png
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_batch_stdout_is_json_lines(tmp_path):
+    for i in range(3):
+        (tmp_path / f"{i}.png").write_bytes(make_png(16 + i, 12))
+
+    result = subprocess.run(
+        [
+            sys.executable,
+            os.path.join(ROOT, "png_fix.py"),
+            "--batch",
+            str(tmp_path),
+            "--jobs",
+            "2",
+            "--print-metadata",
+            "--infer-dimensions",
+            "--rank-dimensions",
+            "2",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    lines = result.stdout.splitlines()
+    assert len(lines) == 3
+    reports = [json.loads(line) for line in lines]
+    assert {os.path.basename(report["input_file"]) for report in reports} == {
+        "0.png",
+        "1.png",
+        "2.png",
+    }
+
+
+def test_rank_dimensions_finds_the_true_layout():
+    _, chunks, _ = png_fix.parse_png(io.BytesIO(make_png(64, 48)))
+    data = png_fix.read_idat(chunks)
+    candidates = png_fix.distinct_layouts(
+        [
+            candidate
+            for candidate in png_fix.infer_dimensions(data)
+            if candidate.valid_filters == candidate.scanlines
+        ]
+    )
+
+    [(_, best), *_] = png_fix.rank_decoded_dimensions(data, candidates)
+    assert (best.width, best.height, best.bit_depth) == (64, 48, 8)
+    assert best.color_type == png_fix.ColorType.Truecolor
+
+
+def test_single_row_layouts_are_not_evidence():
+    assert png_fix.smoothness_score(np.zeros((1, 8, 1))) == float("inf")
+
+
+def test_full_range_ihdr_search_is_capped():
+    _, chunks, _ = png_fix.parse_png(io.BytesIO(make_png(64, 48)))
+    largest = png_fix.MAX_PNG_DIMENSION
+    matches = png_fix.solve_ihdr_dimensions(chunks[0], largest, largest, limit=100)
+    assert len(matches) == 100
+    assert (64, 48) in matches
+
+
+def test_fix_in_place(tmp_path):
+    # big enough that the chunks are views into a mapping of the file
+    png = make_png(400, 300)
+    path = tmp_path / "in-place.png"
+    path.write_bytes(png)
+    (tmp_path / "batch").mkdir()
+    (tmp_path / "batch" / "0.png").write_bytes(png)
+
+    run = [sys.executable, os.path.join(ROOT, "png_fix.py"), "--fix-crc"]
+    subprocess.run(
+        [*run, "--input-file", str(path), "--output-file", str(path)], check=True
+    )
+    batch = str(tmp_path / "batch")
+    subprocess.run(
+        [*run, "--batch", batch, "--output-dir", batch],
+        check=True,
+        capture_output=True,
+    )
+
+    assert path.read_bytes() == png
+    assert (tmp_path / "batch" / "0.png").read_bytes() == png
+    assert os.listdir(batch) == ["0.png"]
+
+
+def test_truncated_idat_is_recovered():
+    png = make_png(64, 48)
+    idat = png.index(b"IDAT")
+    truncated = png[: idat + (len(png) - idat) * 6 // 10]
+
+    _, chunks, excess = png_fix.parse_png(io.BytesIO(truncated))
+    assert len(excess) == 0
+    assert chunks[-1].type == b"IDAT" and chunks[-1].truncated
+
+    report = png_fix.detect_excess_data(chunks)
+    assert report.truncated
+    assert report.scanlines > 0
+
+
+def unfilter_bytewise(scanlines: np.ndarray, bpp: int) -> np.ndarray:
+    """The PNG spec's unfiltering, a byte at a time."""
+    rows = np.zeros((len(scanlines) + 1, scanlines.shape[1] - 1 + bpp), dtype=int)
+    for y, (filter_type, *row) in enumerate(scanlines.tolist(), 1):
+        for x, byte in enumerate(row, bpp):
+            a, b, c = rows[y, x - bpp], rows[y - 1, x], rows[y - 1, x - bpp]
+            p = a + b - c
+            paeth = min((abs(p - a), 0, a), (abs(p - b), 1, b), (abs(p - c), 2, c))[2]
+            predictor = [0, a, b, (a + b) // 2, paeth][filter_type]
+            rows[y, x] = (byte + predictor) % 256
+    return rows[1:, bpp:].astype(np.uint8)
+
+
+def test_unfilter_scanlines_matches_the_spec():
+    rng = np.random.default_rng(0)
+    # tall enough to be unfiltered in several bands
+    for height, width, bpp in [(1, 1, 1), (150, 7, 3), (9, 40, 4), (70, 3, 8)]:
+        filters = rng.integers(0, 5, height, dtype=np.uint8)
+        filters[: height // 3] = rng.integers(0, 3, height // 3)
+        rows = rng.integers(0, 256, (height, width * bpp), dtype=np.uint8)
+        scanlines = np.hstack([filters[:, None], rows])
+
+        expected = unfilter_bytewise(scanlines, bpp)
+        assert np.array_equal(png_fix.unfilter_scanlines(scanlines, bpp), expected)
+
+
+def flipped_chunk(size: int, *bits: int) -> tuple[png_fix.Chunk, png_fix.Chunk]:
+    data = bytearray(np.random.default_rng(size).bytes(size))
+    good = png_fix.Chunk(size, b"IDAT", bytes(data))
+    good.recalc_crc()
+    for bit in bits:
+        data[bit // 8] ^= 1 << (bit % 8)
+    return good, png_fix.Chunk(size, b"IDAT", bytes(data), good.crc)
+
+
+def test_bitflip_repairs():
+    # a unique single flip is the only repair, even in a large chunk
+    good, bad = flipped_chunk(1 << 16, 1234)
+    [repair] = png_fix.find_bitflip_repairs(bad)
+    assert bytes(png_fix.repair_chunk(bad, png_fix.find_bitflip_repairs).data) == (
+        good.data
+    )
+
+    # pairs of flips are found in small chunks
+    good, bad = flipped_chunk(256, 100, 1000)
+    repaired = [bytes(r.apply(bad).data) for r in png_fix.find_bitflip_repairs(bad)]
+    assert good.data in repaired
+
+    # but not searched for in large ones, where most of them would be chance
+    _, bad = flipped_chunk(png_fix.MAX_TWO_FLIP_CHUNK_SIZE + 1, 100, 1000)
+    assert png_fix.find_bitflip_repairs(bad) == []
+
+
+def test_ambiguous_repairs_are_not_applied():
+    _, bad = flipped_chunk(256, 100)
+    repairs = [png_fix.ChunkRepair([(i, 1)]) for i in range(10)]
+    assert png_fix.repair_chunk(bad, lambda chunk: repairs) is bad
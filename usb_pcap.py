@@ -0,0 +1,420 @@
+import csv
+import io
+import mmap
+import struct
+import time
+
+from collections import Counter
+from dataclasses import dataclass
+from functools import partial
+from typing import BinaryIO, Iterable, Iterator
+
+import numpy as np
+
+import instrumentation
+
+LINKTYPE_USB_LINUX = 189
+LINKTYPE_USB_LINUX_MMAPPED = 220
+LINKTYPE_USBPCAP = 249
+
+PCAP_MAGIC_MICROSECONDS = 0xA1B2C3D4
+PCAP_MAGIC_NANOSECONDS = 0xA1B23C4D
+PCAPNG_SECTION_HEADER = 0x0A0D0D0A
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+PCAPNG_INTERFACE_DESCRIPTION = 1
+PCAPNG_OBSOLETE_PACKET = 2
+PCAPNG_SIMPLE_PACKET = 3
+PCAPNG_ENHANCED_PACKET = 6
+PCAPNG_OPTION_TSRESOL = 9
+
+# how often to check for more data when following a capture as it's written
+FOLLOW_POLL_INTERVAL = 0.1
+
+USB_TRANSFER_INTERRUPT = 1
+USB_DIRECTION_IN = 0x80
+
+# id, type, transfer type, endpoint, device, bus, setup flag, data flag, seconds,
+# microseconds, status, length, captured length, in the byte order of the capture
+USBMON_HEADER = "QBBBBHbbqiiII"
+USBMON_HEADER_SIZE = {LINKTYPE_USB_LINUX: 48, LINKTYPE_USB_LINUX_MMAPPED: 64}
+USBMON_COMPLETE = ord("C")
+
+# header length, IRP id, status, function, info, bus, device, endpoint, transfer type,
+# data length
+USBPCAP_HEADER = struct.Struct("<HQIHBHHBBI")
+# set when the IRP is on its way back from the device, i.e. it carries the response
+USBPCAP_INFO_PDO_TO_FDO = 1
+
+
+# scancodes after this are reserved, see the keyboard page of the HID usage tables
+MAX_SCANCODE = 0xE7
+# how much of a stream has to fit a report format for it to be classified as that device
+CLASSIFY_THRESHOLD = 0.95
+MOUSE_REPORT_SIZES = range(3, 10)
+
+
+@dataclass
+class UsbPacket:
+    timestamp: float
+    bus: int
+    device: int
+    endpoint: int
+    # a memoryview into the capture, to avoid copying the packet data
+    data: memoryview
+
+
+def map_file(input_file: BinaryIO) -> memoryview:
+    """Map the capture into memory, so captures larger than RAM are paged in as read."""
+    try:
+        mapping = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        buf = memoryview(input_file.read())
+        instrumentation.count("bytes read", len(buf))
+        return buf
+
+    instrumentation.count("bytes read", len(mapping))
+    if hasattr(mmap, "MADV_SEQUENTIAL"):
+        mapping.madvise(mmap.MADV_SEQUENTIAL)
+    return memoryview(mapping)
+
+
+def is_capture(buf: memoryview) -> bool:
+    if len(buf) < 4:
+        return False
+    magics = (PCAP_MAGIC_MICROSECONDS, PCAP_MAGIC_NANOSECONDS, PCAPNG_SECTION_HEADER)
+    return any(struct.unpack_from(endian + "I", buf)[0] in magics for endian in "<>")
+
+
+def _pcap_header(header: bytes) -> tuple[str, float, int]:
+    """The byte order, timestamp resolution and linktype of a pcap file header."""
+    for endian in "<>":
+        (magic,) = struct.unpack_from(endian + "I", header)
+        if magic in (PCAP_MAGIC_MICROSECONDS, PCAP_MAGIC_NANOSECONDS):
+            break
+    resolution = 1e-6 if magic == PCAP_MAGIC_MICROSECONDS else 1e-9
+    (linktype,) = struct.unpack_from(endian + "I", header, 20)
+    return endian, resolution, linktype
+
+
+def _iter_pcap(buf: memoryview) -> Iterator[tuple[int, float, memoryview, str]]:
+    endian, resolution, linktype = _pcap_header(buf)
+    record = struct.Struct(endian + "IIII")
+
+    offset = 24
+    while offset + record.size <= len(buf):
+        seconds, fraction, captured, _ = record.unpack_from(buf, offset)
+        offset += record.size
+        if offset + captured > len(buf):
+            break
+        packet = buf[offset : offset + captured]
+        yield linktype, seconds + fraction * resolution, packet, endian
+        offset += captured
+
+
+def _tsresol(options: memoryview, endian: str) -> float:
+    offset = 0
+    while offset + 4 <= len(options):
+        code, length = struct.unpack_from(endian + "HH", options, offset)
+        if code == 0:
+            break
+        if code == PCAPNG_OPTION_TSRESOL and length >= 1:
+            value = options[offset + 4]
+            return 2.0 ** -(value & 0x7F) if value & 0x80 else 10.0**-value
+        offset += 4 + (length + 3) // 4 * 4
+    return 1e-6
+
+
+def _pcapng_block_endian(block: memoryview, endian: str) -> str:
+    """The byte order from here on, which every section header sets for its section."""
+    if struct.unpack_from("<I", block)[0] != PCAPNG_SECTION_HEADER:
+        return endian
+    (byte_order,) = struct.unpack_from("<I", block, 8)
+    return "<" if byte_order == PCAPNG_BYTE_ORDER_MAGIC else ">"
+
+
+def _pcapng_packet(
+    block_type: int,
+    body: memoryview,
+    endian: str,
+    interfaces: list[tuple[int, float]],
+) -> tuple[int, float, memoryview] | None:
+    """The (linktype, timestamp, packet) in a block, keeping track of the interfaces."""
+    if block_type == PCAPNG_SECTION_HEADER:
+        interfaces.clear()
+        return None
+
+    if block_type == PCAPNG_INTERFACE_DESCRIPTION:
+        (linktype,) = struct.unpack_from(endian + "H", body)
+        interfaces.append((linktype, _tsresol(body[8:], endian)))
+        return None
+
+    if block_type == PCAPNG_ENHANCED_PACKET:
+        interface, high, low, captured, _ = struct.unpack_from(endian + "IIIII", body)
+    elif block_type == PCAPNG_OBSOLETE_PACKET:
+        interface, _, high, low, captured, _ = struct.unpack_from(
+            endian + "HHIIII", body
+        )
+    elif block_type == PCAPNG_SIMPLE_PACKET:
+        # simple packets are always from the first interface, and have no timestamp
+        (length,) = struct.unpack_from(endian + "I", body)
+        linktype, _ = interfaces[0]
+        return linktype, 0.0, body[4 : 4 + min(length, len(body) - 4)]
+    else:
+        return None
+
+    linktype, resolution = interfaces[interface]
+    return linktype, ((high << 32) | low) * resolution, body[20 : 20 + captured]
+
+
+def _iter_pcapng(buf: memoryview) -> Iterator[tuple[int, float, memoryview, str]]:
+    endian = "<"
+    # (linktype, timestamp resolution) of each interface in the current section
+    interfaces: list[tuple[int, float]] = []
+
+    offset = 0
+    while offset + 12 <= len(buf):
+        endian = _pcapng_block_endian(buf[offset:], endian)
+        block_type, block_length = struct.unpack_from(endian + "II", buf, offset)
+        if block_length < 12 or offset + block_length > len(buf):
+            break
+        body = buf[offset + 8 : offset + block_length - 4]
+        offset += block_length
+
+        if packet := _pcapng_packet(block_type, body, endian, interfaces):
+            yield *packet, endian
+
+
+def iter_records(buf: memoryview) -> Iterator[tuple[int, float, memoryview, str]]:
+    """Yield (linktype, timestamp, packet, byte order) for every packet in a pcap or pcapng."""
+    if struct.unpack_from("<I", buf)[0] == PCAPNG_SECTION_HEADER:
+        return _iter_pcapng(buf)
+    return _iter_pcap(buf)
+
+
+def _read_exact(
+    input_file: BinaryIO, size: int, follow: bool, poll_interval: float
+) -> bytes | None:
+    """Read exactly ``size`` bytes, waiting for the file to grow when following it."""
+    data = input_file.read(size) or b""
+    while len(data) < size:
+        if not follow:
+            return None
+        time.sleep(poll_interval)
+        data += input_file.read(size - len(data)) or b""
+    instrumentation.count("bytes read", size)
+    return data
+
+
+def stream_records(
+    input_file: BinaryIO,
+    follow: bool = False,
+    poll_interval: float = FOLLOW_POLL_INTERVAL,
+) -> Iterator[tuple[int, float, memoryview, str]]:
+    """Like iter_records, but reading one record at a time from a file or pipe.
+
+    With ``follow`` a regular file is waited on to grow, like ``tail -f``. Pipes
+    (e.g. ``tcpdump -w -``) are read until they are closed.
+    """
+    # there's no way to tell a pipe has more to come other than blocking on it
+    follow = follow and input_file.seekable()
+    read = partial(_read_exact, input_file, follow=follow, poll_interval=poll_interval)
+
+    if (magic := read(4)) is None:
+        return
+
+    if struct.unpack("<I", magic)[0] != PCAPNG_SECTION_HEADER:
+        if (rest := read(20)) is None:
+            return
+        endian, resolution, linktype = _pcap_header(magic + rest)
+        record = struct.Struct(endian + "IIII")
+        while (header := read(record.size)) is not None:
+            seconds, fraction, captured, _ = record.unpack(header)
+            if (packet := read(captured)) is None:
+                return
+            timestamp = seconds + fraction * resolution
+            yield linktype, timestamp, memoryview(packet), endian
+        return
+
+    endian = "<"
+    interfaces: list[tuple[int, float]] = []
+    block_type = magic
+    # read the first word of the body too, a section header's byte order is needed to
+    # read its length
+    while (header := read(8)) is not None:
+        header = block_type + header
+        endian = _pcapng_block_endian(header, endian)
+        block_type, block_length = struct.unpack_from(endian + "II", header)
+        if block_length < 12 or (rest := read(block_length - 12)) is None:
+            return
+        body = memoryview(header[8:] + rest)[:-4]
+
+        if packet := _pcapng_packet(block_type, body, endian, interfaces):
+            yield *packet, endian
+
+        if (block_type := read(4)) is None:
+            return
+
+
+def parse_usb_packet(
+    linktype: int, timestamp: float, packet: memoryview, endian: str = "<"
+) -> UsbPacket | None:
+    """Parse interrupt IN transfers returning data, ignoring everything else."""
+    if linktype in USBMON_HEADER_SIZE:
+        header_size = USBMON_HEADER_SIZE[linktype]
+        if len(packet) < header_size:
+            return None
+        fields = struct.unpack_from(endian + USBMON_HEADER, packet)
+        _, event, transfer, endpoint, device, bus = fields[:6]
+        captured = fields[-1]
+        if (
+            event != USBMON_COMPLETE
+            or transfer != USB_TRANSFER_INTERRUPT
+            or not endpoint & USB_DIRECTION_IN
+            or captured == 0
+        ):
+            return None
+        data = packet[header_size : header_size + captured]
+
+    elif linktype == LINKTYPE_USBPCAP:
+        if len(packet) < USBPCAP_HEADER.size:
+            return None
+        header_size, _, _, _, info, bus, device, endpoint, transfer, length = (
+            USBPCAP_HEADER.unpack_from(packet)
+        )
+        if (
+            not info & USBPCAP_INFO_PDO_TO_FDO
+            or transfer != USB_TRANSFER_INTERRUPT
+            or not endpoint & USB_DIRECTION_IN
+            or length == 0
+        ):
+            return None
+        data = packet[header_size : header_size + length]
+
+    else:
+        return None
+
+    return UsbPacket(timestamp, bus, device, endpoint & 0x7F, data)
+
+
+def iter_hid_reports(buf: memoryview) -> Iterator[UsbPacket]:
+    """Yield the interrupt IN packets of a pcap or pcapng, which carry HID reports."""
+    return _hid_reports(iter_records(buf))
+
+
+def stream_hid_reports(
+    input_file: BinaryIO, follow: bool = False
+) -> Iterator[UsbPacket]:
+    """Yield the HID reports of a capture as it is read, see stream_records."""
+    return _hid_reports(stream_records(input_file, follow))
+
+
+def _hid_reports(records) -> Iterator[UsbPacket]:
+    for linktype, timestamp, packet, endian in records:
+        instrumentation.count("packets")
+        if (usb := parse_usb_packet(linktype, timestamp, packet, endian)) is not None:
+            instrumentation.count("HID reports")
+            yield usb
+
+
+def read_csv(path: str) -> Iterator[UsbPacket]:
+    """Yield the HID reports of a Wireshark CSV export with a "HID Data" column.
+
+    The device is taken from the "Source" column (bus.device.endpoint) when present.
+    """
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            if not (hid_data := row.get("HID Data")):
+                continue
+            instrumentation.count("packets")
+
+            source = row.get("Source", "").split(".")
+            if len(source) == 3 and all(part.isdigit() for part in source):
+                bus, device, endpoint = map(int, source)
+            else:
+                bus = device = endpoint = 0
+            timestamp = float(row.get("Time") or 0)
+            yield UsbPacket(
+                timestamp, bus, device, endpoint, memoryview(bytes.fromhex(hid_data))
+            )
+
+
+def read_reports(path: str) -> Iterator[UsbPacket]:
+    """Yield the HID reports from a pcap / pcapng, or a Wireshark CSV export."""
+    with open(path, "rb") as f:
+        buf = map_file(f)
+
+    if is_capture(buf):
+        return iter_hid_reports(buf)
+    return read_csv(path)
+
+
+def group_streams(
+    packets: Iterable[UsbPacket],
+) -> dict[tuple[int, int, int], list[UsbPacket]]:
+    """Split the reports of every (bus, device, endpoint) into their own stream."""
+    streams: dict[tuple[int, int, int], list[UsbPacket]] = {}
+    for packet in packets:
+        key = (packet.bus, packet.device, packet.endpoint)
+        streams.setdefault(key, []).append(packet)
+    return streams
+
+
+def stream_name(key: tuple[int, int, int]) -> str:
+    return "%d.%d.%d" % key
+
+
+def _looks_like_keyboard(reports: np.ndarray) -> np.ndarray:
+    """Which (N, 8) reports fit the boot keyboard format."""
+    scancodes = reports[:, 2:]
+    valid = (scancodes <= MAX_SCANCODE).all(axis=1)
+    # keys are left packed, so nothing follows a zero
+    packed = (np.diff((scancodes != 0).astype(np.int8), axis=1) <= 0).all(axis=1)
+    return (reports[:, 1] == 0) & valid & packed
+
+
+def classify_report(data: memoryview) -> str:
+    """Guess what kind of device a single report came from, see classify_stream."""
+    if len(data) == 8:
+        report = np.frombuffer(data, dtype=np.uint8).reshape(1, 8)
+        if _looks_like_keyboard(report)[0]:
+            return "keyboard"
+    if len(data) in MOUSE_REPORT_SIZES:
+        return "mouse"
+    return "other"
+
+
+def classify_stream(packets: list[UsbPacket]) -> str:
+    """Guess whether a stream of reports came from a "keyboard", "mouse" or "other"."""
+    if not packets:
+        return "other"
+
+    lengths = Counter(len(packet.data) for packet in packets)
+    length, count = lengths.most_common(1)[0]
+    if count < CLASSIFY_THRESHOLD * len(packets):
+        return "other"
+
+    if length == 8:
+        reports = np.frombuffer(
+            b"".join(packet.data for packet in packets if len(packet.data) == 8),
+            dtype=np.uint8,
+        ).reshape(-1, 8)
+        if _looks_like_keyboard(reports).mean() >= CLASSIFY_THRESHOLD:
+            return "keyboard"
+
+    if length in MOUSE_REPORT_SIZES:
+        return "mouse"
+    return "other"
+
+
+class StreamClassifier:
+    """Classifies devices a report at a time, by the kind most of their reports look like."""
+
+    def __init__(self):
+        self.votes: dict[tuple[int, int, int], Counter] = {}
+
+    def classify(self, packet: UsbPacket) -> str:
+        key = (packet.bus, packet.device, packet.endpoint)
+        votes = self.votes.setdefault(key, Counter())
+        votes[classify_report(packet.data)] += 1
+        return votes.most_common(1)[0][0]